@@ -1,8 +1,13 @@
 import numpy as np
-from pymultinest.solve import solve
+import argparse
+import hashlib
 import json
-import sys
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from coord import *
+from geometry import ReflexGeometry, reflex_vector, solar_shift, rsun_mw, vsun_mw
+from catalog import Catalog, catalog_solar, load_catalog
 """
 Important:
 
@@ -24,116 +29,34 @@ The units for the input file are as follows:
 - Errors: mas/yr
 """
 
-# Define the solar motion and position in the galactocentric frame
-vsun_mw = np.array([11.1, 244.24, 7.25])  # km/s
-rsun_mw = np.array([-8.3, 0., 0.02])  # kpc
+# The default solar motion and position in the galactocentric frame, vsun_mw and rsun_mw, are defined
+# in geometry.py; ReflexFit takes others with rsun= and vsun=
 
-dfname = sys.argv[1]
-prefix = sys.argv[2]
 
-
-# 1. Define the galactic cartesian coordinates from input file of shape (cols,rows)
-d = np.loadtxt(dfname).T
-#uncomment this if file has shape rows,cols
-# d = np.loadtxt(dfname)
-x, y, z = d[:, 0], d[:, 1], d[:, 2]
-vx, vy, vz = d[:, 3], d[:, 4], d[:, 5]
-
-rgal = np.zeros((len(x), 3))
-rgal[:, 0] = x
-rgal[:, 1] = y
-rgal[:, 2] = z
-
-vgal = np.zeros((len(x), 3))
-vgal[:, 0] = vx
-vgal[:, 1] = vy
-vgal[:, 2] = vz
-
-# 2. compute spherical galactic coordinates
-rgalsph = np.zeros((len(x), 3))
-tmp = cartesian_to_spherical(rgal[:, 0], rgal[:, 1], rgal[:, 2],
-                             vgal[:, 0], vgal[:, 1], vgal[:, 2])
-rgalsph[:, :] = tmp[0].T
-
-def get_v(cube, rgal, vgal):
+def get_v(cube, rgal, vgal, geom=None, rsun=rsun_mw, vsun=vsun_mw):
     """
     Function to compute and add the reflex motion to the velocities of the stars from the hypercube parameters
 
     :param cube: Multinest hypercube (1xNparam)
     :param rgal: galactic cartesian coordinates
     :param vgal: galactic cartesian velocities
+    :param geom: precomputed ReflexGeometry of rgal, computed here if not given
+    :param rsun: position of the sun in the galactocentric frame (kpc), if geom is not given
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1), if geom is not given
 
     :return: vlos, mul, mub, the line-of-sight velocity, proper motion in l and b with reflex motion and bulk motion added
     """
-    # 3. rotate cartesian coordinates such that the z axis points at lapex, bapex
-    # through the euler angle rotation x-y-z
+    if geom is None:
+        geom = ReflexGeometry(rgal, rsun, vsun)
+
+    # the apex is at the z axis of the frame rotated through the euler angle rotation x-y-z,
+    # the reflex motion is -vtravel along it and the bulk motion is along the spherical unit vectors
     bapex = np.arccos(cube[1])
-    Rrot = euler_xyz(cube[0], bapex, deg=False)
-    rp = np.zeros_like(rgal)
-    vp = np.zeros_like(vgal)
-
-    rp = np.dot(Rrot, rgal.T).T
-
-    # 4. compute the spherical coordinates of r,v in rotated frame
-
-    rpsph = np.zeros_like(rp)
-    vpsph = np.zeros_like(vp)
-
-    tmp = cartesian_to_spherical(rp[:, 0], rp[:, 1], rp[:, 2],
-                                 vp[:, 0], vp[:, 1], vp[:, 2])
-    rpsph[:, :] = tmp[0].T
-    # 4i. add vtravel in the rotated frame
-    vpsph[:, :] = add_vtravel(cube[2], rpsph[:, 2]).T 
-
-    # 5. translate the spherical coordinates in the rotated frame back to cartesian coordinates
-    # note: we don't care about the position vector anymore, we only want the velocities
-    rp1 = np.zeros_like(rp)
-    vp1 = np.zeros_like(rp)
-
-    temp = spherical_to_cartesian(rpsph[:, 0], rpsph[:, 1], rpsph[:, 2],
-                                  vpsph[:, 0], vpsph[:, 1], vpsph[:, 2])
-    rp1[:, :] = temp[0].T
-    vp1[:, :] = temp[1].T
-    # 6. now rotate the coordinates back to the galactic frame
-    rgal1 = np.zeros_like(rgal)
-    vgal1 = np.zeros_like(rgal)
-
-
-    rgal1[:, :] = np.dot(np.linalg.inv(Rrot), rp1[:, :].T).T
-    vgal1[:, :] = np.dot(np.linalg.inv(Rrot), vp1[:, :].T).T
-
-    # 7. compute the vector v and translate to be at the sun
-    r = np.zeros_like(rp)
-    v = np.zeros_like(vp)
-
-    # 7i. convert bulk velocities to cartesian velocities
-    tmp = spherical_to_cartesian(rgalsph[:, 0], rgalsph[:, 1],
-                                 rgalsph[:, 2], cube[3], cube[4], cube[5])
-    r[:, :] = rgal1[:, :] - rsun_mw
-    # 7ii. sum the velocities from the bulk motion(tmp[1]) and reflex motion(vgal1) and correct for solar motion
-    v[:, :] = vgal1[:, :] + tmp[1].T - vsun_mw
-
-    # 8. find the galactic proper motions using the unit vectors of ul, ub, ulos
-    # spherical unit vectors in the galactic frame..
-    rsunsph = np.zeros_like(r)
-    vsunsph = np.zeros_like(v)
-    temp = cartesian_to_spherical(r[:, 0], r[:, 1], r[:, 2],
-                                  v[:, 0], v[:, 1], v[:, 2])
-    rsunsph[:, :] = temp[0].T
-    vsunsph[:, :] = temp[1].T
-    # now multiply the vector v by the unit vectors in spherical coordinates centred at
-    # the positions of the sun
-
-    elos, ephi, eth = spherical_unit_vectors(rsunsph[:, 1], rsunsph[:, 2])
-    elos, ephi, eth = elos.T, ephi.T, eth.T
-
-    # helicocentric distance
-    dist = np.linalg.norm(rsunsph, axis=1)
-    fac = 4.74057 * dist
-    # 9. compute the observables
-    vlos = np.einsum('ij,ij->i', v, elos)
-    mul = np.einsum('ij,ij->i', v, ephi) / fac
-    mub = -np.einsum('ij,ij->i', v, eth) / fac
+    p = reflex_vector(cube[0], bapex, cube[2], cube[3], cube[4], cube[5])
+
+    # observables from the projection onto the spherical unit vectors centred at the sun,
+    # corrected for the solar motion
+    vlos, mul, mub = geom.observables(p)
     return vlos, mul, mub
 
 
@@ -181,43 +104,20 @@ def like_pms(cube, pml_data, pmb_data, dist, corr, epml, epmb, edist, pml_param,
     elp2 = epml ** 2. + edist ** 2. * (np.abs(pml_data) ** 2. / dist ** 2.) + (sigpml / fac ** 2.)
     ebp2 = epmb ** 2. + edist ** 2. * (np.abs(pmb_data) ** 2. / dist ** 2.) + (sigpmb / fac ** 2.)
 
-    cov = np.array([[elp2, epml * epmb * corr],
-                    [epml * epmb * corr, ebp2]])
+    # closed form inverse and determinant of the 2x2 covariance matrix,
+    # so that all stars can be evaluated at once
+    covlb = epml * epmb * corr
+    det = elp2 * ebp2 - covlb ** 2.
 
     kl = pml_data - pml_param
     kb = pmb_data - pmb_param
 
-    #matrix version of above
-    X = np.array([kl,kb])
-    det = np.linalg.det(cov)
-    exp = -0.5 * np.dot(X.T,np.dot(np.linalg.inv(cov), X))
-    ln = -0.5 * np.log(((2 * np.pi) ** 2.) * np.linalg.det(cov))
+    exp = -0.5 * (kl ** 2. * ebp2 - 2. * kl * kb * covlb + kb ** 2. * elp2) / det
+    ln = -0.5 * np.log(((2 * np.pi) ** 2.) * det)
     ppm = ln + exp
 
     return ppm
 
-# 10. compute the likelihood function for the data and model..
-def LogLikelihood(cube):
-    """
-    Function to compute the log likelihood of the model given the data
-
-    :param cube: Multinest hypercube (1xNparam)
-
-    :return: lnptot, the total log likelihood
-    """
-
-    lnptot = 0.
-
-    vlos, mul, mub = get_v(cube, rgal, vgal)
-    for i in range(len(x)):
-        a = like_vlos(cube, d[i, 9], vlos[i], d[i, 13]) + \
-            like_pms(cube, d[i, 10], d[i, 11], d[i, 8], d[i,16], d[i, 14], d[i, 15], d[i, 12], mul[i], mub[i])
-        lnptot += a
-        if np.isinf(lnptot):
-            lnptot = 1.e-160
-    return lnptot
-
-
 # define prior
 def Prior(cube):
     """
@@ -260,25 +160,672 @@ def Prior(cube):
     return cube
 
 
-# Running the sampler
+def BatchPrior(cubes):
+    """
+    Function to apply the prior to a set of points of the unit hypercube at once
+
+    :param cubes: points of the unit hypercube (n_points x Nparam)
+
+    :return: parameters of shape (n_points x Nparam), see Prior
+    """
+    # Prior only indexes the parameters along the first axis, so it works on all points at once
+    return Prior(np.array(cubes, dtype=float).T).T
+
+
 parameters = ["l", "b", "vtravel", "vr", "vphi", "vth", "sigvlos",
               "sigmul", "sigmub"]
 
 n_params = len(parameters)
-result = solve(LogLikelihood=LogLikelihood, Prior=Prior,
-               n_dims=n_params, outputfiles_basename=prefix, verbose=True,
-               resume=False, n_live_points=1000, wrapped_params=None,
-               n_iter_before_update=100)
-
-print()
-print('evidence: %(logZ).1f +- %(logZerr).1f' % result)
-print()
-print('parameter values:')
-for name, col in zip(parameters, result['samples'].transpose()):
-    print('%15s : %.3f +- %.3f' % (name, col.mean(), col.std()))
-
-# make marginal plots by running:
-# $ python multinest_marginals.py chains/3-
-# For that, we need to store the parameter names:
-with open('%sparams.json' % prefix, 'w') as f:
-    json.dump(parameters, f, indent=2)
+
+# maximum number of stars x parameter sets evaluated at once by ReflexFit.BatchLogLikelihood
+batch_elements = 2 ** 21
+
+# default number of stars per block of the likelihood, such that the temporaries of a block stay in cache,
+# and default number of threads evaluating the blocks
+likelihood_block = 2 ** 14
+likelihood_threads = 1
+
+
+class ReflexFit:
+    """
+    Class holding the data and precomputed geometry of a single reflex motion fit
+
+    :param data: array of shape (Nstars, 17) with the columns described in the module docstring,
+        a Catalog, or the path to a catalog directory or input file
+    :param layout: if data is a text file, 'cols' if the file has shape (cols,rows), 'rows' if it has
+        shape (rows,cols), or 'auto'
+    :param block_size: number of stars per block of the likelihood, defaults to likelihood_block
+    :param nthreads: number of threads evaluating the blocks, defaults to likelihood_threads
+    :param dtype: dtype of the stored data and geometry, np.float32 for the compact mode
+    :param rsun: position of the sun in the galactocentric frame (kpc), defaults to rsun_mw
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1), defaults to vsun_mw
+
+    :note: the heliocentric observables are fixed by the data, and the galactocentric coordinates are
+        moved from the solar parameters of the catalog (see catalog_solar) to rsun and vsun
+    :note: all per-dataset state lives in the instance, such that several fits can be run in one
+        process and instances can be sent to parallel workers
+    :note: the instance provides the model interface of the samplers in samplers.py
+    :note: the likelihood is summed over blocks of stars, which run on a thread pool if nthreads > 1
+        (NumPy releases the GIL in its array operations), and the partial sums of the blocks are added
+        with math.fsum, such that the total does not depend on the number of threads or the order the
+        blocks finish in
+    :note: in the compact mode (dtype=np.float32) the data, the precomputed terms and the geometry are
+        stored in float32, halving the memory of a fit, and the per-star terms are computed in float32
+        while the sums over stars are accumulated in float64. On the files in processed_real the total
+        log likelihood differs from the float64 one by ~1e-7 relative at prior draws, and by less than
+        1e-4 (scatter between points) around the maximum likelihood, see benchmark.py --precision
+    """
+
+    parameters = parameters
+    n_params = n_params
+    Prior = staticmethod(Prior)
+    BatchPrior = staticmethod(BatchPrior)
+
+    def __init__(self, data, layout='auto', block_size=None, nthreads=None, dtype=np.float64, rsun=None,
+                 vsun=None):
+        if isinstance(data, str):
+            data = load_catalog(data, layout)
+        elif not isinstance(data, Catalog):
+            data = Catalog.from_array(np.asarray(data, dtype=float))
+        self.nstars = data.nstars
+        self.dtype = np.dtype(dtype)
+        self.rsun = np.array(rsun_mw if rsun is None else rsun, dtype=float)
+        self.vsun = np.array(vsun_mw if vsun is None else vsun, dtype=float)
+
+        # 1. galactic cartesian coordinates from the input data, moved to the solar parameters of the fit
+        rsun0, vsun0 = catalog_solar(data)
+        self.rgal = (data.array(['x', 'y', 'z']) + (self.rsun - rsun0)).astype(self.dtype)
+        self.vgal = (data.array(['vx', 'vy', 'vz']) + (self.vsun - vsun0)).astype(self.dtype)
+
+        # 2. precompute the projection of the reflex model onto the observables
+        t = time.perf_counter()
+        self.geom = ReflexGeometry(self.rgal, self.rsun, self.vsun, dtype=self.dtype)
+        self.setup_time = time.perf_counter() - t
+
+        # 3. contiguous copies of the observed quantities used in the likelihood
+        self.dist, self.vlos, self.mul, self.mub = [np.ascontiguousarray(data[name], dtype=self.dtype)
+                                                    for name in ['dist', 'vlos', 'mul', 'mub']]
+        self.edist, self.evlos, self.emul, self.emub, self.corr = [np.ascontiguousarray(data[name], dtype=self.dtype)
+                                                                   for name in ['edist', 'evlos', 'emul', 'emub', 'corr']]
+        self._precompute()
+        self.configure(block_size, nthreads)
+
+    def _precompute(self):
+        """
+        Function to precompute the terms of the likelihood that only depend on the data, in float64
+        before they are stored in the dtype of the fit
+        """
+        dist, mul, mub, edist, evlos, emul, emub, corr = [
+            getattr(self, name).astype(float) for name in ['dist', 'mul', 'mub', 'edist', 'evlos', 'emul', 'emub', 'corr']]
+        covlb = emul * emub * corr
+        for name, x in [('evlos2', evlos ** 2.),
+                        ('el0', emul ** 2. + edist ** 2. * (mul ** 2. / dist ** 2.)),
+                        ('eb0', emub ** 2. + edist ** 2. * (mub ** 2. / dist ** 2.)),
+                        ('ifac2', 1. / (4.74057 * dist) ** 2.),
+                        ('covlb', covlb),
+                        ('covlb2', covlb ** 2.)]:
+            setattr(self, name, x.astype(self.dtype))
+        # moments of the quadratic form of the likelihood, see _moments
+        self._quadratic = None
+
+    def configure(self, block_size=None, nthreads=None):
+        """
+        Function to set the block size and number of threads of the likelihood
+
+        :param block_size: number of stars per block, defaults to likelihood_block
+        :param nthreads: number of threads, defaults to likelihood_threads
+        """
+        self.block_size = likelihood_block if block_size is None else int(block_size)
+        self.nthreads = likelihood_threads if nthreads is None else int(nthreads)
+        self.blocks = [slice(start, start + self.block_size) for start in range(0, self.nstars, self.block_size)]
+        self._pool = None
+        # timer of the stages of the likelihood, set by telemetry.Telemetry.wrap
+        self.clock = None
+
+    def __getstate__(self):
+        # the thread pool, the cached products and the timer are not sent to parallel workers
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_quadratic'] = None
+        state['clock'] = None
+        return state
+
+    def _map_blocks(self, func):
+        """
+        Function to evaluate a function of a slice of stars over the blocks
+
+        :param func: function of a slice of stars
+
+        :return: list of the results of the blocks
+        """
+        if self.nthreads < 2 or len(self.blocks) < 2:
+            return [func(s) for s in self.blocks]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.nthreads)
+        return list(self._pool.map(func, self.blocks))
+
+    def _block_loglike(self, cube, p, s):
+        """
+        Function to compute the summed log likelihood of a block of stars, see like_vlos and like_pms
+
+        :param cube: parameters after the prior (Nparam), or (Nparam, n_points) for n_points parameter sets,
+            in the dtype of the fit
+        :param p: linear model parameters of shape (6,), or (6, n_points), see reflex_vector, in the dtype
+            of the fit
+        :param s: slice of the stars of the block
+
+        :return: log likelihood of the block, or array of n_points log likelihoods, summed in float64
+        """
+        proj, offset = self.geom.proj, self.geom.offset
+        if np.ndim(p) > 1:
+            col = lambda a: a[s, None]
+        else:
+            col = lambda a: a[s]
+        clock = self.clock
+        if clock is not None:
+            clock.start()
+
+        # residuals of the observables from the projection of the model
+        rv = col(self.vlos) - np.dot(proj[0, s], p)
+        rv += col(offset[0])
+        kl = col(self.mul) - np.dot(proj[1, s], p)
+        kl += col(offset[1])
+        kb = col(self.mub) - np.dot(proj[2, s], p)
+        kb += col(offset[2])
+        if clock is not None:
+            clock.lap('projection')
+        return self._block_gaussian(cube[6:9], rv, kl, kb, s)
+
+    def _block_gaussian(self, prec, rv, kl, kb, s):
+        """
+        Function to compute the summed log likelihood of a block of stars from the residuals of their observables
+
+        :param prec: precisions of the velocity dispersions (3,), or (3, n_points), the parameters 6 to 8 of
+            Prior, in the dtype of the fit
+        :param rv: residuals of the line-of-sight velocities from the model, of shape (block,) or
+            (block, n_points), in the dtype of the fit and overwritten
+        :param kl: residuals of mu_l, overwritten
+        :param kb: residuals of mu_b
+        :param s: slice of the stars of the block
+
+        :return: log likelihood of the block, or array of n_points log likelihoods, summed in float64
+        """
+        if np.ndim(rv) > 1:
+            col = lambda a: a[s, None]
+        else:
+            col = lambda a: a[s]
+        clock = self.clock
+
+        # 1. line-of-sight velocity, accumulating -2 ln p in place
+        S = col(self.evlos2) + 1. / prec[0]
+        lnp = rv * rv
+        lnp /= S
+        lnp += np.log(2 * np.pi * S)
+        if clock is not None:
+            clock.lap('like_vlos')
+
+        # 2. proper motions with the closed form inverse and determinant of the 2x2 covariance matrix
+        elp2 = col(self.el0) + col(self.ifac2) / prec[1]
+        ebp2 = col(self.eb0) + col(self.ifac2) / prec[2]
+        det = elp2 * ebp2
+        det -= col(self.covlb2)
+        q = kl * kl
+        q *= ebp2
+        elp2 *= kb * kb
+        q += elp2
+        kl *= kb
+        kl *= 2. * col(self.covlb)
+        q -= kl
+        q /= det
+        lnp += q
+        det *= (2 * np.pi) ** 2.
+        lnp += np.log(det)
+        if clock is not None:
+            clock.lap('like_pms')
+        lnp = -0.5 * np.sum(lnp, axis=0, dtype=np.float64)
+        if clock is not None:
+            clock.lap('sum')
+        return lnp
+
+    def subset(self, mask):
+        """
+        Function to select a subset of the stars, without recomputing their geometry
+
+        :param mask: boolean mask or indices of the stars
+
+        :return: ReflexFit of the subset
+        """
+        fit = ReflexFit.__new__(ReflexFit)
+        for name in ['rgal', 'vgal', 'dist', 'vlos', 'mul', 'mub', 'edist', 'evlos', 'emul', 'emub', 'corr']:
+            setattr(fit, name, np.ascontiguousarray(getattr(self, name)[mask]))
+        fit.geom = self.geom.subset(mask)
+        fit.nstars = len(fit.dist)
+        fit.dtype = self.dtype
+        fit.rsun, fit.vsun = self.rsun, self.vsun
+        fit._precompute()
+        fit.configure(self.block_size, self.nthreads)
+        return fit
+
+    def with_solar(self, rsun=None, vsun=None):
+        """
+        Function to make the fit of the same stars with other solar parameters
+
+        :param rsun: position of the sun in the galactocentric frame (kpc), defaults to that of this fit
+        :param vsun: motion of the sun in the galactocentric frame (kms^-1), defaults to that of this fit
+
+        :return: ReflexFit sharing the observed data with this one
+
+        :note: only a change of rsun recomputes the geometry, a change of vsun only changes its offset
+        """
+        rsun = self.rsun if rsun is None else np.asarray(rsun, dtype=float)
+        vsun = self.vsun if vsun is None else np.asarray(vsun, dtype=float)
+        fit = self.subset(slice(None))
+        fit.rsun, fit.vsun = rsun, vsun
+        fit.rgal = (self.rgal + (rsun - self.rsun)).astype(self.dtype)
+        fit.vgal = (self.vgal + (vsun - self.vsun)).astype(self.dtype)
+        if np.any(rsun != self.rsun):
+            fit.geom = ReflexGeometry(fit.rgal, rsun, vsun, dtype=self.dtype)
+        elif np.any(vsun != self.vsun):
+            fit.geom = self.geom.with_vsun(vsun)
+        return fit
+
+    def LogLikelihood(self, cube):
+        """
+        Function to compute the log likelihood of the model given the data
+
+        :param cube: Multinest hypercube (1xNparam)
+
+        :return: lnptot, the total log likelihood
+        """
+        clock = self.clock
+        if clock is not None:
+            clock.start()
+        p = reflex_vector(cube[0], np.arccos(cube[1]), cube[2], cube[3], cube[4], cube[5]).astype(self.dtype)
+        cube = np.asarray(cube, dtype=self.dtype)
+        if clock is not None:
+            clock.lap('rotation')
+        lnptot = math.fsum(self._map_blocks(lambda s: self._block_loglike(cube, p, s)))
+        if np.isinf(lnptot):
+            lnptot = 1.e-160
+        return lnptot
+
+    def StarLogLikelihood(self, cubes):
+        """
+        Function to compute the log likelihood of each star for a set of parameter vectors
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+
+        :return: array of shape (n_points, Nstars)
+        """
+        cube = np.atleast_2d(cubes).T
+        vlos, mul, mub = get_v(cube, self.rgal, self.vgal, self.geom)
+        return (like_vlos(cube, self.vlos[:, None], vlos, self.evlos[:, None]) +
+                like_pms(cube, self.mul[:, None], self.mub[:, None], self.dist[:, None], self.corr[:, None],
+                         self.emul[:, None], self.emub[:, None], self.edist[:, None], mul, mub)).T
+
+    def BatchLogLikelihood(self, cubes):
+        """
+        Function to compute the log likelihood of a set of parameter vectors at once
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+
+        :return: lnptot, array of n_points total log likelihoods
+        """
+        clock = self.clock
+        if clock is not None:
+            clock.start()
+        cube = np.atleast_2d(cubes).T
+        p = reflex_vector(cube[0], np.arccos(cube[1]), cube[2], cube[3], cube[4], cube[5])
+        if clock is not None:
+            clock.lap('rotation')
+        return self._batch_loglike(cube, p)
+
+    def _batch_loglike(self, cube, p):
+        """
+        Function to compute the total log likelihood of a set of parameter sets in blocks of points
+
+        :param cube: parameters after the prior (Nparam, n_points)
+        :param p: linear model parameters (6, n_points), see reflex_vector
+
+        :return: lnptot, array of n_points total log likelihoods
+        """
+        lnptot = np.empty(cube.shape[1])
+
+        # the observables of a block of stars and points have shape (block_size, n_points), so the
+        # points are evaluated in blocks to bound the memory of the temporaries
+        block = max(1, batch_elements // min(self.nstars, self.block_size))
+        for start in range(0, len(lnptot), block):
+            c = cube[:, start:start + block].astype(self.dtype)
+            q = p[:, start:start + block].astype(self.dtype)
+            partial = np.array(self._map_blocks(lambda s: self._block_loglike(c, q, s)))
+            if self.clock is not None:
+                self.clock.start()
+            lnptot[start:start + block] = [math.fsum(col) for col in partial.T]
+            if self.clock is not None:
+                self.clock.lap('sum')
+        lnptot[np.isinf(lnptot)] = 1.e-160
+        return lnptot
+
+    def SolarSweepLogLikelihood(self, cubes, vsuns):
+        """
+        Function to compute the log likelihood of a set of parameter vectors for a grid of solar motions at once
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+        :param vsuns: solar motions (n_vsun x 3), kms^-1
+
+        :return: array of shape (n_vsun, n_points) of total log likelihoods
+
+        :note: the observables are linear in the solar motion, which only shifts the reflex velocity in
+            p by d (see geometry.solar_shift), and the covariances do not depend on it, so the log
+            likelihood is exactly lnl + d @ g - 0.5 d @ H @ d, see QuadraticLogLikelihood. The terms of
+            each point are computed in one pass over the stars, after which the grid costs O(n_vsun * n_points)
+        """
+        lnl, g, H = self.QuadraticLogLikelihood(cubes, slice(0, 3))
+        d = solar_shift(self.vsun, np.atleast_2d(vsuns))[:3].T
+        lnptot = lnl + np.dot(d, g) - 0.5 * np.einsum('kc,cdn,kd->kn', d, H, d)
+        lnptot[np.isinf(lnptot)] = 1.e-160
+        return lnptot
+
+    def QuadraticLogLikelihood(self, cubes, cols):
+        """
+        Function to compute the log likelihood of a set of parameter vectors and its expansion in three of the
+        linear model parameters
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+        :param cols: slice of the linear model parameters, slice(0, 3) for the reflex velocity or slice(3, 6)
+            for the bulk motion, see reflex_vector
+
+        :return: lnl of shape (n_points,), g of shape (3, n_points) and H of shape (3, 3, n_points), such that
+            the log likelihood with p[cols] shifted by d is exactly lnl + d @ g - 0.5 d @ H @ d
+
+        :note: the observables are linear in p and the covariances do not depend on it, so -2 ln L is a
+            quadratic form c + b @ p + p @ A @ p whose coefficients are sums over the stars of fixed moments of
+            the data and geometry, weighted by the inverse covariances, see _moments. The residuals of the
+            stars are never formed, and a point costs about a quarter of a point of BatchLogLikelihood, see
+            benchmark.py --marginal. The sums are done in float64 for either dtype of the fit
+        """
+        cube = np.atleast_2d(cubes).T
+        p = reflex_vector(cube[0], np.arccos(cube[1]), cube[2], cube[3], cube[4], cube[5])
+        n = cube.shape[1]
+        lnl, g, H = np.empty(n), np.empty((3, n)), np.empty((3, 3, n))
+        moments = self._moments()
+        iu = np.triu_indices(6)
+
+        block = max(1, batch_elements // min(self.nstars, self.block_size))
+        for start in range(0, n, block):
+            q = p[:, start:start + block]
+            v = 1. / cube[6:9, start:start + block]
+            partial = self._map_blocks(lambda s: self._block_moment_terms(v, s, moments))
+            logdet = [math.fsum(col) for col in np.array([x[0] for x in partial]).T]
+            T = np.sum([x[1] for x in partial], axis=0)
+
+            # 1. coefficients of -2 ln L = c + b @ p + p @ A @ p, from the upper triangle of A with the
+            # off-diagonal terms doubled
+            A = np.zeros((6, 6, q.shape[1]))
+            A[iu] = T[7:]
+            A = 0.5 * (A + A.transpose(1, 0, 2))
+            Ap = np.einsum('jkn,kn->jn', A, q)
+            lnl[start:start + block] = -0.5 * (logdet + T[0] + np.sum((T[1:7] + Ap) * q, axis=0))
+
+            # 2. expansion in p[cols]
+            g[:, start:start + block] = -0.5 * T[1:7][cols] - Ap[cols]
+            H[:, :, start:start + block] = A[cols, cols]
+        return lnl, g, H
+
+    def _moments(self):
+        """
+        Function to compute the moments of the data and geometry that the quadratic form of the log likelihood
+        in p is made of, once per fit
+
+        :return: dictionary of arrays in float64: 'ev' the squared errors of vlos (Nstars,), 'X' the terms of
+            the determinant of the proper motion covariance (Nstars, 4), 'M0' the moments of the vlos residual
+            (28, Nstars) and 'Mpm' those of the proper motion residuals (84, Nstars), see _block_moment_terms
+
+        :note: with the residual r_i = d_i - e_i @ p of the observable i of a star, d_i the data plus the
+            offset and e_i the row of proj, the 28 moments of a pair of observables are d_i d_j, the linear
+            terms -(d_i e_j + d_j e_i) and the upper triangle of the symmetrised e_i e_j^T with the
+            off-diagonal terms doubled. The proper motion weights ebp2 / det, elp2 / det and -covlb / det
+            are split into 1 / det times the data terms, and v_mul / det and v_mub / det times ifac2, such
+            that all proper motion moments are weighted by 1 / det
+        :note: the moments take 117 float64 per star, about 0.9 kB, against 0.2 kB of the geometry
+        """
+        if self._quadratic is None:
+            proj = self.geom.proj.astype(float)
+            d = np.array([self.vlos, self.mul, self.mub], dtype=float) + self.geom.offset
+            ev, el0, eb0, ifac2, covlb = [getattr(self, name).astype(float)
+                                          for name in ['evlos2', 'el0', 'eb0', 'ifac2', 'covlb']]
+            iu = np.triu_indices(6)
+            diagonal = np.where(iu[0] == iu[1], 1., 2.)
+
+            def pair(i, j):
+                linear = d[i][:, None] * proj[j] + d[j][:, None] * proj[i]
+                quadratic = proj[i][:, iu[0]] * proj[j][:, iu[1]] + proj[j][:, iu[0]] * proj[i][:, iu[1]]
+                return np.column_stack([d[i] * d[j], -linear, 0.5 * diagonal * quadratic]).T
+
+            M11, M12, M22 = pair(1, 1), pair(1, 2), pair(2, 2)
+            self._quadratic = {
+                'ev': ev,
+                'X': np.column_stack([el0 * eb0 - covlb ** 2., ifac2 * eb0, ifac2 * el0, ifac2 ** 2.]),
+                'M0': np.ascontiguousarray(pair(0, 0)),
+                'Mpm': np.vstack([eb0 * M11 - 2. * covlb * M12 + el0 * M22, ifac2 * M11, ifac2 * M22])}
+        return self._quadratic
+
+    def _block_moment_terms(self, v, s, moments):
+        """
+        Function to compute the sums over a block of stars of the log determinants of the covariances and of the
+        moments weighted by the inverse covariances
+
+        :param v: variances of the velocity dispersions, 1 / the precisions, of shape (3, n_points)
+        :param s: slice of the stars of the block
+        :param moments: see _moments
+
+        :return: the log determinants including the factors 2 pi, of shape (n_points,), and the weighted moments
+            of shape (28, n_points), summed in float64
+        """
+        # 1. variance of vlos, and determinant of the proper motion covariance, which is linear in
+        # 1, v_mul, v_mub and v_mul v_mub
+        S = moments['ev'][s, None] + v[0]
+        det = np.dot(moments['X'][s], np.array([np.ones_like(v[1]), v[1], v[2], v[1] * v[2]]))
+        logdet = S * det
+        logdet = np.sum(np.log(logdet, out=logdet), axis=0)
+        logdet += 3. * np.log(2 * np.pi) * len(S)
+
+        # 2. moments weighted by 1 / S and 1 / det, see _moments
+        T = np.dot(moments['M0'][:, s], np.reciprocal(S, out=S))
+        Tpm = np.dot(moments['Mpm'][:, s], np.reciprocal(det, out=det))
+        T += Tpm[:28]
+        T += v[2] * Tpm[28:56]
+        T += v[1] * Tpm[56:]
+        return logdet, T
+
+    def _block_score(self, prec, rv, kl, kb, s):
+        """
+        Function to compute the log likelihood of a block of stars and its derivatives with respect to the
+        model observables and the precisions, in float64
+
+        :param prec: precisions of the velocity dispersions (3,), the parameters 6 to 8 of Prior
+        :param rv: residuals of the line-of-sight velocities from the model (block,)
+        :param kl: residuals of mu_l
+        :param kb: residuals of mu_b
+        :param s: slice of the stars of the block
+
+        :return: log likelihood of the block, the derivatives with respect to the model vlos, mu_l and mu_b of
+            each star, of shape (3, block), and the derivatives with respect to the three precisions
+        """
+        evlos2, el0, eb0, ifac2, covlb = [getattr(self, name)[s].astype(float)
+                                          for name in ['evlos2', 'el0', 'eb0', 'ifac2', 'covlb']]
+
+        # 1. line-of-sight velocity terms
+        S = evlos2 + 1. / prec[0]
+        lnp_vlos = -0.5 * np.log(2 * np.pi * S) - 0.5 * rv ** 2. / S
+        dS = np.sum(-0.5 / S + 0.5 * rv ** 2. / S ** 2.)
+
+        # 2. proper motion terms, see like_pms
+        elp2 = el0 + ifac2 / prec[1]
+        ebp2 = eb0 + ifac2 / prec[2]
+        det = elp2 * ebp2 - covlb ** 2.
+        Q = (kl ** 2. * ebp2 - 2. * kl * kb * covlb + kb ** 2. * elp2) / det
+        lnp_pms = -0.5 * np.log(((2 * np.pi) ** 2.) * det) - 0.5 * Q
+        dl = -0.5 * (ebp2 + kb ** 2. - Q * ebp2) / det
+        db = -0.5 * (elp2 + kl ** 2. - Q * elp2) / det
+
+        # 3. derivatives with respect to the model observables, and to the precisions through the variances
+        w = np.array([rv / S, (kl * ebp2 - kb * covlb) / det, (kb * elp2 - kl * covlb) / det])
+        dprec = np.array([-dS, -np.sum(dl * ifac2), -np.sum(db * ifac2)]) / prec ** 2.
+        return math.fsum(lnp_vlos + lnp_pms), w, dprec
+
+    def LogLikelihoodGradient(self, cube):
+        """
+        Function to compute the log likelihood and its gradient with respect to the parameters
+
+        :param cube: parameters after the prior (1xNparam)
+
+        :return: lnptot, the total log likelihood, and its gradient of shape (Nparam,)
+
+        :note: the observables are linear in p = reflex_vector(...), so the gradient with respect to
+            p is a projection of the derivatives of the Gaussian terms per star, and the gradient
+            with respect to the apex parameters follows from the jacobian of p
+        """
+        cube = np.asarray(cube, dtype=float)
+        lapex, cosb, vtravel = cube[0], cube[1], cube[2]
+        # the derivative with respect to cos(b_apex) diverges at the poles
+        sinb = max(np.sqrt(1. - cosb ** 2.), 1.e-8)
+        p = reflex_vector(lapex, np.arccos(cosb), vtravel, cube[3], cube[4], cube[5])
+
+        def block(s):
+            # 1. residuals and derivatives per star, projected onto p
+            proj = self.geom.proj[:, s].astype(float)
+            obs = np.array([self.vlos[s], self.mul[s], self.mub[s]], dtype=float)
+            rv, kl, kb = obs - np.dot(proj, p) + self.geom.offset[:, s]
+            lnp, w, dprec = self._block_score(cube[6:9], rv, kl, kb, s)
+            return lnp, np.einsum('kn,knj->j', w, proj), dprec
+
+        lnp, gp, dprec = zip(*self._map_blocks(block))
+
+        # 2. jacobian of p = (-vtravel * apex_vector(lapex, arccos(cosb)), vr, vphi, vth)
+        J = np.zeros((6, 6))
+        J[:3, 0] = -vtravel * np.array([-sinb * np.sin(lapex), sinb * np.cos(lapex), 0.])
+        J[:3, 1] = -vtravel * np.array([-cosb / sinb * np.cos(lapex), -cosb / sinb * np.sin(lapex), 1.])
+        J[:3, 2] = -np.array([sinb * np.cos(lapex), sinb * np.sin(lapex), cosb])
+        J[3:, 3:] = np.eye(3)
+
+        grad = np.zeros(n_params)
+        grad[:6] = np.dot(np.sum(gp, axis=0), J)
+        grad[6:] = np.sum(dprec, axis=0)
+        return math.fsum(lnp), grad
+
+    def fingerprint(self):
+        """
+        Function to compute a hash of the data and solar parameters the likelihood depends on
+
+        :return: hexadecimal sha256 hash
+        """
+        h = hashlib.sha256()
+        for x in [self.rgal, self.vgal, self.dist, self.vlos, self.mul, self.mub, self.edist, self.evlos,
+                  self.emul, self.emub, self.corr, self.rsun, self.vsun]:
+            h.update(np.ascontiguousarray(x, dtype=float).tobytes())
+        return h.hexdigest()
+
+    def run(self, prefix, sampler='multinest', resume=True, **kwargs):
+        """
+        Function to run the sampler
+
+        :param prefix: prefix for the sampler output files
+        :param sampler: name of the sampler backend, one of samplers.backends
+        :param resume: if True, resume from the output files of a previous run with the same data,
+            prior and settings
+        :param kwargs: sampler settings, e.g. n_live_points, verbose, see samplers.py
+
+        :return: FitResult
+        """
+        import samplers
+
+        result = samplers.run(self, prefix, sampler, resume, **kwargs)
+
+        # make marginal plots by running:
+        # $ python multinest_marginals.py chains/3-
+        # For that, we need to store the parameter names:
+        if samplers.mpi_rank() == 0:
+            with open('%sparams.json' % prefix, 'w') as f:
+                json.dump(parameters, f, indent=2)
+
+        return FitResult(result['samples'], result['logZ'], result['logZerr'], prefix)
+
+
+class FitResult:
+    """
+    Class holding the output of a reflex motion fit
+
+    :param samples: equally weighted posterior samples of shape (Nsamples, Nparam)
+    :param logZ: log evidence
+    :param logZerr: error on the log evidence
+    :param prefix: prefix of the sampler output files
+    :param names: parameter names, defaults to the parameters of ReflexFit
+    """
+
+    def __init__(self, samples, logZ, logZerr, prefix=None, names=None):
+        self.samples = samples
+        self.logZ = logZ
+        self.logZerr = logZerr
+        self.prefix = prefix
+        self.names = parameters if names is None else names
+
+    def summary(self):
+        """
+        Function to summarise the posterior samples
+
+        :return: dictionary with the (mean, std) of each parameter
+        """
+        return {name: (col.mean(), col.std()) for name, col in zip(self.names, self.samples.T)}
+
+    def __str__(self):
+        lines = ['evidence: %.1f +- %.1f' % (self.logZ, self.logZerr), '', 'parameter values:']
+        for name, (mean, std) in self.summary().items():
+            lines.append('%15s : %.3f +- %.3f' % (name, mean, std))
+        return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit the reflex motion model to a set of stars.')
+    parser.add_argument('input', help='input file or catalog directory')
+    parser.add_argument('prefix', help='prefix of the sampler output files')
+    parser.add_argument('sampler', nargs='?', default='multinest', choices=['multinest', 'nested', 'map', 'laplace'],
+                        help='sampler backend')
+    parser.add_argument('--layout', default='auto', choices=['auto', 'rows', 'cols'],
+                        help='layout of a text input file, rows if each line is a star, see catalog.text_layout')
+    parser.add_argument('--n-live-points', type=int, default=None, help='number of live points')
+    parser.add_argument('--no-resume', action='store_true', help='start afresh instead of resuming')
+    parser.add_argument('--threads', type=int, default=None, help='number of threads of the likelihood')
+    parser.add_argument('--block-size', type=int, default=None, help='number of stars per block of the likelihood')
+    parser.add_argument('--float32', action='store_true', help='store the data and geometry in float32')
+    parser.add_argument('--rsun', type=float, nargs=3, default=None, help='solar position (kpc), defaults to rsun_mw')
+    parser.add_argument('--vsun', type=float, nargs=3, default=None, help='solar velocity (km/s), defaults to vsun_mw')
+    parser.add_argument('--telemetry', default=None, help='telemetry file (.json or .csv) of the run, see telemetry.py')
+    parser.add_argument('--telemetry-interval', type=float, default=10., help='time between telemetry snapshots (s)')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the likelihood with cProfile, written to the telemetry file + .prof, '
+                             'needs --telemetry')
+    args = parser.parse_args()
+    if args.profile and args.telemetry is None:
+        parser.error('--profile writes the profile next to the telemetry file, give --telemetry PATH')
+
+    settings = dict()
+    if args.n_live_points is not None:
+        settings['n_live_points'] = args.n_live_points
+    if args.telemetry is not None:
+        import cProfile
+        from telemetry import Telemetry
+
+        settings['telemetry'] = Telemetry(args.telemetry, args.telemetry_interval,
+                                          cProfile.Profile() if args.profile else None)
+
+    # catalog directory or input file, text files of shape (cols,rows) or (rows,cols) are told apart
+    # from their number of lines and values per line, set --layout cols or rows if needed
+    fit = ReflexFit(args.input, layout=args.layout, block_size=args.block_size, nthreads=args.threads,
+                    dtype=np.float32 if args.float32 else np.float64, rsun=args.rsun, vsun=args.vsun)
+    result = fit.run(args.prefix, sampler=args.sampler, resume=not args.no_resume, **settings)
+
+    from samplers import mpi_rank
+    if mpi_rank() == 0:
+        print()
+        print(result)
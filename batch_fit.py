@@ -0,0 +1,220 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+from multiprocessing import Pool
+from Reflex_fit_data import ReflexFit
+from read_posterior import get_binned_fit_medians
+"""
+Run the reflex motion fit on a set of input files in parallel, and summarise the results in the
+table format of results/RESULTSsgr.md.
+
+Usage:
+
+python batch_fit.py "processed_real/sgrtests/*.txt" --chains chains/ --out results/batch.md
+
+or with a manifest file, where each line is "/path/to/input.txt chains/prefixdir/" as used with
+Reflex_fit_data.py:
+
+python batch_fit.py --manifest manifest.txt --out results/batch.md
+
+Fits are scheduled over a process pool with one process per core (or --nproc). A fit is skipped if
+its chains already exist and were made from the same input file and sampler settings.
+"""
+
+# file written in each prefix directory to record the input of a finished fit
+batch_info = 'batch.json'
+
+table_header = ('| Cut | Radius Limit | l | b | vtravel | vr | vphi | vtheta | sigmavlos | sigmul | sigmub | Nstars |\n'
+                '|-----|--------------|---|---|---------|----|------|--------|-----------|--------|--------|--------|\n')
+
+
+def read_manifest(manifest):
+    """
+    Function to read a manifest file
+
+    :param manifest: path to a file where each line is "/path/to/input.txt prefix"
+
+    :return: list of (input file, prefix)
+    """
+    jobs = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if len(line) > 0:
+                jobs.append((line[0], line[1]))
+    return jobs
+
+
+def jobs_from_glob(patterns, chains='chains/'):
+    """
+    Function to make the list of fits from glob patterns, with one prefix directory per input file
+
+    :param patterns: list of glob patterns of input files
+    :param chains: directory in which the prefix directories are made
+
+    :return: list of (input file, prefix)
+    """
+    jobs = []
+    for pattern in patterns:
+        for dfname in sorted(glob.glob(pattern)):
+            name = os.path.splitext(os.path.basename(os.path.normpath(dfname)))[0]
+            jobs.append((dfname, os.path.join(chains, name, '')))
+    return jobs
+
+
+def input_hash(dfname, settings):
+    """
+    Function to compute the hash of an input file and the sampler settings
+
+    :param dfname: path to the input file or catalog directory
+    :param settings: dictionary of sampler settings
+
+    :return: hexadecimal sha256 hash
+    """
+    h = hashlib.sha256()
+    if os.path.isdir(dfname):
+        # catalog directory
+        files = [os.path.join(dfname, name) for name in sorted(os.listdir(dfname))]
+    else:
+        files = [dfname]
+    for fname in files:
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def is_done(prefix, hash):
+    """
+    Function to check whether the chains for a prefix exist and match the input hash
+
+    :param prefix: prefix of the pyMultinest output files
+    :param hash: input hash of the fit
+
+    :return: True if the fit can be skipped
+    """
+    if not os.path.exists(prefix + 'post_equal_weights.dat') or not os.path.exists(prefix + batch_info):
+        return False
+    with open(prefix + batch_info) as f:
+        return json.load(f)['hash'] == hash
+
+
+def run_fit(job):
+    """
+    Function to run a single fit, to be called by the process pool
+
+    :param job: (input file, prefix, layout, sampler settings, force)
+
+    :return: (input file, prefix, status), status being 'done', 'skipped' or the error message
+    """
+    dfname, prefix, layout, settings, force = job
+    hash = input_hash(dfname, settings)
+    if not force and is_done(prefix, hash):
+        return dfname, prefix, 'skipped'
+
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    try:
+        fit = ReflexFit(dfname, layout=layout)
+        # resume=False also discards the resume files of a previous run, such that a forced fit starts afresh
+        fit.run(prefix, resume=not force, verbose=False, **settings)
+    except (Exception, SystemExit) as e:
+        # pymultinest calls sys.exit on errors, which would otherwise take down the pool worker
+        return dfname, prefix, 'failed: %r' % e
+
+    with open(prefix + batch_info, 'w') as f:
+        json.dump({'input': dfname, 'hash': hash, 'nstars': fit.nstars, 'settings': settings}, f, indent=2)
+    return dfname, prefix, 'done'
+
+
+def summary_row(dfname, prefix):
+    """
+    Function to make a row of the summary table for a finished fit
+
+    :param dfname: path to the input file
+    :param prefix: prefix of the pyMultinest output files
+
+    :return: row of the table, reporting the medians and the lower-bound uncertainties
+    """
+    M, Eu, Ed = get_binned_fit_medians(prefix)
+    with open(prefix + batch_info) as f:
+        nstars = json.load(f)['nstars']
+
+    name = os.path.splitext(os.path.basename(os.path.normpath(dfname)))[0]
+    radius = re.search(r'_(\d+\+?)$', name)
+    if radius is not None:
+        cut, radius = name[:radius.start()], radius.group(1)
+    else:
+        cut, radius = name, ''
+
+    values = ' | '.join('%.0f ± %.0f' % (m, e) for m, e in zip(M, Ed))
+    return '| %s | %s | %s | %d |\n' % (cut, radius, values, nstars)
+
+
+def run_batch(jobs, nproc=None, layout='auto', force=False, **settings):
+    """
+    Function to run a set of fits over a process pool
+
+    :param jobs: list of (input file, prefix)
+    :param nproc: number of processes, defaults to the number of cores
+    :param layout: layout of text input files, 'rows', 'cols' or 'auto'
+    :param force: if True, rerun fits whose chains already exist, from the start
+    :param settings: sampler settings passed to ReflexFit.run
+
+    :return: list of (input file, prefix, status)
+    """
+    if nproc is None:
+        nproc = os.cpu_count()
+    nproc = max(1, min(nproc, len(jobs)))
+
+    tasks = [(dfname, prefix, layout, settings, force) for dfname, prefix in jobs]
+    status = []
+    with Pool(nproc) as pool:
+        for dfname, prefix, s in pool.imap_unordered(run_fit, tasks):
+            print('%-60s %s' % (dfname, s))
+            status.append((dfname, prefix, s))
+    return status
+
+
+def write_summary(jobs, outfile):
+    """
+    Function to write the summary table of a set of finished fits
+
+    :param jobs: list of (input file, prefix)
+    :param outfile: path to the output markdown file
+    """
+    with open(outfile, 'w') as f:
+        f.write(table_header)
+        for dfname, prefix in jobs:
+            if os.path.exists(prefix + batch_info):
+                f.write(summary_row(dfname, prefix))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the reflex motion fit on a set of input files in parallel.')
+    parser.add_argument('patterns', nargs='*', help='glob patterns of input files')
+    parser.add_argument('--manifest', help='file where each line is "/path/to/input.txt prefix"')
+    parser.add_argument('--chains', default='chains/', help='directory for the prefix directories of globbed files')
+    parser.add_argument('--out', default=None, help='markdown file for the summary table')
+    parser.add_argument('--nproc', type=int, default=None, help='number of processes (default: number of cores)')
+    parser.add_argument('--layout', default='auto', choices=['auto', 'rows', 'cols'],
+                        help='layout of text input files, rows if each line is a star')
+    parser.add_argument('--sampler', default='multinest', choices=['multinest', 'nested', 'laplace'],
+                        help='sampler backend, nested runs without the MultiNest library and laplace is a quick look')
+    parser.add_argument('--n-live-points', type=int, default=1000)
+    parser.add_argument('--force', action='store_true', help='rerun fits whose chains already exist')
+    args = parser.parse_args()
+
+    jobs = jobs_from_glob(args.patterns, args.chains)
+    if args.manifest is not None:
+        jobs += read_manifest(args.manifest)
+
+    settings = dict(sampler=args.sampler)
+    if args.sampler != 'laplace':
+        settings['n_live_points'] = args.n_live_points
+    run_batch(jobs, nproc=args.nproc, layout=args.layout, force=args.force, **settings)
+    if args.out is not None:
+        write_summary(jobs, args.out)
@@ -0,0 +1,560 @@
+import numpy as np
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import coord
+import genreflex
+import read_posterior as rp
+import Reflex_fit_data as rfd
+from catalog import load_catalog
+"""
+Benchmark suite of the reflex model, likelihood and posterior hot paths.
+
+Usage:
+
+python benchmark.py [--sizes 1e3 1e4 1e5 1e6 1e7] [--json results.json] [--compare reference.json]
+
+Each benchmark is run on synthetic catalogs of the given numbers of stars (posterior samples for
+read_posterior and shift_samples) and on the input files in processed_real. For each it reports the
+throughput (calls/s and stars/s), the peak memory allocated during a call and this peak in units of
+float64 arrays of the catalog size (peak_n_arrays). The latter stands in for a count of the N-sized
+temporaries: tracemalloc only traces the blocks alive at a given time, so the temporaries freed during
+a call cannot be counted, and peak_n_arrays is the number of N-sized arrays that would make up the peak.
+
+Results are stored as JSON with the git commit, such that a run can be compared with a reference run
+of another commit with --compare. The catalogs of 1e7 stars need ~5 GB of memory, so they are only part of
+the default sizes when more than large_size_memory is available (as reported by os.sysconf, so never on
+macOS or Windows), and are otherwise run with --sizes.
+
+With --precision, the log likelihood of the float32 compact mode of ReflexFit is compared with the
+float64 one on the files in processed_real (or --files), at prior draws and around the maximum.
+
+With --distance, the log likelihood of ReflexFit, whose distance errors are propagated to first order,
+and of distance.DistanceMarginalFit with a few Gauss-Hermite nodes are compared with the latter with many
+nodes around the maximum, with their costs relative to ReflexFit.
+
+With --marginal, the fit with the bulk motion marginalised (marginal.py) is compared with the fit of all nine
+parameters on a mock catalog (or --files): the cost of a point, and the points, wall-clock time and evidence
+of a run of the nested backend.
+"""
+
+default_sizes = [1000, 10000, 100000, 1000000]
+
+# catalog size added to the default sizes when the memory it needs is available (bytes)
+large_size, large_size_memory = 10000000, 6 * 2 ** 30
+
+
+def make_synthetic_data(nstars, rmin=20., rmax=100., seed=42):
+    """
+    Function to make a synthetic catalog with the 17 column format of the input files
+
+    :param nstars: number of stars
+    :param rmin: minimum galactocentric radius (kpc)
+    :param rmax: maximum galactocentric radius (kpc)
+    :param seed: random seed
+
+    :return: d, array of shape (nstars, 17)
+    """
+    rng = np.random.default_rng(seed)
+    d = np.zeros((nstars, 17))
+
+    # isotropic positions in a shell, with isotropic velocities
+    r = rng.uniform(rmin, rmax, nstars)
+    cost = rng.uniform(-1., 1., nstars)
+    phi = rng.uniform(-np.pi, np.pi, nstars)
+    sint = np.sqrt(1. - cost ** 2.)
+    d[:, 0] = r * sint * np.cos(phi)
+    d[:, 1] = r * sint * np.sin(phi)
+    d[:, 2] = r * cost
+    d[:, 3:6] = rng.normal(0., 100., (nstars, 3))
+
+    # heliocentric observables
+    rsph = cartesian_to_spherical_helio(d[:, :3])
+    d[:, 6] = np.rad2deg(rsph[1])
+    d[:, 7] = 90. - np.rad2deg(rsph[2])
+    d[:, 8] = rsph[0]
+    d[:, 9] = rng.normal(0., 100., nstars)
+    d[:, 10] = rng.normal(0., 0.5, nstars)
+    d[:, 11] = rng.normal(0., 0.5, nstars)
+
+    # errors and correlation
+    d[:, 12] = 0.1 * d[:, 8]
+    d[:, 13] = rng.uniform(1., 10., nstars)
+    d[:, 14] = rng.uniform(0.01, 0.1, nstars)
+    d[:, 15] = rng.uniform(0.01, 0.1, nstars)
+    d[:, 16] = rng.uniform(-0.3, 0.3, nstars)
+    return d
+
+
+def cartesian_to_spherical_helio(rgal):
+    """
+    Function to compute the heliocentric distance and angles of galactocentric positions
+
+    :param rgal: galactic cartesian coordinates (Nx3)
+
+    :return: array of shape 3xN with distance, phi, theta
+    """
+    r = rgal - rfd.rsun_mw
+    dist = np.linalg.norm(r, axis=1)
+    return np.array([dist, np.arctan2(r[:, 1], r[:, 0]), np.arccos(r[:, 2] / dist)])
+
+
+def make_synthetic_chain(nsamples, seed=42):
+    """
+    Function to make synthetic equally weighted posterior samples in the pyMultinest output format
+
+    :param nsamples: number of samples
+    :param seed: random seed
+
+    :return: array of shape (nsamples, 10)
+    """
+    rng = np.random.default_rng(seed)
+    I = np.zeros((nsamples, 10))
+    I[:, 0] = np.mod(rng.normal(2.5, 0.5, nsamples) + np.pi, 2. * np.pi) - np.pi
+    I[:, 1] = np.clip(rng.normal(-0.5, 0.2, nsamples), -1., 1.)
+    I[:, 2] = np.abs(rng.normal(30., 5., nsamples))
+    I[:, 3:6] = rng.normal(0., 5., (nsamples, 3))
+    I[:, 6:9] = 1. / rng.normal(90., 3., (nsamples, 3)) ** 2.
+    I[:, 9] = rng.normal(-1.e4, 3., nsamples)
+    return I
+
+
+def time_call(func, min_time=0.5):
+    """
+    Function to measure the number of calls per second of a function
+
+    :param func: function without arguments
+    :param min_time: minimum time to spend calling the function (s)
+
+    :return: calls per second
+    """
+    func()
+    n = 0
+    t0 = time.perf_counter()
+    while True:
+        func()
+        n += 1
+        t = time.perf_counter() - t0
+        if t > min_time:
+            return n / t
+
+
+def memory_call(func):
+    """
+    Function to measure the peak memory allocated during a call of a function
+
+    :param func: function without arguments
+
+    :return: peak memory (bytes) above the memory allocated before the call
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - before
+
+
+def available_memory():
+    """
+    Function to find the physical memory available to the benchmarks
+
+    :return: available memory (bytes), or None if os.sysconf does not report it
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def suite_sizes():
+    """
+    Function to make the default numbers of stars of the synthetic datasets
+
+    :return: default_sizes, with large_size if more than large_size_memory is available
+    """
+    memory = available_memory()
+    if memory is not None and memory > large_size_memory:
+        return default_sizes + [large_size]
+    return list(default_sizes)
+
+
+def star_benchmarks(d):
+    """
+    Function to make the benchmarks that run on a catalog
+
+    :param d: catalog array of shape (Nstars, 17)
+
+    :return: dictionary of benchmark name and function without arguments
+    """
+    fit = rfd.ReflexFit(d)
+    threaded = rfd.ReflexFit(d, nthreads=os.cpu_count())
+    compact = rfd.ReflexFit(d, dtype=np.float32)
+    cube = rfd.Prior(np.random.default_rng(1).random(rfd.n_params))
+    x, y, z = fit.rgal.T
+    vx, vy, vz = fit.vgal.T
+    rsph = coord.cartesian_to_spherical(x, y, z, vx, vy, vz)
+    sph, vsph = coord.cartesian_to_spherical_nx3(fit.rgal, fit.vgal)
+    out, vout = np.empty_like(sph), np.empty_like(vsph)
+    vlos, mul, mub = rfd.get_v(cube, fit.rgal, fit.vgal, fit.geom)
+    gcube = [cube[0], np.arccos(cube[1]), cube[2], cube[3], cube[4], cube[5]]
+    # 3x3x3 grid of solar motions around the default
+    vsuns = rfd.vsun_mw + np.stack(np.meshgrid(*[[-5., 0., 5.]] * 3), axis=-1).reshape(-1, 3)
+
+    return {
+        'coord.cartesian_to_spherical': lambda: coord.cartesian_to_spherical(x, y, z, vx, vy, vz),
+        'coord.spherical_to_cartesian': lambda: coord.spherical_to_cartesian(*rsph[0], *rsph[1]),
+        'coord.cartesian_to_spherical_nx3': lambda: coord.cartesian_to_spherical_nx3(fit.rgal, fit.vgal, out, vout),
+        'coord.spherical_to_cartesian_nx3': lambda: coord.spherical_to_cartesian_nx3(sph, vsph, out, vout),
+        'geometry.ReflexGeometry': lambda: rfd.ReflexGeometry(fit.rgal, rfd.rsun_mw, rfd.vsun_mw),
+        'Reflex_fit_data.get_v': lambda: rfd.get_v(cube, fit.rgal, fit.vgal, fit.geom),
+        'Reflex_fit_data.like_pms': lambda: rfd.like_pms(cube, fit.mul, fit.mub, fit.dist, fit.corr, fit.emul,
+                                                         fit.emub, fit.edist, mul, mub),
+        'Reflex_fit_data.LogLikelihood': lambda: fit.LogLikelihood(cube),
+        'Reflex_fit_data.LogLikelihood[threads]': lambda: threaded.LogLikelihood(cube),
+        'Reflex_fit_data.LogLikelihood[float32]': lambda: compact.LogLikelihood(cube),
+        'Reflex_fit_data.SolarSweepLogLikelihood': lambda: fit.SolarSweepLogLikelihood(cube, vsuns),
+        'genreflex.get_v': lambda: genreflex.get_v(gcube, fit.rgal, fit.vgal, solar=True),
+    }
+
+
+def chain_benchmarks(nsamples, tmpdir):
+    """
+    Function to make the benchmarks that run on posterior samples
+
+    :param nsamples: number of samples
+    :param tmpdir: directory for the synthetic chain
+
+    :return: dictionary of benchmark name and function without arguments
+    """
+    prefix = os.path.join(tmpdir, 'chain%d-' % nsamples)
+    np.savetxt(rp.chain_file(prefix), make_synthetic_chain(nsamples))
+    P = rp.read_posterior(prefix)
+    l, v = np.deg2rad(P['l']), P['vtravel']
+
+    return {
+        'read_posterior.read_posterior': lambda: rp.read_posterior(prefix),
+        'read_posterior.load_chain(cache=False)': lambda: rp.load_chain(prefix, cache=False),
+        'read_posterior.shift_samples': lambda: rp.shift_samples(v, l),
+    }
+
+
+def run_benchmarks(benchmarks, nstars, source, min_time=0.5, only=None):
+    """
+    Function to run a set of benchmarks
+
+    :param benchmarks: dictionary of benchmark name and function without arguments
+    :param nstars: number of stars (or samples) of the benchmarks
+    :param source: name of the dataset
+    :param min_time: minimum time to spend on each benchmark (s)
+    :param only: if given, list of substrings of the names of the benchmarks to run
+
+    :return: list of result dictionaries
+    """
+    results = []
+    for name, func in benchmarks.items():
+        if only is not None and not any(o in name for o in only):
+            continue
+        calls = time_call(func, min_time)
+        peak = memory_call(func)
+        result = {'name': name, 'source': source, 'nstars': nstars, 'calls_per_s': calls,
+                  'stars_per_s': calls * nstars, 'peak_bytes': peak, 'peak_n_arrays': peak / (8. * nstars)}
+        print('%-40s %-30s %10d %12.1f %12.3g %10.1f %8.1f' % (name, source, nstars, calls, calls * nstars,
+                                                               peak / 2. ** 20, peak / (8. * nstars)))
+        results.append(result)
+    return results
+
+
+def run_suite(sizes=None, files=None, min_time=0.5, only=None):
+    """
+    Function to run the benchmark suite
+
+    :param sizes: numbers of stars (and posterior samples) of the synthetic datasets, defaults to suite_sizes()
+    :param files: input files (or catalog directories) to run the star benchmarks on, defaults to
+        the files in processed_real
+    :param min_time: minimum time to spend on each benchmark (s)
+    :param only: if given, list of substrings of the names of the benchmarks to run
+
+    :return: list of result dictionaries
+    """
+    if sizes is None:
+        sizes = suite_sizes()
+    if files is None:
+        files = sorted(glob.glob('processed_real/**/*.txt', recursive=True))
+        files = [f for f in files if not f.endswith('_bin_edges.txt')]
+
+    print('%-40s %-30s %10s %12s %12s %10s %8s' % ('benchmark', 'source', 'nstars', 'calls/s', 'stars/s',
+                                                  'peak MB', 'N-arrays'))
+    results = []
+    # single rotation matrix, independent of the number of stars
+    results += run_benchmarks({'coord.euler_xyz': lambda: coord.euler_xyz(0.5, 1.2)}, 1, 'scalar', min_time, only)
+
+    for n in sizes:
+        results += run_benchmarks(star_benchmarks(make_synthetic_data(n)), n, 'synthetic', min_time, only)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n in sizes:
+            results += run_benchmarks(chain_benchmarks(n, tmpdir), n, 'synthetic chain', min_time, only)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for f in files:
+        cat = load_catalog(f)
+        results += run_benchmarks(star_benchmarks(cat.array(cat.names[:17])), cat.nstars,
+                                  os.path.basename(os.path.normpath(f)), min_time, only)
+    return results
+
+
+def precision_check(files=None, npoints=200, seed=0):
+    """
+    Function to compare the log likelihood of the float32 compact mode of ReflexFit with the float64 one
+
+    :param files: input files (or catalog directories), defaults to those in processed_real, files whose
+        float64 log likelihood is not finite (e.g. with the correlation in another column) are skipped
+    :param npoints: number of parameter sets drawn from the prior and around the maximum likelihood
+    :param seed: random seed
+
+    :return: list of result dictionaries
+
+    :note: what matters for the posterior is the scatter of the difference between points near the
+        maximum, a constant offset only shifts the evidence
+    """
+    import samplers
+
+    if files is None:
+        files = sorted(glob.glob('processed_real/**/*.txt', recursive=True))
+        files = [f for f in files if not f.endswith('_bin_edges.txt')]
+
+    print('%-45s %7s %12s %10s %12s %12s %12s' % ('file', 'nstars', 'prior |d|', 'prior rel', 'max lnL',
+                                                  'near mean d', 'near std d'))
+    results = []
+    for f in files:
+        fit64, fit32 = rfd.ReflexFit(f), rfd.ReflexFit(f, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        # 1. points drawn from the prior
+        cubes = rfd.BatchPrior(rng.random((npoints, rfd.n_params)))
+        with np.errstate(invalid='ignore'):
+            l64 = fit64.BatchLogLikelihood(cubes)
+        if not np.all(np.isfinite(l64)):
+            continue
+        d = fit32.BatchLogLikelihood(cubes) - l64
+
+        # 2. points around the maximum likelihood
+        u, lmax, ncall = samplers.find_map(fit64, fit64.BatchLogLikelihood, rng, n_starts=2, verbose=False)
+        near = rfd.BatchPrior(np.clip(u + 1.e-3 * rng.normal(size=(npoints, rfd.n_params)), 0., 1.))
+        dnear = fit32.BatchLogLikelihood(near) - fit64.BatchLogLikelihood(near)
+
+        r = {'file': f, 'nstars': fit64.nstars, 'prior_abs': float(np.max(np.abs(d))),
+             'prior_rel': float(np.max(np.abs(d / l64))), 'max_loglike': float(lmax),
+             'near_mean': float(np.mean(dnear)), 'near_std': float(np.std(dnear))}
+        print('%-45s %7d %12.2e %10.1e %12.1f %12.1e %12.1e' % (
+            os.path.relpath(f, 'processed_real'), r['nstars'], r['prior_abs'], r['prior_rel'], r['max_loglike'],
+            r['near_mean'], r['near_std']))
+        results.append(r)
+    return results
+
+
+def distance_check(files=None, nodes=(3, 5, 7, 11), ref_nodes=21, npoints=200, seed=0, min_time=0.5):
+    """
+    Function to compare the first order distance errors of ReflexFit with the Gauss-Hermite marginalisation
+
+    :param files: input files (or catalog directories), defaults to those in processed_real, files whose
+        log likelihood is not finite are skipped
+    :param nodes: numbers of nodes of the compared DistanceMarginalFit
+    :param ref_nodes: number of nodes of the reference DistanceMarginalFit
+    :param npoints: number of parameter sets around the maximum likelihood of ReflexFit
+    :param seed: random seed
+    :param min_time: minimum time per timing (s)
+
+    :return: list of result dictionaries
+
+    :note: as in precision_check, what matters for the posterior is the scatter of the difference between
+        points near the maximum
+    """
+    import samplers
+    from distance import DistanceMarginalFit
+
+    if files is None:
+        files = sorted(glob.glob('processed_real/**/*.txt', recursive=True))
+        files = [f for f in files if not f.endswith('_bin_edges.txt')]
+
+    print('%-45s %7s %8s %6s %12s %12s %8s' % ('file', 'nstars', 'edist/d', 'nodes', 'near mean d', 'near std d',
+                                               'cost'))
+    results = []
+    for f in files:
+        fit = rfd.ReflexFit(f)
+        rng = np.random.default_rng(seed)
+        with np.errstate(invalid='ignore'):
+            if not np.all(np.isfinite(fit.BatchLogLikelihood(rfd.BatchPrior(rng.random((4, rfd.n_params)))))):
+                continue
+
+        # 1. points around the maximum likelihood, and the reference marginalised likelihood there
+        u, lmax, ncall = samplers.find_map(fit, fit.BatchLogLikelihood, rng, n_starts=2, verbose=False)
+        near = rfd.BatchPrior(np.clip(u + 1.e-3 * rng.normal(size=(npoints, rfd.n_params)), 0., 1.))
+        lref = DistanceMarginalFit(fit, ref_nodes).BatchLogLikelihood(near)
+        rate = time_call(lambda: fit.BatchLogLikelihood(near), min_time)
+
+        # 2. the first order approximation (nodes 0) and the marginalisation with few nodes
+        r = {'file': f, 'nstars': fit.nstars, 'edist_median': float(np.median(fit.edist / fit.dist)),
+             'ref_nodes': ref_nodes, 'nodes': []}
+        for k, model in [(0, fit)] + [(k, DistanceMarginalFit(fit, k)) for k in nodes]:
+            d = model.BatchLogLikelihood(near) - lref
+            cost = rate / time_call(lambda: model.BatchLogLikelihood(near), min_time) if k else 1.
+            r['nodes'].append({'nodes': k, 'near_mean': float(np.mean(d)), 'near_std': float(np.std(d)),
+                               'cost': cost})
+            print('%-45s %7d %8.3f %6s %12.2e %12.2e %8.2f' % (
+                os.path.relpath(f, 'processed_real'), r['nstars'], r['edist_median'], k or 'approx',
+                np.mean(d), np.std(d), cost))
+        results.append(r)
+    return results
+
+
+def marginal_check(files=None, nstars=10000, n_live_points=400, seed=0, min_time=0.5):
+    """
+    Function to compare the fit of all nine parameters with the fit with the bulk motion marginalised, see
+    marginal.py, in cost per point and in wall-clock time of a run of the nested backend
+
+    :param files: input files (or catalog directories), defaults to a mock catalog, see mock.py
+    :param nstars: number of stars of the mock catalog
+    :param n_live_points: number of live points of the nested backend
+    :param seed: random seed of the mock and of the sampler
+    :param min_time: minimum time per timing (s)
+
+    :return: list of result dictionaries
+    """
+    import samplers
+    from marginal import MarginalReflexFit
+    from mock import mock_array
+
+    print('%-30s %7s %6s %10s %12s %10s %10s %10s' % ('source', 'nstars', 'dim', 'point cost', 'points', 'time (s)',
+                                                      'logZ', 'speedup'))
+    results = []
+    for f in files or ['mock']:
+        fit = rfd.ReflexFit(mock_array(nstars, seed=seed) if f == 'mock' else f)
+        models = [('full', fit), ('marginal', MarginalReflexFit(fit))]
+
+        # 1. cost of a point relative to ReflexFit, in batches of the size the nested backend evaluates
+        u = np.random.default_rng(seed).random((max(1, n_live_points // 10), rfd.n_params))
+        full = fit.BatchPrior(u)
+        rate = time_call(lambda: fit.BatchLogLikelihood(full), min_time)
+
+        r = {'source': f, 'nstars': fit.nstars, 'n_live_points': n_live_points}
+        for name, model in models:
+            cubes = model.BatchPrior(u[:, :model.n_params])
+            cost = rate / time_call(lambda: model.BatchLogLikelihood(cubes), min_time)
+
+            # 2. a run of the nested backend, counting the points
+            ncall = [0]
+
+            def counted(cubes, loglike=model.BatchLogLikelihood):
+                ncall[0] += len(cubes)
+                return loglike(cubes)
+
+            model.BatchLogLikelihood = counted
+            with tempfile.TemporaryDirectory() as tmp:
+                t0 = time.perf_counter()
+                result = samplers.run(model, os.path.join(tmp, name + '-'), 'nested', resume=False,
+                                      n_live_points=n_live_points, seed=seed, verbose=False)
+                elapsed = time.perf_counter() - t0
+            del model.BatchLogLikelihood
+            r[name] = {'point_cost': cost, 'points': ncall[0], 'time': elapsed, 'logZ': float(result['logZ']),
+                       'logZerr': float(result['logZerr'])}
+        r['speedup'] = r['full']['time'] / r['marginal']['time']
+        for name, model in models:
+            x = r[name]
+            print('%-30s %7d %6d %10.2f %12d %10.1f %10.2f %10s' % (
+                os.path.basename(f), fit.nstars, model.n_params, x['point_cost'], x['points'], x['time'], x['logZ'],
+                '%.2f' % r['speedup'] if name == 'marginal' else ''))
+        results.append(r)
+    return results
+
+
+def git_commit():
+    """
+    Function to find the current git commit
+
+    :return: commit hash, or None outside a git repository
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, reference):
+    """
+    Function to print the change of throughput and peak memory with respect to a reference run
+
+    :param results: list of result dictionaries
+    :param reference: list of result dictionaries of the reference run
+    """
+    ref = {(r['name'], r['source'], r['nstars']): r for r in reference}
+    print()
+    print('%-40s %-30s %10s %12s %12s' % ('benchmark', 'source', 'nstars', 'speedup', 'memory ratio'))
+    for r in results:
+        key = (r['name'], r['source'], r['nstars'])
+        if key in ref:
+            print('%-40s %-30s %10d %12.2f %12.2f' % (key + (r['calls_per_s'] / ref[key]['calls_per_s'],
+                                                          r['peak_bytes'] / max(ref[key]['peak_bytes'], 1))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the reflex model and likelihood hot paths.')
+    parser.add_argument('--sizes', nargs='+', type=float, default=None,
+                        help='numbers of stars of the synthetic catalogs, defaults to 1e3 to 1e6 and 1e7 if the '
+                             'memory allows')
+    parser.add_argument('--files', nargs='*', default=None,
+                        help='input files or catalogs, defaults to processed_real/**/*.txt')
+    parser.add_argument('--only', nargs='+', default=None, help='substrings of the benchmark names to run')
+    parser.add_argument('--min-time', type=float, default=0.5, help='minimum time per benchmark (s)')
+    parser.add_argument('--json', default=None, help='file to store the results')
+    parser.add_argument('--compare', default=None, help='results file of a reference run')
+    parser.add_argument('--precision', action='store_true',
+                        help='compare the float32 compact mode of the likelihood with float64 instead')
+    parser.add_argument('--distance', action='store_true',
+                        help='compare the first order distance errors with their Gauss-Hermite marginalisation instead')
+    parser.add_argument('--marginal', action='store_true',
+                        help='compare the fit with the bulk motion marginalised with the full fit instead')
+    args = parser.parse_args()
+
+    if args.marginal:
+        results = marginal_check(args.files or None, min_time=args.min_time)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump({'commit': git_commit(), 'marginal': results}, f, indent=2)
+        raise SystemExit
+    if args.precision:
+        results = precision_check(args.files or None)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump({'commit': git_commit(), 'precision': results}, f, indent=2)
+        raise SystemExit
+    if args.distance:
+        results = distance_check(args.files or None, min_time=args.min_time)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump({'commit': git_commit(), 'distance': results}, f, indent=2)
+        raise SystemExit
+
+    results = run_suite(None if args.sizes is None else [int(n) for n in args.sizes], args.files, args.min_time,
+                        args.only)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'numpy': np.__version__, 'machine': platform.platform(), 'processor': platform.processor(),
+                       'ncores': os.cpu_count(), 'results': results}, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,405 @@
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+from geometry import rsun_mw, vsun_mw
+"""
+Binary, memory-mapped catalog format for the input data of the fitter.
+
+A catalog is a directory (by convention with a .cat suffix) containing a catalog.json header with
+the column names, number of stars and dtype, and one .npy file per column. Columns are opened
+memory-mapped, such that only the columns that are used are read from disk.
+
+The standard columns follow the input file format described in Reflex_fit_data.py:
+x, y, z, vx, vy, vz, l, b, dist, vlos, mul, mub, edist, evlos, emul, emub, corr
+Any further columns of a text file are stored as col17, col18, ...
+The galactocentric columns x..vz are relative to the solar position and motion recorded in the
+header meta by ingest.py, or to rsun_mw and vsun_mw of geometry.py, see catalog_solar.
+
+The text files in processed_real are either column-major (one line per column, as read by
+Reflex_fit_data.py) or row-major (one line per star, as read by calc_my_reflex.ipynb). With
+layout='auto', the layout is found from the known number of columns, see text_layout.
+
+Usage, to convert text files to catalogs next to them:
+
+python catalog.py processed_real/sgrtests/*.txt
+"""
+
+columns = ['x', 'y', 'z', 'vx', 'vy', 'vz', 'l', 'b', 'dist', 'vlos', 'mul', 'mub',
+           'edist', 'evlos', 'emul', 'emub', 'corr']
+
+# columns of the _bin_edges.txt files
+bin_edge_columns = ['r', 'nstars']
+
+header_name = 'catalog.json'
+
+
+def column_names(ncols, names=None):
+    """
+    Function to name the columns of a table
+
+    :param ncols: number of columns
+    :param names: column names, defaults to the standard columns followed by col17, col18, ...
+
+    :return: list of ncols column names
+    """
+    if names is None:
+        names = columns
+    return list(names[:ncols]) + ['col%d' % i for i in range(len(names), ncols)]
+
+
+class Catalog:
+    """
+    Class giving access to the columns of a catalog by name
+
+    :param path: path to the catalog directory
+    :param mmap_mode: memory-map mode of the columns, None to read them into memory
+
+    :note: use Catalog.from_array to wrap an array already in memory
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, header_name)) as f:
+            header = json.load(f)
+        self.names = header['names']
+        self.nstars = header['nstars']
+        self.dtype = np.dtype(header['dtype'])
+        self.meta = header.get('meta')
+        self._columns = dict()
+        self._aliases = dict()
+
+    @classmethod
+    def from_array(cls, data, names=None):
+        """
+        Function to wrap an array of shape (Nstars, Ncols) as a catalog
+
+        :param data: array of shape (Nstars, Ncols)
+        :param names: column names, see column_names
+
+        :return: Catalog
+        """
+        cat = cls.__new__(cls)
+        cat.path = None
+        cat.mmap_mode = None
+        cat.names = column_names(data.shape[1], names)
+        cat.nstars = data.shape[0]
+        cat.dtype = data.dtype
+        cat.meta = None
+        cat._columns = {name: data[:, i] for i, name in enumerate(cat.names)}
+        cat._aliases = dict()
+        return cat
+
+    def alias(self, name, column):
+        """
+        Function to read a column under another name, e.g. a correlation column stored after extra columns
+
+        :param name: name under which the column is read
+        :param column: name of the column in the catalog
+        """
+        if column not in self.names:
+            raise KeyError('no column %s in catalog %s' % (column, self.path))
+        self._aliases[name] = column
+        self._columns.pop(name, None)
+
+    def __getitem__(self, name):
+        name = self._aliases.get(name, name)
+        if name not in self._columns:
+            if name not in self.names:
+                raise KeyError('no column %s in catalog %s' % (name, self.path))
+            self._columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode=self.mmap_mode)
+        return self._columns[name]
+
+    def __contains__(self, name):
+        return name in self.names or name in self._aliases
+
+    def __len__(self):
+        return self.nstars
+
+    def array(self, names=None):
+        """
+        Function to stack columns into an array
+
+        :param names: column names, defaults to all columns
+
+        :return: array of shape (Nstars, len(names))
+        """
+        if names is None:
+            names = self.names
+        return np.column_stack([self[name] for name in names])
+
+
+def catalog_solar(cat):
+    """
+    Function to find the solar position and motion the galactocentric columns of a catalog were made with
+
+    :param cat: Catalog
+
+    :return: rsun (kpc) and vsun (kms^-1), from the header meta if recorded, otherwise rsun_mw and vsun_mw
+    """
+    meta = cat.meta or dict()
+    rsun = np.array(meta.get('rsun', rsun_mw), dtype=float)
+    vsun = np.array(meta.get('vsun', vsun_mw), dtype=float)
+    return rsun, vsun
+
+
+def text_layout(fname, ncols=None):
+    """
+    Function to find whether a text file is column-major or row-major
+
+    :param fname: path to the text file
+    :param ncols: number of columns of the file, not counting extra columns, defaults to the standard columns
+
+    :return: 'cols' if each line is a column, 'rows' if each line is a star
+
+    :note: the layout giving exactly ncols columns is chosen, otherwise the only layout giving at least
+        ncols columns. A file with extra columns and at least as many stars as columns either way is taken
+        to have more stars than columns. A file of ncols stars of ncols columns cannot be told apart, and
+        raises a ValueError like a file without data
+    """
+    if ncols is None:
+        ncols = len(columns)
+    nlines, nvalues = 0, 0
+    with open(fname) as f:
+        for line in f:
+            if line.strip() == '' or line.lstrip().startswith('#'):
+                continue
+            if nlines == 0:
+                nvalues = len(line.split())
+            nlines += 1
+    if nlines == 0:
+        raise ValueError('%s has no data' % fname)
+
+    # number of columns of each layout
+    shape = {'rows': nvalues, 'cols': nlines}
+    exact = [layout for layout in shape if shape[layout] == ncols]
+    possible = [layout for layout in shape if shape[layout] >= ncols]
+    if len(exact) == 2:
+        raise ValueError('%s has %d lines of %d values, set its layout to rows or cols' % (fname, nlines, nvalues))
+    if len(exact) == 1:
+        return exact[0]
+    if len(possible) == 1:
+        return possible[0]
+    if len(possible) == 0:
+        raise ValueError('%s has %d lines of %d values, fewer than the %d columns either way' %
+                         (fname, nlines, nvalues, ncols))
+    return 'cols' if nlines < nvalues else 'rows'
+
+
+def default_names(fname):
+    """
+    Function to choose the column names of a text file from its name
+
+    :param fname: path to the text file
+
+    :return: bin_edge_columns for _bin_edges files, None otherwise
+    """
+    if fname.endswith('_bin_edges.txt'):
+        return bin_edge_columns
+    return None
+
+
+def read_text(fname, layout='auto', names=None):
+    """
+    Function to read a text file into a catalog in memory
+
+    :param fname: path to the text file
+    :param layout: 'rows', 'cols' or 'auto'
+    :param names: column names, see column_names
+
+    :return: Catalog
+    """
+    if names is None:
+        names = default_names(fname)
+    if layout == 'auto':
+        layout = text_layout(fname, None if names is None else len(names))
+    d = np.loadtxt(fname, ndmin=2)
+    if layout == 'cols':
+        d = d.T
+    return Catalog.from_array(d, names)
+
+
+def load_catalog(fname, layout='auto', mmap_mode='r', names=None):
+    """
+    Function to load a catalog from a catalog directory or a text file
+
+    :param fname: path to a catalog directory or a text file
+    :param layout: layout of a text file, 'rows', 'cols' or 'auto'
+    :param mmap_mode: memory-map mode of the columns of a catalog directory
+    :param names: column names of a text file, see column_names
+
+    :return: Catalog
+    """
+    if os.path.isdir(fname):
+        return Catalog(fname, mmap_mode)
+    return read_text(fname, layout, names)
+
+
+def write_header(path, names, nstars, dtype, source=None, meta=None):
+    """
+    Function to write the header of a catalog directory
+
+    :param path: path to the catalog directory
+    :param names: column names
+    :param nstars: number of stars
+    :param dtype: dtype of the columns
+    :param source: file the catalog was made from
+    :param meta: dictionary of further information to store in the header
+    """
+    with open(os.path.join(path, header_name), 'w') as f:
+        json.dump({'names': list(names), 'nstars': int(nstars), 'dtype': np.dtype(dtype).str,
+                   'source': source, 'meta': meta}, f, indent=2)
+
+
+def save_catalog(path, data, names=None, source=None, meta=None):
+    """
+    Function to save an array or catalog as a catalog directory
+
+    :param path: path to the catalog directory
+    :param data: array of shape (Nstars, Ncols) or Catalog
+    :param names: column names of an array, see column_names
+    :param source: file the catalog was made from
+    :param meta: dictionary of further information to store in the header
+    """
+    if not isinstance(data, Catalog):
+        data = Catalog.from_array(np.asarray(data), names)
+    os.makedirs(path, exist_ok=True)
+    for name in data.names:
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(data[name]))
+    write_header(path, data.names, data.nstars, data.dtype, source, meta)
+
+
+class CatalogWriter:
+    """
+    Class writing a catalog directory chunk by chunk when the number of stars is not known in advance
+
+    :param path: path to the catalog directory
+    :param names: column names
+    :param dtype: dtype of the columns
+    :param source: file the catalog was made from
+    :param meta: dictionary of further information to store in the header
+
+    :note: the chunks are appended to raw files, which close() turns into .npy files, such that only
+        one chunk is held in memory
+    """
+
+    def __init__(self, path, names, dtype=np.float64, source=None, meta=None):
+        self.path = path
+        self.names = list(names)
+        self.dtype = np.dtype(dtype)
+        self.source = source
+        self.meta = meta
+        self.nstars = 0
+        os.makedirs(path, exist_ok=True)
+        self._files = {name: open(os.path.join(path, name + '.raw'), 'wb') for name in self.names}
+
+    def append(self, chunk, mask=None):
+        """
+        Function to append a chunk of stars
+
+        :param chunk: dictionary or Catalog of the columns of the chunk
+        :param mask: boolean mask of the stars of the chunk to write, defaults to all
+        """
+        n = None
+        for name in self.names:
+            col = np.asarray(chunk[name], dtype=self.dtype)
+            if mask is not None:
+                col = col[mask]
+            self._files[name].write(np.ascontiguousarray(col).tobytes())
+            n = len(col)
+        self.nstars += n
+
+    def close(self):
+        """
+        Function to turn the raw files into .npy files and write the header
+
+        :return: path to the catalog directory
+        """
+        for name, f in self._files.items():
+            f.close()
+            raw = os.path.join(self.path, name + '.raw')
+            with open(os.path.join(self.path, name + '.npy'), 'wb') as out, open(raw, 'rb') as src:
+                np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                           'fortran_order': False, 'shape': (self.nstars,)})
+                shutil.copyfileobj(src, out)
+            os.remove(raw)
+        write_header(self.path, self.names, self.nstars, self.dtype, self.source, self.meta)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert_text(fname, path=None, layout='auto', names=None, chunk_size=100000, dtype=np.float64):
+    """
+    Function to convert a text file to a catalog directory without reading the whole file into memory
+
+    :param fname: path to the text file
+    :param path: path to the catalog directory, defaults to fname with a .cat suffix
+    :param layout: 'rows', 'cols' or 'auto'
+    :param names: column names, see column_names
+    :param chunk_size: number of stars read at once from a row-major file
+    :param dtype: dtype of the columns
+
+    :return: path to the catalog directory
+    """
+    if path is None:
+        path = os.path.splitext(fname)[0] + '.cat'
+    if names is None:
+        names = default_names(fname)
+    if layout == 'auto':
+        layout = text_layout(fname, None if names is None else len(names))
+    os.makedirs(path, exist_ok=True)
+
+    with open(fname) as f:
+        lines = (line for line in f if line.strip() != '' and not line.lstrip().startswith('#'))
+        if layout == 'cols':
+            # each line is a column, which is written as soon as it is read
+            ncols = 0
+            for line in lines:
+                col = np.array(line.split(), dtype=dtype)
+                nstars = len(col)
+                np.save(os.path.join(path, 'tmp%d.npy' % ncols), col)
+                ncols += 1
+            names = column_names(ncols, names)
+            for i, name in enumerate(names):
+                os.replace(os.path.join(path, 'tmp%d.npy' % i), os.path.join(path, name + '.npy'))
+        else:
+            # count the stars, then fill the memory-mapped columns chunk by chunk
+            nstars = sum(1 for line in lines)
+            f.seek(0)
+            lines = (line for line in f if line.strip() != '' and not line.lstrip().startswith('#'))
+            out = None
+            start = 0
+            while start < nstars:
+                chunk = np.loadtxt(lines, max_rows=min(chunk_size, nstars - start), ndmin=2, dtype=dtype)
+                if out is None:
+                    names = column_names(chunk.shape[1], names)
+                    out = [np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                                     dtype=dtype, shape=(nstars,)) for name in names]
+                for i, col in enumerate(out):
+                    col[start:start + len(chunk)] = chunk[:, i]
+                start += len(chunk)
+            for col in out:
+                col.flush()
+
+    write_header(path, names, nstars, dtype, source=fname)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert text input files to binary catalogs.')
+    parser.add_argument('files', nargs='+', help='text files to convert, written next to them with a .cat suffix')
+    parser.add_argument('--layout', default='auto', choices=['auto', 'rows', 'cols'],
+                        help='rows if each line is a star, cols if each line is a column')
+    parser.add_argument('--float32', action='store_true', help='store the columns in float32')
+    args = parser.parse_args()
+
+    dtype = np.float32 if args.float32 else np.float64
+    for fname in args.files:
+        print(fname, '->', convert_text(fname, layout=args.layout, dtype=dtype))
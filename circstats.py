@@ -0,0 +1,145 @@
+import numpy as np
+"""
+Vectorized circular statistics for the posterior samples of the apex angles.
+
+The apex longitude wraps at +-pi, such that its posterior can straddle the wrap. The statistics here
+first centre the samples on the most populated bin of a histogram over [-pi, pi] (the mode), such that
+the posterior is away from the wrap, and then use the usual linear statistics on the shifted samples.
+All functions take an optional array of sample weights, for the weighted raw chains of MultiNest.
+
+sketch_percentiles computes percentiles from histograms instead of samples, for the streaming
+statistics of correct_reflex.py and ingest.py that do not hold the samples in memory.
+"""
+
+
+def wrap(theta):
+    """
+    Function to wrap angles into [-pi, pi)
+
+    :param theta: angles (rad)
+
+    :return: wrapped angles (rad)
+    """
+    return (theta + np.pi) % (2. * np.pi) - np.pi
+
+
+def weighted_percentile(x, q, weights=None):
+    """
+    Function to compute percentiles of weighted samples, ignoring NaNs
+
+    :param x: samples
+    :param q: percentile or array of percentiles
+    :param weights: sample weights, if None this is np.nanpercentile
+
+    :return: percentiles of x
+    """
+    if weights is None:
+        return np.nanpercentile(x, q)
+    good = ~np.isnan(x)
+    x, weights = x[good], weights[good]
+    order = np.argsort(x)
+    x, weights = x[order], weights[order]
+    # percentile of each sample at the midpoint of its weight
+    cdf = (np.cumsum(weights) - 0.5 * weights) / np.sum(weights)
+    return np.interp(np.asarray(q) / 100., cdf, x)
+
+
+def sketch_percentiles(hist, lo, width, percentiles):
+    """
+    Function to compute percentiles from histograms with linear interpolation within the bins
+
+    :param hist: counts of shape (M, Nhist)
+    :param lo: lower edge of the histograms (M,)
+    :param width: bin width of the histograms (M,)
+    :param percentiles: percentiles to compute
+
+    :return: array of shape (len(percentiles), M)
+    """
+    cum = np.cumsum(hist, axis=1)
+    rows = np.arange(len(hist))
+    out = np.zeros((len(percentiles), len(hist)))
+    for i, q in enumerate(percentiles):
+        target = q / 100. * cum[:, -1]
+        k = np.argmax(cum >= target[:, None], axis=1)
+        below = np.where(k > 0, cum[rows, k - 1], 0)
+        frac = (target - below) / np.maximum(hist[rows, k], 1)
+        out[i] = lo + (k + frac) * width
+    return out
+
+
+def circular_mode(theta, weights=None, bins=36):
+    """
+    Function to find the mode of angles from the most populated bin of a histogram over [-pi, pi]
+
+    :param theta: angles (rad)
+    :param weights: sample weights
+    :param bins: number of histogram bins
+
+    :return: centre of the most populated bin (rad)
+    """
+    good = ~np.isnan(theta)
+    N, edges = np.histogram(theta[good], bins=np.linspace(-np.pi, np.pi, bins + 1),
+                            weights=None if weights is None else weights[good])
+    centres = (edges[:-1] + edges[1:]) / 2.
+    return centres[np.argmax(N)]
+
+
+def circular_mean(theta, weights=None):
+    """
+    Function to compute the circular mean of angles
+
+    :param theta: angles (rad)
+    :param weights: sample weights
+
+    :return: direction of the mean resultant vector (rad)
+    """
+    good = ~np.isnan(theta)
+    w = None if weights is None else weights[good]
+    return np.arctan2(np.average(np.sin(theta[good]), weights=w), np.average(np.cos(theta[good]), weights=w))
+
+
+def shift_angles(theta, centre, r=None):
+    """
+    Function to rotate angles such that the centre is at zero
+
+    :param theta: angles (rad)
+    :param centre: angle moved to zero (rad)
+    :param r: radial coordinate of the samples, the angle is flipped by pi where r < 0 and zero where r = 0
+
+    :return: shifted angles in [-pi, pi] (rad)
+    """
+    if r is None:
+        return wrap(theta - centre)
+    return np.arctan2(r * np.sin(theta - centre), r * np.cos(theta - centre))
+
+
+def circular_median(theta, weights=None, bins=36):
+    """
+    Function to compute the circular median of angles, as the median of the angles centred on the mode
+
+    :param theta: angles (rad)
+    :param weights: sample weights
+    :param bins: number of histogram bins of the mode
+
+    :return: median angle in [-pi, pi) (rad)
+    """
+    centre = circular_mode(theta, weights, bins)
+    return wrap(weighted_percentile(shift_angles(theta, centre), 50., weights) + centre)
+
+
+def circular_percentile_widths(theta, weights=None, r=None, upper=86., lower=14., bins=36):
+    """
+    Function to compute the widths of a wrapped posterior above and below its median
+
+    :param theta: angles (rad)
+    :param weights: sample weights
+    :param r: radial coordinate of the samples, see shift_angles
+    :param upper: upper percentile
+    :param lower: lower percentile
+    :param bins: number of histogram bins of the mode
+
+    :return: widths |p_upper - p_50| and |p_lower - p_50| (rad)
+    """
+    shifted = shift_angles(theta, circular_mode(theta, weights, bins), r)
+    pl, pm, pu = weighted_percentile(shifted, [lower, 50., upper], weights)
+    return np.abs(pu - pm), np.abs(pl - pm)
@@ -1,5 +1,94 @@
 import numpy as np
 
+# number of stars converted at once by the (N, 3) layout kernels, bounding their temporary arrays
+nx3_block = 2 ** 14
+
+def _cartesian_to_spherical(x, y, z, vx, vy, vz, out, vout=None, trig=None):
+    """
+    Function to convert cartesian to spherical coordinates into preallocated buffers
+
+    :param x: x coordinate
+    :param y: y coordinate
+    :param z: z coordinate
+    :param vx: x velocity, not used if vout is None
+    :param vy: y velocity, not used if vout is None
+    :param vz: z velocity, not used if vout is None
+    :param out: buffer indexed by component, out[0], out[1], out[2] receive r, phi, theta
+    :param vout: buffer indexed by component receiving vr, vphi, vtheta, or None
+    :param trig: buffer indexed by component receiving cos phi, sin phi, cos theta, sin theta, or None
+
+    :note: the trigonometric functions of phi and theta are computed from ratios of the coordinates
+        instead of from the angles, with phi = 0 on the z axis as for arctan2(0, 0)
+    """
+    r, phi, th = out[0, ...], out[1, ...], out[2, ...]
+    if trig is None:
+        trig = np.empty((4,) + np.shape(r))
+    cosp, sinp, cost, sint = trig[0, ...], trig[1, ...], trig[2, ...], trig[3, ...]
+
+    # 1. cylindrical radius in sint, radius and angles
+    np.multiply(x, x, out=sint)
+    np.multiply(y, y, out=cosp)
+    sint += cosp
+    np.multiply(z, z, out=cosp)
+    np.add(sint, cosp, out=r)
+    np.sqrt(r, out=r)
+    np.sqrt(sint, out=sint)
+    np.arctan2(y, x, out=phi)
+    np.divide(z, r, out=cost)
+    np.arccos(cost, out=th)
+
+    # 2. cos and sin of phi from the cylindrical radius, then sin theta
+    inside = sint > 0
+    cosp[...] = 1.
+    sinp[...] = 0.
+    np.divide(x, sint, out=cosp, where=inside)
+    np.divide(y, sint, out=sinp, where=inside)
+    np.divide(sint, r, out=sint)
+
+    # 3. velocity components (code part from Mpetersen)
+    if vout is not None:
+        vr, vphi, vth = vout[0, ...], vout[1, ...], vout[2, ...]
+        vxy = cosp * vx
+        vxy += sinp * vy
+        np.multiply(sint, vxy, out=vr)
+        vr += cost * vz
+        np.multiply(cosp, vy, out=vphi)
+        vphi -= sinp * vx
+        np.multiply(cost, vxy, out=vth)
+        vth -= sint * vz
+
+
+def cartesian_to_spherical_nx3(pos, vel=None, out=None, vout=None):
+    """
+    Function to convert cartesian to spherical coordinates in the (N, 3) layout
+
+    :param pos: cartesian coordinates (array of shape Nx3 with x, y, z)
+    :param vel: cartesian velocities (array of shape Nx3 with vx, vy, vz), or None
+    :param out: buffer of shape Nx3 for r, phi, theta, allocated if not given
+    :param vout: buffer of shape Nx3 for vr, vphi, vtheta, allocated if not given and vel is given
+
+    :return: out, and vout if vel is given
+
+    :note: the stars are converted in blocks of nx3_block, such that the temporary arrays do not grow with N
+    """
+    if out is None:
+        out = np.empty(np.shape(pos))
+    if vel is not None and vout is None:
+        vout = np.empty(np.shape(vel))
+    trig = np.empty((4, min(len(pos), nx3_block)))
+    for start in range(0, len(pos), nx3_block):
+        s = slice(start, start + nx3_block)
+        p, t = pos[s], trig[:, :len(pos[s])]
+        if vel is None:
+            _cartesian_to_spherical(p[:, 0], p[:, 1], p[:, 2], 0., 0., 0., out[s].T, trig=t)
+        else:
+            v = vel[s]
+            _cartesian_to_spherical(p[:, 0], p[:, 1], p[:, 2], v[:, 0], v[:, 1], v[:, 2], out[s].T, vout[s].T, t)
+    if vel is None:
+        return out
+    return out, vout
+
+
 def cartesian_to_spherical(x, y, z, vx, vy, vz):
     """
     Function to convert cartesian coordinates to spherical coordinates
@@ -15,22 +104,12 @@ def cartesian_to_spherical(x, y, z, vx, vy, vz):
     r: spherical coordinates (array of shape Nx3 with r, phi, theta)
     v: spherical velocity components(array of shape Nx3 with vr, vphi, vtheta)
 
+    :note: see cartesian_to_spherical_nx3 for the version writing into preallocated buffers
     """
-    phi = np.arctan2(y, x)
-    th = np.arccos(z / np.sqrt(x ** 2 + y ** 2 + z ** 2))
-    r = np.sqrt(x ** 2. + y ** 2. + z ** 2.)
-
-    # Code part from Mpetersen
-    cost = z / r
-    sint = np.sqrt(1. - cost * cost)
-    cosp = np.cos(phi)
-    sinp = np.sin(phi)
-
-    vr = sint * (cosp * vx + sinp * vy) + cost * vz
-    vphi = (-sinp * vx + cosp * vy)
-    vtheta = (cost * (cosp * vx + sinp * vy) - sint * vz)
-
-    return np.array([r, phi, th]), np.array([vr, vphi, vtheta])
+    shape = np.broadcast(x, y, z).shape
+    out, vout = np.empty((3,) + shape), np.empty((3,) + shape)
+    _cartesian_to_spherical(x, y, z, vx, vy, vz, out, vout)
+    return out, vout
 
 
 def euler_xyz(phi, theta, psi=0., deg=False):
@@ -81,6 +160,89 @@ def add_vtravel(vtravel, phi2):
     return np.array([vr, vphi1, vphi2])
 
 
+def _spherical_trig(phi, th, trig=None):
+    """
+    Function to compute cos phi, sin phi, cos theta and sin theta into a buffer
+
+    :param phi: azimuthal angle
+    :param th: polar angle
+    :param trig: buffer indexed by component, allocated if not given
+
+    :return: trig
+    """
+    if trig is None:
+        trig = np.empty((4,) + np.broadcast(phi, th).shape)
+    np.cos(phi, out=trig[0, ...])
+    np.sin(phi, out=trig[1, ...])
+    np.cos(th, out=trig[2, ...])
+    np.sin(th, out=trig[3, ...])
+    return trig
+
+
+def _spherical_unit_vectors(trig, out):
+    """
+    Function to compute the spherical unit vectors from the trigonometric functions of the angles
+
+    :param trig: cos phi, sin phi, cos theta, sin theta, see _spherical_trig
+    :param out: buffer indexed by [vector, component] receiving er, ephi, eth
+    """
+    cosp, sinp, cost, sint = trig[0, ...], trig[1, ...], trig[2, ...], trig[3, ...]
+    np.multiply(sint, cosp, out=out[0, 0, ...])
+    np.multiply(sint, sinp, out=out[0, 1, ...])
+    out[0, 2, ...] = cost
+    np.negative(sinp, out=out[1, 0, ...])
+    out[1, 1, ...] = cosp
+    out[1, 2, ...] = 0.
+    np.multiply(cost, cosp, out=out[2, 0, ...])
+    np.multiply(cost, sinp, out=out[2, 1, ...])
+    np.negative(sint, out=out[2, 2, ...])
+
+
+def spherical_basis(x, y, z, out=None, sph=None):
+    """
+    Function to compute the spherical unit vectors at cartesian positions from ratios of the coordinates
+
+    :param x: x coordinate
+    :param y: y coordinate
+    :param z: z coordinate
+    :param out: buffer of shape (3, 3, N) receiving er, ephi, eth, allocated if not given
+    :param sph: buffer of shape (3, N) receiving r, phi, theta, allocated if not given
+
+    :return: out, sph
+    """
+    shape = np.broadcast(x, y, z).shape
+    if out is None:
+        out = np.empty((3, 3) + shape)
+    if sph is None:
+        sph = np.empty((3,) + shape)
+    trig = np.empty((4,) + shape)
+    _cartesian_to_spherical(x, y, z, 0., 0., 0., sph, trig=trig)
+    _spherical_unit_vectors(trig, out)
+    return out, sph
+
+
+def spherical_basis_nx3(pos, out=None, sph=None):
+    """
+    Function to compute the spherical unit vectors at cartesian positions in the (N, 3) layout
+
+    :param pos: cartesian coordinates (array of shape Nx3 with x, y, z)
+    :param out: buffer of shape Nx3x3, out[:, 0], out[:, 1], out[:, 2] receive er, ephi, eth
+    :param sph: buffer of shape Nx3 receiving r, phi, theta, allocated if not given
+
+    :return: out, sph
+    """
+    n = len(pos)
+    if out is None:
+        out = np.empty((n, 3, 3))
+    if sph is None:
+        sph = np.empty((n, 3))
+    for start in range(0, n, nx3_block):
+        s = slice(start, start + nx3_block)
+        p = pos[s]
+        spherical_basis(p[:, 0], p[:, 1], p[:, 2], out[s].transpose(1, 2, 0), sph[s].T)
+    return out, sph
+
+
 def spherical_unit_vectors(phi, th):
     """
     Function to compute the spherical unit vectors
@@ -90,10 +252,71 @@ def spherical_unit_vectors(phi, th):
 
     :return: er, ephi, eth, the spherical unit vectors with shape (3, N) for each component
     """
-    er = np.array([np.sin(th) * np.cos(phi), np.sin(th) * np.sin(phi), (np.cos(th))])
-    ephi = np.array([-np.sin(phi), np.cos(phi), np.zeros_like(phi)])
-    eth = np.array([np.cos(th) * np.cos(phi), np.cos(th) * np.sin(phi), -np.sin(th)])
-    return er, ephi, eth
+    trig = _spherical_trig(phi, th)
+    out = np.empty((3, 3) + trig.shape[1:])
+    _spherical_unit_vectors(trig, out)
+    return out[0], out[1], out[2]
+
+
+def _spherical_to_cartesian(r, vr, vphi, vth, trig, out, vout=None):
+    """
+    Function to convert spherical to cartesian coordinates into preallocated buffers
+
+    :param r: radial distance
+    :param vr: radial velocity, not used if vout is None
+    :param vphi: azimuthal velocity, not used if vout is None
+    :param vth: polar velocity, not used if vout is None
+    :param trig: cos phi, sin phi, cos theta, sin theta, see _spherical_trig
+    :param out: buffer indexed by component receiving x, y, z
+    :param vout: buffer indexed by component receiving vx, vy, vz, or None
+    """
+    cosp, sinp, cost, sint = trig[0, ...], trig[1, ...], trig[2, ...], trig[3, ...]
+    rsint = r * sint
+    np.multiply(rsint, cosp, out=out[0, ...])
+    np.multiply(rsint, sinp, out=out[1, ...])
+    np.multiply(r, cost, out=out[2, ...])
+    if vout is not None:
+        # velocity in the plane of er and eth, then along cylindrical R
+        vR = vr * sint
+        vR += vth * cost
+        np.multiply(vR, cosp, out=vout[0, ...])
+        vout[0, ...] -= vphi * sinp
+        np.multiply(vR, sinp, out=vout[1, ...])
+        vout[1, ...] += vphi * cosp
+        np.multiply(vr, cost, out=vout[2, ...])
+        vout[2, ...] -= vth * sint
+
+
+def spherical_to_cartesian_nx3(sph, vsph=None, out=None, vout=None):
+    """
+    Function to convert spherical to cartesian coordinates in the (N, 3) layout
+
+    :param sph: spherical coordinates (array of shape Nx3 with r, phi, theta)
+    :param vsph: spherical velocity components (array of shape Nx3 with vr, vphi, vtheta), or None
+    :param out: buffer of shape Nx3 for x, y, z, allocated if not given
+    :param vout: buffer of shape Nx3 for vx, vy, vz, allocated if not given and vsph is given
+
+    :return: out, and vout if vsph is given
+
+    :note: the stars are converted in blocks of nx3_block, such that the temporary arrays do not grow with N
+    """
+    if out is None:
+        out = np.empty(np.shape(sph))
+    if vsph is not None and vout is None:
+        vout = np.empty(np.shape(vsph))
+    trig = np.empty((4, min(len(sph), nx3_block)))
+    for start in range(0, len(sph), nx3_block):
+        s = slice(start, start + nx3_block)
+        p = sph[s]
+        t = _spherical_trig(p[:, 1], p[:, 2], trig[:, :len(p)])
+        if vsph is None:
+            _spherical_to_cartesian(p[:, 0], 0., 0., 0., t, out[s].T)
+        else:
+            v = vsph[s]
+            _spherical_to_cartesian(p[:, 0], v[:, 0], v[:, 1], v[:, 2], t, out[s].T, vout[s].T)
+    if vsph is None:
+        return out
+    return out, vout
 
 
 def spherical_to_cartesian(r, phi, th, vr, vphi, vth):
@@ -110,17 +333,11 @@ def spherical_to_cartesian(r, phi, th, vr, vphi, vth):
     :return:
     rcart: cartesian coordinates (array of shape Nx3 with x, y, z)
     vcart: cartesian velocity components(array of shape Nx3 with vx, vy, vz)
-    """
-    ur = np.array([np.sin(th) * np.cos(phi), np.sin(th) * np.sin(phi), (np.cos(th))])
-    uphi = np.array([-np.sin(phi), np.cos(phi), np.zeros_like(r)])
-    uth = np.array([np.cos(th) * np.cos(phi), np.cos(th) * np.sin(phi), -np.sin(th)])
 
-    rcart = np.array(r * ur)
-
-    vx = vr * ur[0] + vth * uth[0] + vphi * uphi[0]
-    vy = vr * ur[1] + vth * uth[1] + vphi * uphi[1]
-    vz = vr * ur[2] + vth * uth[2] + vphi * uphi[2]
-
-    vcart = np.array([vx, vy, vz])
-
-    return rcart, vcart
\ No newline at end of file
+    :note: see spherical_to_cartesian_nx3 for the version writing into preallocated buffers
+    """
+    shape = np.broadcast(r, phi, th, vr, vphi, vth).shape
+    trig = _spherical_trig(phi, th)
+    rcart, vcart = np.empty((3,) + shape), np.empty((3,) + shape)
+    _spherical_to_cartesian(r, vr, vphi, vth, np.broadcast_to(trig, (4,) + shape), rcart, vcart)
+    return rcart, vcart
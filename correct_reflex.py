@@ -0,0 +1,419 @@
+import numpy as np
+import argparse
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+from catalog import Catalog, catalog_solar, convert_text, load_catalog, write_header
+from circstats import sketch_percentiles
+from geometry import ReflexGeometry, apex_vector, rsun_mw, vsun_mw
+from read_posterior import read_posterior
+from genreflex import table2_results
+"""
+Apply the reflex motion corrections to the vlos, mu_l and mu_b of a catalog, as in calc_my_reflex.ipynb,
+for catalogs too large to fit in memory.
+
+The catalog is processed in chunks of stars in parallel workers. Each star is assigned to its radial bin
+from its galactocentric radius, the reflex and bulk motion model of its bin is evaluated with the
+precomputed geometry of the chunk, and the corrected observables are written to an output catalog.
+
+Usage:
+
+python correct_reflex.py input.cat output.cat --edges processed_real/binned_sgr_4bin/KG/KGiant_edr3_metal_sgr_20_bin_edges.txt
+
+The model parameters default to Table 2 of Yaaqib, Petersen and Penarrubia 2024, with the bins
+20-30, 30-40, 40-50 and 50+ kpc. Text input files are first converted to a temporary catalog.
+
+The output catalog has the columns vlos_corr, mul_corr, mub_corr (observed minus model), vlos_model,
+mul_model, mub_model and bin (index of the radial bin, -1 outside the bins). Stars outside the bins
+have NaN corrections.
+
+The model is evaluated with the solar position and motion of --rsun and --vsun (defaulting to rsun_mw and
+vsun_mw of geometry.py), the galactocentric positions of the catalog being moved from the solar position
+it was made with.
+
+With --posterior, the corrections are propagated from the posterior samples of the fit of each bin
+instead of a single set of values:
+
+python correct_reflex.py input.cat output.cat --edges bin_edges.txt --posterior chains/bin0/ chains/bin1/ ...
+
+The model is evaluated for every (sample, star) pair in blocks over both stars and samples, and the
+output catalog has the mean, standard deviation and percentiles over the samples of the corrected
+observables, e.g. vlos_corr_mean, vlos_corr_std, vlos_corr_p14, vlos_corr_p50, vlos_corr_p86. The mean
+and standard deviation are accumulated with Welford/Chan updates, and the percentiles with a histogram
+per star spanning +-8 standard deviations of the first block of samples.
+"""
+
+output_columns = ['vlos_corr', 'mul_corr', 'mub_corr', 'vlos_model', 'mul_model', 'mub_model']
+
+# bins of Table 2 in the paper
+table2_edges = np.array([20., 30., 40., 50., np.inf])
+
+
+def reflex_parameters(M):
+    """
+    Function to convert fitted values per bin or posterior samples to the linear model parameters of ReflexGeometry
+
+    :param M: array of shape (Nbins, >=6) with l_apex (deg), b_apex (deg), v_travel, vr, vphi, vth,
+        as in table2_results
+
+    :return: P, array of shape (Nbins, 6)
+    """
+    M = np.atleast_2d(M)
+    P = np.zeros((len(M), 6))
+    P[:, :3] = -M[:, 2:3] * apex_vector(np.deg2rad(M[:, 0]), np.deg2rad(90. - M[:, 1])).T
+    P[:, 3:] = M[:, 3:6]
+    return P
+
+
+def assign_bins(r, edges):
+    """
+    Function to assign stars to radial bins
+
+    :param r: galactocentric radii
+    :param edges: bin edges (Nbins+1)
+
+    :return: index of the bin of each star, -1 outside the bins
+    """
+    ibin = np.searchsorted(edges, r, side='right') - 1
+    ibin[(ibin < 0) | (ibin >= len(edges) - 1)] = -1
+    return ibin
+
+
+def correct_chunk(rgal, ibin, P, solar=True, rsun=rsun_mw, vsun=vsun_mw):
+    """
+    Function to compute the model observables of a chunk of stars
+
+    :param rgal: galactic cartesian coordinates (Nx3)
+    :param ibin: index of the bin of each star, -1 outside the bins
+    :param P: linear model parameters of each bin (Nbins, 6)
+    :param solar: if True, the solar motion is included in the model
+    :param rsun: position of the sun in the galactocentric frame of rgal (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+    :return: array of shape (3, N) with the model vlos, mul, mub, NaN outside the bins
+    """
+    geom = ReflexGeometry(rgal, rsun, vsun)
+    # parameters of the bin of each star, such that all bins are evaluated in one pass
+    Pstar = P[ibin]
+    model = np.einsum('inj,nj->in', geom.proj, Pstar)
+    if solar:
+        model -= geom.offset
+    model[:, ibin < 0] = np.nan
+    return model
+
+
+def _chunk_positions(cat, start, stop, rsun):
+    """
+    Function to read the galactic cartesian coordinates of a chunk of stars, moved to a solar position
+
+    :param cat: Catalog
+    :param start: index of the first star
+    :param stop: index after the last star
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+
+    :return: array of shape (N, 3)
+    """
+    rgal = np.column_stack([cat[name][start:stop] for name in ['x', 'y', 'z']]).astype(float)
+    return rgal + (np.asarray(rsun, dtype=float) - catalog_solar(cat)[0])
+
+
+def _correct_worker(args):
+    """
+    Function to correct one chunk of the input catalog and write it to the output catalog
+
+    :param args: (input catalog path, output catalog path, start, stop, edges, P, solar, rsun, vsun)
+
+    :return: number of stars in the chunk
+    """
+    inpath, outpath, start, stop, edges, P, solar, rsun, vsun = args
+    cat = Catalog(inpath)
+    rgal = _chunk_positions(cat, start, stop, rsun)
+    ibin = assign_bins(np.linalg.norm(rgal, axis=1), edges)
+    model = correct_chunk(rgal, ibin, P, solar, rsun, vsun)
+
+    out = Catalog(outpath, mmap_mode='r+')
+    for i, name in enumerate(['vlos', 'mul', 'mub']):
+        out[name + '_corr'][start:stop] = cat[name][start:stop] - model[i]
+        out[name + '_model'][start:stop] = model[i]
+    out['bin'][start:stop] = ibin
+    for name in out.names:
+        out[name].flush()
+    return stop - start
+
+
+def posterior_parameters(prefix):
+    """
+    Function to read the equally weighted posterior samples of a fit as linear model parameters
+
+    :param prefix: prefix of the pyMultinest output files
+
+    :return: P, array of shape (Nsamples, 6)
+    """
+    P = read_posterior(prefix)
+    return reflex_parameters(np.column_stack([P[name] for name in ['l', 'b', 'vtravel', 'vr', 'vphi', 'vth']]))
+
+
+def welford_merge(n, mean, M2, nb, meanb, M2b):
+    """
+    Function to merge the running mean and sum of squared deviations of two sets of samples
+
+    :param n: number of samples of the first set
+    :param mean: mean of the first set
+    :param M2: sum of squared deviations from the mean of the first set
+    :param nb: number of samples of the second set
+    :param meanb: mean of the second set
+    :param M2b: sum of squared deviations from the mean of the second set
+
+    :return: n, mean, M2 of the merged set
+    """
+    ntot = n + nb
+    delta = meanb - mean
+    mean = mean + delta * nb / ntot
+    M2 = M2 + M2b + delta ** 2. * n * nb / ntot
+    return ntot, mean, M2
+
+
+def propagate_chunk(rgal, data, ibin, Ps, percentiles, sample_block=256, nhist=256, solar=True, rsun=rsun_mw,
+                    vsun=vsun_mw):
+    """
+    Function to compute the statistics of the corrected observables of a chunk of stars over posterior samples
+
+    :param rgal: galactic cartesian coordinates (Nx3)
+    :param data: observed vlos, mul, mub (3xN)
+    :param ibin: index of the bin of each star, -1 outside the bins
+    :param Ps: list with the linear model parameters of the posterior samples of each bin (Nsamples, 6)
+    :param percentiles: percentiles to compute
+    :param sample_block: number of samples evaluated at once
+    :param nhist: number of histogram bins per star for the percentiles
+    :param solar: if True, the solar motion is included in the model
+    :param rsun: position of the sun in the galactocentric frame of rgal (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+    :return: mean, std of shape (3, N) and percentiles of shape (len(percentiles), 3, N), NaN outside the bins
+    """
+    geom = ReflexGeometry(rgal, rsun, vsun)
+    n = len(rgal)
+    mean = np.full((3, n), np.nan)
+    std = np.full((3, n), np.nan)
+    pct = np.full((len(percentiles), 3, n), np.nan)
+
+    for k, P in enumerate(Ps):
+        sel = np.where(ibin == k)[0]
+        m = len(sel)
+        if m == 0:
+            continue
+        proj = geom.proj[:, sel]
+        # corrected = data - model, with model = proj @ p - offset
+        base = data[:, sel] + geom.offset[:, sel] if solar else data[:, sel]
+
+        count, mu, M2 = 0, np.zeros((3, m)), np.zeros((3, m))
+        hist = None
+        for start in range(0, len(P), sample_block):
+            v = base[:, :, None] - np.einsum('inj,sj->ins', proj, P[start:start + sample_block])
+            nb = v.shape[-1]
+            meanb = v.mean(axis=-1)
+            M2b = np.sum((v - meanb[:, :, None]) ** 2., axis=-1)
+            count, mu, M2 = welford_merge(count, mu, M2, nb, meanb, M2b)
+
+            if hist is None:
+                # histogram range from the first block of samples
+                half = 8. * np.sqrt(M2b / nb)
+                half = np.maximum(half, 1.e-8 * (np.abs(meanb) + 1.)).ravel()
+                lo = meanb.ravel() - half
+                width = 2. * half / nhist
+                hist = np.zeros((3 * m, nhist), dtype=np.int64)
+            idx = np.clip(np.floor((v.reshape(3 * m, nb) - lo[:, None]) / width[:, None]), 0, nhist - 1)
+            flat = (np.arange(3 * m)[:, None] * nhist + idx.astype(np.intp)).ravel()
+            hist += np.bincount(flat, minlength=3 * m * nhist).reshape(3 * m, nhist)
+
+        mean[:, sel] = mu
+        std[:, sel] = np.sqrt(M2 / count)
+        pct[:, :, sel] = sketch_percentiles(hist, lo, width, percentiles).reshape(len(percentiles), 3, m)
+    return mean, std, pct
+
+
+def _propagate_worker(args):
+    """
+    Function to propagate the posterior of one chunk of the input catalog and write it to the output catalog
+
+    :param args: (input catalog path, output catalog path, start, stop, edges, Ps, percentiles, sample_block, solar,
+        rsun, vsun)
+
+    :return: number of stars in the chunk
+    """
+    inpath, outpath, start, stop, edges, Ps, percentiles, sample_block, solar, rsun, vsun = args
+    cat = Catalog(inpath)
+    rgal = _chunk_positions(cat, start, stop, rsun)
+    data = np.array([cat[name][start:stop] for name in ['vlos', 'mul', 'mub']], dtype=float)
+    ibin = assign_bins(np.linalg.norm(rgal, axis=1), edges)
+    mean, std, pct = propagate_chunk(rgal, data, ibin, Ps, percentiles, sample_block, solar=solar, rsun=rsun,
+                                     vsun=vsun)
+
+    out = Catalog(outpath, mmap_mode='r+')
+    for i, name in enumerate(['vlos', 'mul', 'mub']):
+        out[name + '_corr_mean'][start:stop] = mean[i]
+        out[name + '_corr_std'][start:stop] = std[i]
+        for j, q in enumerate(percentiles):
+            out[name + '_corr_p%g' % q][start:stop] = pct[j, i]
+    out['bin'][start:stop] = ibin
+    for name in out.names:
+        out[name].flush()
+    return stop - start
+
+
+def _open_input(inpath):
+    """
+    Function to open the input of a correction, converting text files to a temporary catalog
+
+    :param inpath: path to the input catalog directory or text file
+
+    :return: path to the input catalog, temporary directory to remove afterwards or None
+    """
+    if os.path.isdir(inpath):
+        return inpath, None
+    tmpdir = tempfile.mkdtemp()
+    return convert_text(inpath, os.path.join(tmpdir, 'input.cat')), tmpdir
+
+
+def _make_output(outpath, names, nstars, source):
+    """
+    Function to preallocate the output catalog, which the workers fill chunk by chunk
+
+    :param outpath: path to the output catalog directory
+    :param names: names of the float columns, a bin column is added
+    :param nstars: number of stars
+    :param source: path to the input catalog
+    """
+    os.makedirs(outpath, exist_ok=True)
+    for name in names:
+        np.lib.format.open_memmap(os.path.join(outpath, name + '.npy'), mode='w+', dtype=np.float64, shape=(nstars,))
+    np.lib.format.open_memmap(os.path.join(outpath, 'bin.npy'), mode='w+', dtype=np.int32, shape=(nstars,))
+    write_header(outpath, list(names) + ['bin'], nstars, np.float64, source=source)
+
+
+def _run_chunks(worker, tasks, nproc=None):
+    """
+    Function to run the chunks over a process pool
+
+    :param worker: function of one task
+    :param tasks: list of tasks
+    :param nproc: number of processes, defaults to the number of cores
+    """
+    if nproc is None:
+        nproc = os.cpu_count()
+    with Pool(max(1, min(nproc, len(tasks)))) as pool:
+        for n in pool.imap_unordered(worker, tasks):
+            pass
+
+
+def correct_catalog(inpath, outpath, edges=table2_edges, M=None, chunk_size=100000, nproc=None, solar=True,
+                    rsun=rsun_mw, vsun=vsun_mw):
+    """
+    Function to correct a catalog for the reflex motion in bounded memory
+
+    :param inpath: path to the input catalog directory or text file
+    :param outpath: path to the output catalog directory
+    :param edges: radial bin edges (Nbins+1), kpc
+    :param M: fitted values per bin (Nbins, >=6), see reflex_parameters, defaults to table2_results
+    :param chunk_size: number of stars per chunk
+    :param nproc: number of processes, defaults to the number of cores
+    :param solar: if True, the solar motion is included in the model
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+    :return: path to the output catalog
+    """
+    if M is None:
+        M = table2_results()[0]
+    P = reflex_parameters(M)
+    edges = np.asarray(edges, dtype=float)
+    if len(P) != len(edges) - 1:
+        raise ValueError('%d bins of parameters for %d bin edges' % (len(P), len(edges)))
+
+    inpath, tmpdir = _open_input(inpath)
+    try:
+        nstars = Catalog(inpath).nstars
+        _make_output(outpath, output_columns, nstars, inpath)
+        tasks = [(inpath, outpath, start, min(start + chunk_size, nstars), edges, P, solar, rsun, vsun)
+                 for start in range(0, nstars, chunk_size)]
+        _run_chunks(_correct_worker, tasks, nproc)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return outpath
+
+
+def propagate_posterior(inpath, outpath, prefixes, edges=table2_edges, percentiles=(14., 50., 86.),
+                        chunk_size=4096, sample_block=256, nproc=None, solar=True, rsun=rsun_mw, vsun=vsun_mw):
+    """
+    Function to propagate the posterior samples of the fit of each bin to the corrections of a catalog
+
+    :param inpath: path to the input catalog directory or text file
+    :param outpath: path to the output catalog directory
+    :param prefixes: prefixes of the pyMultinest output files of the fit of each bin
+    :param edges: radial bin edges (Nbins+1), kpc
+    :param percentiles: percentiles of the corrected observables to compute
+    :param chunk_size: number of stars per chunk
+    :param sample_block: number of samples evaluated at once
+    :param nproc: number of processes, defaults to the number of cores
+    :param solar: if True, the solar motion is included in the model
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+    :return: path to the output catalog
+
+    :note: the memory of each worker scales as chunk_size * (sample_block + 256) * 3 * 8 bytes
+    """
+    Ps = [posterior_parameters(prefix) for prefix in prefixes]
+    edges = np.asarray(edges, dtype=float)
+    if len(Ps) != len(edges) - 1:
+        raise ValueError('%d posteriors for %d bin edges' % (len(Ps), len(edges)))
+
+    names = []
+    for name in ['vlos', 'mul', 'mub']:
+        names += [name + '_corr_mean', name + '_corr_std'] + [name + '_corr_p%g' % q for q in percentiles]
+
+    inpath, tmpdir = _open_input(inpath)
+    try:
+        nstars = Catalog(inpath).nstars
+        _make_output(outpath, names, nstars, inpath)
+        tasks = [(inpath, outpath, start, min(start + chunk_size, nstars), edges, Ps, percentiles, sample_block,
+                  solar, rsun, vsun) for start in range(0, nstars, chunk_size)]
+        _run_chunks(_propagate_worker, tasks, nproc)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return outpath
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Correct the vlos, mu_l and mu_b of a catalog for the reflex motion.')
+    parser.add_argument('input', help='input catalog directory or text file')
+    parser.add_argument('output', help='output catalog directory')
+    parser.add_argument('--edges', default=None,
+                        help='file of radial bin edges (first column), defaults to 20,30,40,50,inf kpc')
+    parser.add_argument('--params', default=None,
+                        help='text file with one row per bin: l_apex b_apex (deg) vtravel vr vphi vth, '
+                             'defaults to Table 2')
+    parser.add_argument('--posterior', nargs='+', default=None,
+                        help='prefixes of the pyMultinest output files of each bin, to propagate the posterior')
+    parser.add_argument('--percentiles', nargs='+', type=float, default=[14., 50., 86.],
+                        help='percentiles of the corrected observables with --posterior')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='number of stars per chunk, defaults to 100000 (4096 with --posterior)')
+    parser.add_argument('--nproc', type=int, default=None)
+    parser.add_argument('--no-solar', action='store_true', help='do not include the solar motion in the model')
+    parser.add_argument('--rsun', type=float, nargs=3, default=rsun_mw, help='solar position (kpc)')
+    parser.add_argument('--vsun', type=float, nargs=3, default=vsun_mw, help='solar velocity (km/s)')
+    args = parser.parse_args()
+
+    edges = table2_edges if args.edges is None else load_catalog(args.edges).array()[:, 0]
+    if args.posterior is not None:
+        propagate_posterior(args.input, args.output, args.posterior, edges, args.percentiles,
+                            chunk_size=args.chunk_size or 4096, nproc=args.nproc, solar=not args.no_solar,
+                            rsun=args.rsun, vsun=args.vsun)
+    else:
+        M = None if args.params is None else np.loadtxt(args.params, ndmin=2)
+        correct_catalog(args.input, args.output, edges, M, chunk_size=args.chunk_size or 100000, nproc=args.nproc,
+                        solar=not args.no_solar, rsun=args.rsun, vsun=args.vsun)
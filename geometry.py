@@ -0,0 +1,178 @@
+import numpy as np
+from coord import spherical_basis
+"""
+Precomputed geometry for the reflex motion model.
+
+The star positions do not change during a fit, only the apex direction, v_travel and the bulk
+motion do. The reflex motion is a uniform velocity of -v_travel along the apex direction and the
+bulk motion is (vr, vphi, vth) along the galactocentric spherical unit vectors of each star, so that
+the model observables are linear in the 6-vector
+
+    p = (-v_travel * apex unit vector, vr, vphi, vth)
+
+and can be written as (vlos, mul, mub) = proj @ p - offset, where proj and offset only depend on the
+star positions and the solar position and motion. ReflexGeometry computes these once per dataset.
+
+The observables are also linear in the solar motion: offset = E @ vsun, where E = proj[:, :, :3] are the
+heliocentric unit vectors, so a fit with the solar motion vsun' is the fit with vsun and the reflex
+velocity shifted by vsun - vsun', see solar_shift. Only a change of the solar position needs a new geometry.
+"""
+
+# default motion and position of the sun in the galactocentric frame, used by all scripts
+vsun_mw = np.array([11.1, 244.24, 7.25])  # km/s
+rsun_mw = np.array([-8.3, 0., 0.02])  # kpc
+
+# conversion factor between km/s and kpc mas/yr
+kfac = 4.74057
+
+# number of stars whose geometry is computed at once, bounding the temporary arrays
+geometry_block = 2 ** 14
+
+
+def apex_vector(lapex, bapex):
+    """
+    Function to compute the unit vector pointing at the apex
+
+    :param lapex: azimuthal angle of the apex (rad)
+    :param bapex: polar angle of the apex (rad)
+
+    :return: unit vector of shape (3,), the z axis of the frame rotated by euler_xyz(lapex, bapex)
+    """
+    return np.array([np.sin(bapex) * np.cos(lapex),
+                     np.sin(bapex) * np.sin(lapex),
+                     np.cos(bapex)])
+
+
+def reflex_vector(lapex, bapex, vtravel, vr, vphi, vth):
+    """
+    Function to compute the vector of linear model parameters from the reflex and bulk motion
+
+    :param lapex: azimuthal angle of the apex (rad)
+    :param bapex: polar angle of the apex (rad)
+    :param vtravel: travel velocity (kms^-1)
+    :param vr: bulk radial velocity (kms^-1)
+    :param vphi: bulk azimuthal velocity (kms^-1)
+    :param vth: bulk polar velocity (kms^-1)
+
+    :return: p, array of shape (6,) with the reflex velocity vector and the bulk motion, or (6, n) if
+        the parameters are arrays of n parameter sets
+    """
+    p = np.zeros((6,) + np.shape(vtravel))
+    p[:3] = -vtravel * apex_vector(lapex, bapex)
+    p[3:] = vr, vphi, vth
+    return p
+
+
+def solar_shift(vsun, vsun_new):
+    """
+    Function to compute the shift of the linear model parameters equivalent to a change of the solar motion
+
+    :param vsun: solar motion of the geometry (kms^-1)
+    :param vsun_new: solar motion to evaluate the model with (kms^-1), shape (3,) or (n, 3)
+
+    :return: array of shape (6,), or (6, n), such that proj @ (p + shift) - offset are the observables
+        with the solar motion vsun_new
+    """
+    dv = np.asarray(vsun, dtype=float) - np.asarray(vsun_new, dtype=float)
+    shift = np.zeros((6,) + dv.shape[:-1])
+    shift[:3] = dv.T
+    return shift
+
+
+class ReflexGeometry:
+    """
+    Class holding the projection of the reflex motion model onto the observables of a fixed set of stars
+
+    :param rgal: galactic cartesian coordinates (Nx3)
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+    :param pm_units: if True, the proper motion observables are in mas/yr, otherwise they are the
+        tangential velocities in kms^-1
+    :param block: number of stars computed at once, defaults to geometry_block
+    :param dtype: dtype of the stored geometry, the geometry is computed in float64 and float32 halves its memory
+
+    :note: proj has shape (3, N, 6) and offset shape (3, N), the first axis being vlos, mul, mub
+    """
+
+    def __init__(self, rgal, rsun, vsun, pm_units=True, block=None, dtype=np.float64):
+        rgal = np.asarray(rgal)
+        rsun, vsun = np.asarray(rsun, dtype=float), np.asarray(vsun, dtype=float)
+        if block is None:
+            block = geometry_block
+        self.nstars = len(rgal)
+        self.dist, self.l, self.th, self.fac = (np.empty(self.nstars, dtype=dtype) for i in range(4))
+        self.proj = np.empty((3, self.nstars, 6), dtype=dtype)
+        self.offset = np.empty((3, self.nstars), dtype=dtype)
+
+        for start in range(0, self.nstars, block):
+            s = slice(start, start + block)
+            pos = np.asarray(rgal[s], dtype=float)
+
+            # galactocentric spherical unit vectors, for the bulk motion
+            B = spherical_basis(pos[:, 0], pos[:, 1], pos[:, 2])[0]
+
+            # heliocentric spherical coordinates and unit vectors, for the observables
+            E, rsunsph = spherical_basis(pos[:, 0] - rsun[0], pos[:, 1] - rsun[1], pos[:, 2] - rsun[2])
+            self.dist[s], self.l[s], self.th[s] = rsunsph
+            # note: this is the norm of (r, phi, theta) as used in the original get_v, not the distance
+            fac = kfac * np.sqrt(np.einsum('cn,cn->n', rsunsph, rsunsph))
+            self.fac[s] = fac
+
+            # rows of the projection onto vlos, mul, mub with shape (3 observables, 3 components, n stars)
+            E[2] *= -1.
+            if pm_units:
+                E[1:] /= fac
+
+            # projection of the bulk motion unit vectors and of the solar motion, summed over components
+            M = E[:, None, 0] * B[None, :, 0]
+            offset = vsun[0] * E[:, 0]
+            for c in (1, 2):
+                M += E[:, None, c] * B[None, :, c]
+                offset += vsun[c] * E[:, c]
+
+            self.proj[:, s, :3] = E.transpose(0, 2, 1)
+            self.proj[:, s, 3:] = M.transpose(0, 2, 1)
+            self.offset[:, s] = offset
+
+    def subset(self, mask):
+        """
+        Function to select the geometry of a subset of the stars
+
+        :param mask: boolean mask or indices of the stars
+
+        :return: ReflexGeometry of the subset
+        """
+        geom = ReflexGeometry.__new__(ReflexGeometry)
+        geom.dist, geom.l, geom.th, geom.fac = self.dist[mask], self.l[mask], self.th[mask], self.fac[mask]
+        geom.proj = self.proj[:, mask]
+        geom.offset = self.offset[:, mask]
+        geom.nstars = len(geom.dist)
+        return geom
+
+    def with_vsun(self, vsun):
+        """
+        Function to change the solar motion of the geometry, without recomputing the projection
+
+        :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+        :return: ReflexGeometry sharing proj with this one
+        """
+        geom = self.subset(slice(None))
+        geom.offset = np.dot(self.proj[:, :, :3], np.asarray(vsun, dtype=float)).astype(self.proj.dtype)
+        return geom
+
+    def observables(self, p, solar=True):
+        """
+        Function to compute the model observables for a vector of linear model parameters
+
+        :param p: linear model parameters of shape (6,), or (6, n) for n parameter sets, see reflex_vector
+        :param solar: if True, the solar motion is subtracted
+
+        :return: array of shape (3, N) with vlos, mul, mub, or (3, N, n) for n parameter sets, in the dtype
+            of the geometry
+        """
+        p = np.asarray(p, dtype=self.proj.dtype)
+        obs = np.dot(self.proj.reshape(-1, 6), p).reshape((3, self.nstars) + np.shape(p)[1:])
+        if solar:
+            obs -= self.offset.reshape(self.offset.shape + (1,) * (obs.ndim - 2))
+        return obs
@@ -0,0 +1,376 @@
+import numpy as np
+import argparse
+import itertools
+import os
+from catalog import Catalog, CatalogWriter, columns
+from circstats import sketch_percentiles
+from coord import spherical_to_cartesian
+from geometry import kfac, rsun_mw, vsun_mw
+"""
+Ingest of raw survey columns into the 17-column input catalogs of the fitter, with radial binning.
+
+The raw input is a text table with a header line of column names (comma or whitespace separated, as
+written by the Gaia archive or TOPCAT) or a catalog directory, with the columns
+
+    ra, dec [deg], parallax [mas] or distance [kpc], pmra, pmdec [mas/yr], rv [km/s],
+    parallax_error or distance_error, pmra_error, pmdec_error, rv_error, pmra_pmdec_corr
+
+Gaia archive names (radial_velocity, radial_velocity_error) are recognised, and other names are mapped
+with --rename rv=vhelio. The equatorial positions and proper motions are rotated to Galactic l, b, mu_l
+(including cos b) and mu_b, with the proper motion covariance rotated into emul, emub and corr, and the
+galactocentric x..vz follow from coord.spherical_to_cartesian with the solar position rsun and velocity
+vsun (defaulting to rsun_mw and vsun_mw of geometry.py). Distances from parallaxes are 1/parallax
+with the first order error, and stars with non-positive parallaxes or missing values are dropped.
+
+The table is read in chunks, and each transformed chunk is appended to the output catalog, such that
+the memory use does not depend on the number of stars. The galactocentric radii are accumulated into a
+fine histogram on the fly, from which equal-count bin edges follow as streaming quantiles. A second
+chunked pass over the output catalog writes one catalog per bin and the _bin_edges.txt file, in the
+format of processed_real/binned_sgr_4bin.
+
+Usage, for 4 equal-count bins between 20 and 200 kpc:
+
+python ingest.py kgiants.csv processed/KGiant.cat --rmin 20 --rmax 200 --nbins 4 --binning count
+
+which writes processed/KGiant.cat, processed/KGiant_0.cat ... processed/KGiant_3.cat and
+processed/KGiant_bin_edges.txt. Fixed edges are given with --edges 20 30 40 50 200.
+"""
+
+# names under which the raw columns are looked up, in order
+raw_names = {'ra': ['ra'], 'dec': ['dec'], 'parallax': ['parallax'], 'distance': ['distance', 'dist'],
+             'pmra': ['pmra'], 'pmdec': ['pmdec'], 'rv': ['rv', 'radial_velocity', 'vlos'],
+             'parallax_error': ['parallax_error'], 'distance_error': ['distance_error', 'edist'],
+             'pmra_error': ['pmra_error'], 'pmdec_error': ['pmdec_error'],
+             'rv_error': ['rv_error', 'radial_velocity_error', 'evlos'], 'pmra_pmdec_corr': ['pmra_pmdec_corr']}
+
+# rotation from ICRS to Galactic cartesian coordinates (Hipparcos definition, as in astropy)
+icrs_to_galactic = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                             [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+                             [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669]])
+
+
+def raw_column(chunk, name, rename=None, default=None):
+    """
+    Function to find a raw column in a chunk under its possible names
+
+    :param chunk: dictionary of the raw columns
+    :param name: key of raw_names
+    :param rename: dictionary of further names of the raw columns
+    :param default: value returned if the column is missing, otherwise a KeyError is raised
+
+    :return: array of the column
+    """
+    names = raw_names[name]
+    if rename is not None and name in rename:
+        names = [rename[name]]
+    for n in names:
+        if n in chunk:
+            return np.asarray(chunk[n], dtype=float)
+    if default is not None:
+        return default
+    raise KeyError('no column %s in the raw input (looked for %s)' % (name, ', '.join(names)))
+
+
+def equatorial_to_galactic(ra, dec, pmra, pmdec, pmra_error, pmdec_error, pmra_pmdec_corr):
+    """
+    Function to rotate equatorial positions and proper motions with their covariance to Galactic coordinates
+
+    :param ra: right ascension (deg)
+    :param dec: declination (deg)
+    :param pmra: proper motion in ra, including cos dec (mas/yr)
+    :param pmdec: proper motion in dec (mas/yr)
+    :param pmra_error: error of pmra (mas/yr)
+    :param pmdec_error: error of pmdec (mas/yr)
+    :param pmra_pmdec_corr: correlation of pmra and pmdec
+
+    :return: l, b (deg), mul (including cos b), mub, emul, emub (mas/yr) and the correlation of mul and mub
+    """
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    cosa, sina, cosd, sind = np.cos(ra), np.sin(ra), np.cos(dec), np.sin(dec)
+
+    # 1. position and the east and north directions on the sky, rotated to Galactic coordinates
+    u = icrs_to_galactic @ np.array([cosd * cosa, cosd * sina, sind])
+    east = icrs_to_galactic @ np.array([-sina, cosa, np.zeros_like(ra)])
+    north = icrs_to_galactic @ np.array([-sind * cosa, -sind * sina, cosd])
+
+    l = np.arctan2(u[1], u[0]) % (2. * np.pi)
+    b = np.arcsin(np.clip(u[2], -1., 1.))
+
+    # 2. Jacobian between the equatorial and Galactic tangent planes
+    cosl, sinl, cosb, sinb = np.cos(l), np.sin(l), np.cos(b), np.sin(b)
+    el = np.array([-sinl, cosl, np.zeros_like(l)])
+    eb = np.array([-sinb * cosl, -sinb * sinl, cosb])
+    j00, j01 = np.sum(el * east, axis=0), np.sum(el * north, axis=0)
+    j10, j11 = np.sum(eb * east, axis=0), np.sum(eb * north, axis=0)
+
+    mul = j00 * pmra + j01 * pmdec
+    mub = j10 * pmra + j11 * pmdec
+
+    # 3. covariance J C J^T
+    caa, cdd = pmra_error ** 2., pmdec_error ** 2.
+    cad = pmra_pmdec_corr * pmra_error * pmdec_error
+    cll = j00 ** 2. * caa + 2. * j00 * j01 * cad + j01 ** 2. * cdd
+    cbb = j10 ** 2. * caa + 2. * j10 * j11 * cad + j11 ** 2. * cdd
+    clb = j00 * j10 * caa + (j00 * j11 + j01 * j10) * cad + j01 * j11 * cdd
+    emul, emub = np.sqrt(cll), np.sqrt(cbb)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.where(emul * emub > 0, clb / (emul * emub), 0.)
+    return np.rad2deg(l), np.rad2deg(b), mul, mub, emul, emub, corr
+
+
+def transform_chunk(chunk, rsun=rsun_mw, vsun=vsun_mw, rename=None, parallax_zero_point=0.):
+    """
+    Function to transform a chunk of raw survey columns to the input columns of the fitter
+
+    :param chunk: dictionary or Catalog of the raw columns, see raw_names
+    :param rsun: galactocentric position of the Sun (kpc)
+    :param vsun: galactocentric velocity of the Sun (km/s)
+    :param rename: dictionary of further names of the raw columns
+    :param parallax_zero_point: zero point subtracted from the parallaxes (mas)
+
+    :return: dictionary of the columns of catalog.columns, and the boolean mask of the valid stars
+    """
+    ra = raw_column(chunk, 'ra', rename)
+    zeros = np.zeros_like(ra)
+
+    # 1. distances, directly or from the parallaxes
+    dist = raw_column(chunk, 'distance', rename, default=False)
+    if dist is not False:
+        edist = raw_column(chunk, 'distance_error', rename, default=zeros)
+    else:
+        plx = raw_column(chunk, 'parallax', rename) - parallax_zero_point
+        with np.errstate(divide='ignore'):
+            dist = np.where(plx > 0, 1. / plx, np.nan)
+            edist = raw_column(chunk, 'parallax_error', rename, default=zeros) / plx ** 2.
+
+    # 2. sky positions and proper motions
+    l, b, mul, mub, emul, emub, corr = equatorial_to_galactic(
+        ra, raw_column(chunk, 'dec', rename), raw_column(chunk, 'pmra', rename), raw_column(chunk, 'pmdec', rename),
+        raw_column(chunk, 'pmra_error', rename), raw_column(chunk, 'pmdec_error', rename),
+        raw_column(chunk, 'pmra_pmdec_corr', rename, default=zeros))
+    vlos = raw_column(chunk, 'rv', rename)
+    evlos = raw_column(chunk, 'rv_error', rename)
+
+    # 3. galactocentric positions and velocities, with the sign conventions of the catalogs in processed_real
+    fac = kfac * dist
+    rcart, vcart = spherical_to_cartesian(dist, np.deg2rad(l), np.deg2rad(90. - b), vlos, fac * mul, -fac * mub)
+    rgal = rcart + np.asarray(rsun, dtype=float)[:, None]
+    vgal = vcart + np.asarray(vsun, dtype=float)[:, None]
+
+    out = dict(zip(columns, [rgal[0], rgal[1], rgal[2], vgal[0], vgal[1], vgal[2], l, b, dist, vlos, mul, mub,
+                             edist, evlos, emul, emub, corr]))
+    valid = np.all(np.isfinite(np.array(list(out.values()))), axis=0) & (dist > 0)
+    return out, valid
+
+
+def text_chunks(fname, chunk_size=100000):
+    """
+    Function to read a text table with a header line of column names in chunks
+
+    :param fname: path to the text file, comma or whitespace separated
+    :param chunk_size: number of rows read at once
+
+    :return: generator of dictionaries of the columns of each chunk, missing values are NaN
+    """
+    with open(fname) as f:
+        lines = (line for line in f if line.strip() != '')
+        header = next(lines)
+        delimiter = ',' if ',' in header else None
+        names = [n.strip() for n in header.lstrip('#').split(delimiter)]
+        lines = (line for line in lines if not line.lstrip().startswith('#'))
+        while True:
+            block = list(itertools.islice(lines, chunk_size))
+            if len(block) == 0:
+                return
+            d = np.genfromtxt(block, delimiter=delimiter, dtype=float, ndmin=2)
+            yield {name: d[:, i] for i, name in enumerate(names)}
+
+
+def catalog_chunks(cat, chunk_size=100000, names=None):
+    """
+    Function to read the columns of a catalog in chunks
+
+    :param cat: Catalog
+    :param chunk_size: number of stars read at once
+    :param names: columns to read, defaults to all columns
+
+    :return: generator of dictionaries of the columns of each chunk
+    """
+    if names is None:
+        names = cat.names
+    for start in range(0, cat.nstars, chunk_size):
+        yield {name: np.asarray(cat[name][start:start + chunk_size]) for name in names}
+
+
+class RadialSketch:
+    """
+    Class accumulating a histogram of galactocentric radii chunk by chunk, for streaming quantiles
+
+    :param lo: lower edge of the histogram (kpc)
+    :param hi: upper edge of the histogram (kpc), larger radii are counted in the last bin
+    :param nhist: number of histogram bins
+
+    :note: the quantiles are exact to within (hi - lo) / nhist, i.e. 15 pc for the defaults of ingest
+    """
+
+    def __init__(self, lo, hi, nhist=2 ** 16):
+        self.lo, self.hi, self.nhist = float(lo), float(hi), int(nhist)
+        self.width = (self.hi - self.lo) / self.nhist
+        self.hist = np.zeros(self.nhist)
+        self.rmin, self.rmax = np.inf, -np.inf
+
+    def add(self, r):
+        """
+        Function to add radii to the histogram
+
+        :param r: galactocentric radii (kpc)
+        """
+        if len(r) == 0:
+            return
+        k = np.clip(((r - self.lo) / self.width).astype(int), 0, self.nhist - 1)
+        self.hist += np.bincount(k, minlength=self.nhist)
+        self.rmin, self.rmax = min(self.rmin, np.min(r)), max(self.rmax, np.max(r))
+
+    def quantiles(self, q):
+        """
+        Function to compute quantiles of the radii
+
+        :param q: quantiles between 0 and 1
+
+        :return: array of the radii at the quantiles
+        """
+        q = np.atleast_1d(q)
+        out = sketch_percentiles(self.hist[None], np.array([self.lo]), np.array([self.width]), 100. * q)[:, 0]
+        return np.clip(out, self.rmin, self.rmax)
+
+
+def bin_edges(sketch, nbins, binning='count', rmin=0., rmax=np.inf):
+    """
+    Function to choose radial bin edges
+
+    :param sketch: RadialSketch of the radii of the stars
+    :param nbins: number of bins
+    :param binning: 'count' for equal numbers of stars, 'width' for equal widths
+    :param rmin: lower radius of the sample, the smallest radius is used if 0
+    :param rmax: upper radius of the sample, the largest radius is used if infinite
+
+    :return: array of nbins + 1 edges
+    """
+    lo = rmin if rmin > 0 else sketch.rmin
+    hi = rmax if np.isfinite(rmax) else sketch.rmax
+    if binning == 'width':
+        return np.linspace(lo, hi, nbins + 1)
+    if binning != 'count':
+        raise ValueError('unknown binning %s, use count or width' % binning)
+    edges = sketch.quantiles(np.arange(nbins + 1) / nbins)
+    edges[0], edges[-1] = lo, hi
+    return edges
+
+
+def bin_prefix(outpath):
+    """
+    Function to find the prefix of the bin files of an output catalog
+
+    :param outpath: path to the output catalog, e.g. processed/KGiant.cat
+
+    :return: prefix of the bin files, e.g. processed/KGiant
+    """
+    outpath = outpath.rstrip('/')
+    return outpath[:-4] if outpath.endswith('.cat') else outpath
+
+
+def ingest(inpath, outpath, rsun=rsun_mw, vsun=vsun_mw, rmin=0., rmax=np.inf, edges=None, nbins=None,
+           binning='count', chunk_size=100000, rename=None, parallax_zero_point=0., nhist=2 ** 16,
+           dtype=np.float64):
+    """
+    Function to ingest a raw survey table into an input catalog of the fitter and its radial bins
+
+    :param inpath: path to a text table with a header line or to a catalog directory of raw columns
+    :param outpath: path to the output catalog directory
+    :param rsun: galactocentric position of the Sun (kpc)
+    :param vsun: galactocentric velocity of the Sun (km/s)
+    :param rmin: smallest galactocentric radius kept (kpc)
+    :param rmax: largest galactocentric radius kept (kpc)
+    :param edges: radial bin edges, overrides nbins
+    :param nbins: number of radial bins, None for no binning
+    :param binning: 'count' for equal numbers of stars, 'width' for equal widths
+    :param chunk_size: number of stars processed at once
+    :param rename: dictionary of further names of the raw columns, see raw_names
+    :param parallax_zero_point: zero point subtracted from the parallaxes (mas)
+    :param nhist: number of histogram bins of the streaming quantiles
+    :param dtype: dtype of the output catalogs, np.float32 halves their size
+
+    :return: paths to the output catalog and the bin catalogs, and the bin edges (None without binning)
+    """
+    if os.path.isdir(inpath):
+        chunks = catalog_chunks(Catalog(inpath), chunk_size)
+    else:
+        chunks = text_chunks(inpath, chunk_size)
+    meta = {'rsun': list(map(float, rsun)), 'vsun': list(map(float, vsun)), 'rmin': float(rmin),
+            'rmax': float(rmax), 'parallax_zero_point': float(parallax_zero_point), 'nread': 0}
+
+    # 1. transform the raw table chunk by chunk, accumulating the histogram of the radii
+    sketch = RadialSketch(rmin, rmax if np.isfinite(rmax) else 1000., nhist)
+    out = CatalogWriter(outpath, columns, dtype, source=inpath, meta=meta)
+    for chunk in chunks:
+        d, valid = transform_chunk(chunk, rsun, vsun, rename, parallax_zero_point)
+        r = np.sqrt(d['x'] ** 2. + d['y'] ** 2. + d['z'] ** 2.)
+        with np.errstate(invalid='ignore'):
+            keep = valid & (r >= rmin) & (r <= rmax)
+        out.append(d, keep)
+        sketch.add(r[keep])
+        meta['nread'] += len(keep)
+    out.close()
+
+    if edges is None and nbins is None:
+        return outpath, [], None
+    if edges is None:
+        edges = bin_edges(sketch, nbins, binning, rmin, rmax)
+    edges = np.asarray(edges, dtype=float)
+
+    # 2. split the output catalog into the bins, the last bin including its upper edge
+    prefix = bin_prefix(outpath)
+    cat = Catalog(outpath)
+    paths = ['%s_%d.cat' % (prefix, i) for i in range(len(edges) - 1)]
+    writers = [CatalogWriter(path, columns, dtype, source=outpath, meta=dict(meta, rmin=float(edges[i]),
+                                                                             rmax=float(edges[i + 1])))
+               for i, path in enumerate(paths)]
+    for chunk in catalog_chunks(cat, chunk_size):
+        r = np.sqrt(chunk['x'] ** 2. + chunk['y'] ** 2. + chunk['z'] ** 2.)
+        ibin = np.searchsorted(edges, r, side='right') - 1
+        ibin[r == edges[-1]] = len(edges) - 2
+        for i, w in enumerate(writers):
+            w.append(chunk, ibin == i)
+    counts = [w.nstars for w in writers]
+    for w in writers:
+        w.close()
+
+    np.savetxt(prefix + '_bin_edges.txt', np.column_stack([edges, counts + [0]]), fmt='%10.4f')
+    return outpath, paths, edges
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ingest a raw survey table into binned input catalogs.')
+    parser.add_argument('input', help='text table with a header line, or catalog directory, of raw columns')
+    parser.add_argument('output', help='output catalog directory, the bins are written next to it')
+    parser.add_argument('--rsun', type=float, nargs=3, default=rsun_mw, help='solar position (kpc)')
+    parser.add_argument('--vsun', type=float, nargs=3, default=vsun_mw, help='solar velocity (km/s)')
+    parser.add_argument('--rmin', type=float, default=0., help='smallest galactocentric radius kept (kpc)')
+    parser.add_argument('--rmax', type=float, default=np.inf, help='largest galactocentric radius kept (kpc)')
+    parser.add_argument('--edges', type=float, nargs='+', help='radial bin edges (kpc)')
+    parser.add_argument('--nbins', type=int, help='number of radial bins')
+    parser.add_argument('--binning', default='count', choices=['count', 'width'],
+                        help='equal numbers of stars or equal widths')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='number of stars processed at once')
+    parser.add_argument('--parallax-zero-point', type=float, default=0., help='subtracted from the parallaxes (mas)')
+    parser.add_argument('--rename', nargs='+', default=[], help='raw column names, e.g. rv=vhelio pmra=PMRA')
+    parser.add_argument('--float32', action='store_true', help='store the output catalogs in float32')
+    args = parser.parse_args()
+
+    rename = dict(item.split('=', 1) for item in args.rename)
+    outpath, paths, edges = ingest(args.input, args.output, args.rsun, args.vsun, args.rmin, args.rmax, args.edges,
+                                   args.nbins, args.binning, args.chunk_size, rename, args.parallax_zero_point,
+                                   dtype=np.float32 if args.float32 else np.float64)
+    print(outpath, Catalog(outpath).nstars, 'stars')
+    for i, path in enumerate(paths):
+        print('%-40s %8.2f - %8.2f kpc %8d stars' % (path, edges[i], edges[i + 1], Catalog(path).nstars))
@@ -0,0 +1,324 @@
+import numpy as np
+import argparse
+import json
+import os
+from multiprocessing import Pool
+from catalog import Catalog, columns, write_header
+from coord import spherical_to_cartesian
+from geometry import ReflexGeometry, kfac, reflex_vector, rsun_mw, vsun_mw
+from Reflex_fit_data import parameters
+"""
+Mock halo catalogs with a known reflex motion, in the 17-column input format of the fitter.
+
+The stars are drawn from a spherical halo with a power law density between rmin and rmax and Gaussian
+velocities of power law dispersion with a constant anisotropy beta,
+
+    rho(r) ~ r^-alpha,    sigma_r(r) = sigma (r / r0)^gamma,    sigma_phi = sigma_th = sigma_r sqrt(1 - beta)
+
+(beta = 0 for an isotropic halo). The reflex motion of the apex, v_travel and the bulk motion are added
+with the projection of the reflex model of the fitter, ReflexGeometry (as used by get_v), such that a fit
+to a mock without errors recovers the injected parameters up to the noise of the halo.
+
+The errors are those of Gaia DR3 for giants: the apparent magnitude G = M_G + 5 log10(d / 10 pc) of a
+star of absolute magnitude M_G ~ N(absmag, absmag_scatter) gives the parallax error
+sigma_plx = sqrt(40 + 800 z + 30 z^2) uas with z = 10^(0.4 (max(G, 13) - 15)), and the proper motion
+errors are pm_error times it (in mas/yr per mas), with a correlation drawn from N(corr, corr_scatter).
+The line-of-sight velocity errors are lognormal around evlos, and the distances have a lognormal error
+of relative width edist (as in distance.py). The galactocentric columns x..vz are computed from the
+observed values as in ingest.py.
+
+The stars are generated in chunks over a process pool, each chunk with its own random stream spawned
+from the seed of the mock, so a mock only depends on its seed and chunk size, not on the number of
+processes. Many mocks are made at once with make_mocks, whose mock i has the seed spawned as the
+i-th child of the given seed.
+
+Usage, for 1000 mocks of 1e4 stars in mocks/halo_0000.cat ... mocks/halo_0999.cat:
+
+python mock.py mocks/halo.cat --nstars 10000 --nmocks 1000 --seed 1 --beta 0.5 --vtravel 40
+"""
+
+# injected reflex and bulk motion, in the parameters of ReflexFit: the 50+ kpc bin of table2_results,
+# l = 38 deg, b = -37 deg (cos of the polar angle = sin b), v_travel = 40, vr, vphi, vth = -9, -24, 17 kms^-1
+default_truth = {'l': np.deg2rad(38.), 'b': np.sin(np.deg2rad(-37.)), 'vtravel': 40., 'vr': -9., 'vphi': -24.,
+                 'vth': 17.}
+
+# density and dispersion profile of the halo, radii in kpc and dispersions in kms^-1
+default_halo = {'rmin': 40., 'rmax': 150., 'alpha': 3.5, 'sigma': 85., 'r0': 50., 'gamma': 0., 'beta': 0.}
+
+# errors of the observables, see the module docstring
+default_errors = {'absmag': -1., 'absmag_scatter': 0.5, 'pm_error': 1., 'corr': 0.1, 'corr_scatter': 0.25,
+                  'evlos': 3., 'evlos_scatter': 0.5, 'edist': 0.1}
+
+# number of stars generated at once by a worker
+mock_chunk = 2 ** 16
+
+
+def halo_radii(rng, n, rmin, rmax, alpha):
+    """
+    Function to draw galactocentric radii of a power law density by inverting its cumulative distribution
+
+    :param rng: numpy random generator
+    :param n: number of stars
+    :param rmin: minimum radius (kpc)
+    :param rmax: maximum radius (kpc)
+    :param alpha: slope of the density, rho ~ r^-alpha
+
+    :return: array of n radii
+    """
+    u = rng.random(n)
+    k = 3. - alpha
+    if abs(k) < 1.e-8:
+        return rmin * (rmax / rmin) ** u
+    return (rmin ** k + u * (rmax ** k - rmin ** k)) ** (1. / k)
+
+
+def gaia_pm_error(G, pm_error=1.):
+    """
+    Function to compute the Gaia DR3 proper motion error as a function of the apparent magnitude
+
+    :param G: apparent G magnitude
+    :param pm_error: ratio of the proper motion error (mas/yr) to the parallax error (mas)
+
+    :return: proper motion error (mas/yr)
+    """
+    z = 10. ** (0.4 * (np.maximum(G, 13.) - 15.))
+    return pm_error * 1.e-3 * np.sqrt(40. + 800. * z + 30. * z ** 2.)
+
+
+def truth_cube(truth=None, halo=None):
+    """
+    Function to make the parameters of ReflexFit injected into a mock
+
+    :param truth: dictionary of the injected l, b, vtravel, vr, vphi, vth, see default_truth
+    :param halo: dictionary of the halo profile, see default_halo
+
+    :return: array of the 9 parameters, with the dispersions at r0 (the line-of-sight one taken as radial)
+    """
+    truth, halo = dict(default_truth, **(truth or dict())), dict(default_halo, **(halo or dict()))
+    sigt2 = halo['sigma'] ** 2. * (1. - halo['beta'])
+    return np.array([truth[name] for name in parameters[:6]] + [1. / halo['sigma'] ** 2., 1. / sigt2, 1. / sigt2])
+
+
+def _seed_sequence(seed):
+    """
+    Function to make the numpy SeedSequence of a seed
+
+    :param seed: int, None or numpy SeedSequence
+
+    :return: numpy SeedSequence
+    """
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def mock_seed(path):
+    """
+    Function to read the seed of a mock catalog made by make_mocks
+
+    :param path: path of the catalog directory
+
+    :return: numpy SeedSequence, such that mock_array with it gives the stars of the catalog
+    """
+    seed = Catalog(path).meta['seed']
+    return np.random.SeedSequence(seed['entropy'], spawn_key=seed['spawn_key'])
+
+
+def mock_chunk_columns(n, seed, truth=None, halo=None, errors=None, rsun=rsun_mw, vsun=vsun_mw):
+    """
+    Function to generate the columns of a chunk of mock stars
+
+    :param n: number of stars
+    :param seed: seed of the chunk (int or numpy SeedSequence)
+    :param truth: dictionary of the injected parameters, see default_truth
+    :param halo: dictionary of the halo profile, see default_halo
+    :param errors: dictionary of the errors, see default_errors
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+
+    :return: dictionary of the columns of catalog.columns
+    """
+    truth, halo = dict(default_truth, **(truth or dict())), dict(default_halo, **(halo or dict()))
+    errors = dict(default_errors, **(errors or dict()))
+    rng = np.random.default_rng(seed)
+    rsun, vsun = np.asarray(rsun, dtype=float), np.asarray(vsun, dtype=float)
+
+    # 1. positions of the halo, isotropic around the galactic centre
+    r = halo_radii(rng, n, halo['rmin'], halo['rmax'], halo['alpha'])
+    cost = rng.uniform(-1., 1., n)
+    phi = rng.uniform(-np.pi, np.pi, n)
+    rsint = r * np.sqrt(1. - cost ** 2.)
+    rgal = np.column_stack([rsint * np.cos(phi), rsint * np.sin(phi), r * cost])
+    geom = ReflexGeometry(rgal, rsun, vsun)
+
+    # 2. velocities in the galactocentric spherical basis, with the bulk motion, and the reflex velocity
+    q = np.empty((6, n))
+    q[:3] = reflex_vector(truth['l'], np.arccos(truth['b']), truth['vtravel'], 0., 0., 0.)[:3, None]
+    sigr = halo['sigma'] * (r / halo['r0']) ** halo['gamma']
+    q[3:] = rng.standard_normal((3, n)) * sigr
+    q[4:] *= np.sqrt(1. - halo['beta'])
+    q[3:] += np.array([truth['vr'], truth['vphi'], truth['vth']])[:, None]
+
+    # 3. observables of the model, proj @ q - offset star by star
+    obs = np.einsum('onk,kn->on', geom.proj, q)
+    obs -= geom.offset
+    vlos, mul, mub = obs
+
+    # 4. errors
+    dist = geom.dist * np.exp(errors['edist'] * rng.standard_normal(n))
+    G = rng.normal(errors['absmag'], errors['absmag_scatter'], n) + 5. * np.log10(100. * geom.dist)
+    emu = gaia_pm_error(G, errors['pm_error'])
+    corr = np.clip(rng.normal(errors['corr'], errors['corr_scatter'], n), -0.9, 0.9)
+    evlos = errors['evlos'] * np.exp(errors['evlos_scatter'] * rng.standard_normal(n))
+    z = rng.standard_normal((3, n))
+    vlos += evlos * z[0]
+    mul += emu * z[1]
+    mub += emu * (corr * z[1] + np.sqrt(1. - corr ** 2.) * z[2])
+
+    # 5. galactocentric columns from the observed values, with the conventions of ingest.transform_chunk
+    fac = kfac * dist
+    rcart, vcart = spherical_to_cartesian(dist, geom.l, geom.th, vlos, fac * mul, -fac * mub)
+    rcart += rsun[:, None]
+    vcart += vsun[:, None]
+    values = [rcart[0], rcart[1], rcart[2], vcart[0], vcart[1], vcart[2], np.rad2deg(geom.l) % 360.,
+              90. - np.rad2deg(geom.th), dist, vlos, mul, mub, errors['edist'] * dist, evlos, emu, emu, corr]
+    return dict(zip(columns, values))
+
+
+def mock_array(nstars, seed=None, truth=None, halo=None, errors=None, rsun=rsun_mw, vsun=vsun_mw,
+               chunk_size=mock_chunk):
+    """
+    Function to generate a mock catalog in memory, e.g. for ReflexFit(mock_array(...))
+
+    :param nstars: number of stars
+    :param seed: seed of the mock (int or numpy SeedSequence, see mock_seed)
+    :param truth: dictionary of the injected parameters, see default_truth
+    :param halo: dictionary of the halo profile, see default_halo
+    :param errors: dictionary of the errors, see default_errors
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+    :param chunk_size: number of stars per chunk, the stars are those of make_mock with the same chunk size
+
+    :return: array of shape (nstars, 17)
+    """
+    starts = range(0, nstars, chunk_size)
+    seeds = _seed_sequence(seed).spawn(len(starts))
+    d = np.empty((nstars, len(columns)))
+    for start, s in zip(starts, seeds):
+        chunk = mock_chunk_columns(min(chunk_size, nstars - start), s, truth, halo, errors, rsun, vsun)
+        for i, name in enumerate(columns):
+            d[start:start + chunk_size, i] = chunk[name]
+    return d
+
+
+def _mock_worker(args):
+    """
+    Function to generate one chunk of a mock and write it to the preallocated catalog
+
+    :param args: (catalog path, start, stop, seed, truth, halo, errors, rsun, vsun)
+
+    :return: number of stars in the chunk
+    """
+    path, start, stop, seed, truth, halo, errors, rsun, vsun = args
+    chunk = mock_chunk_columns(stop - start, seed, truth, halo, errors, rsun, vsun)
+    out = Catalog(path, mmap_mode='r+')
+    for name in columns:
+        out[name][start:stop] = chunk[name]
+        out[name].flush()
+    return stop - start
+
+
+def mock_paths(path, nmocks):
+    """
+    Function to name the catalogs of a set of mocks
+
+    :param path: path of the catalog directory, the mocks are numbered before its suffix
+    :param nmocks: number of mocks, a single mock is written to path
+
+    :return: list of paths
+    """
+    if nmocks == 1:
+        return [path]
+    stem, ext = os.path.splitext(path.rstrip('/'))
+    return ['%s_%04d%s' % (stem, i, ext) for i in range(nmocks)]
+
+
+def make_mocks(path, nstars, nmocks=1, seed=None, truth=None, halo=None, errors=None, rsun=rsun_mw, vsun=vsun_mw,
+               chunk_size=mock_chunk, nproc=None):
+    """
+    Function to generate mock catalogs over a process pool
+
+    :param path: path of the catalog directory, see mock_paths
+    :param nstars: number of stars per mock
+    :param nmocks: number of mocks
+    :param seed: seed of the set of mocks (int or numpy SeedSequence), mock i is seeded by its i-th spawned child
+    :param truth: dictionary of the injected parameters, see default_truth
+    :param halo: dictionary of the halo profile, see default_halo
+    :param errors: dictionary of the errors, see default_errors
+    :param rsun: position of the sun in the galactocentric frame (kpc)
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1)
+    :param chunk_size: number of stars per chunk
+    :param nproc: number of processes, defaults to the number of cores
+
+    :return: list of the paths of the catalogs
+
+    :note: the header meta of each catalog records rsun, vsun (see catalog.catalog_solar), the injected
+        parameters of ReflexFit (truth_cube), the settings and the seed, and mock_array(nstars, mock_seed(path))
+        gives the same stars in memory
+    """
+    truth, halo = dict(default_truth, **(truth or dict())), dict(default_halo, **(halo or dict()))
+    errors = dict(default_errors, **(errors or dict()))
+    rsun, vsun = np.asarray(rsun, dtype=float), np.asarray(vsun, dtype=float)
+    paths = mock_paths(path, nmocks)
+    root = _seed_sequence(seed)
+
+    # 1. preallocated catalogs, filled chunk by chunk by the workers
+    tasks = []
+    for p, s in zip(paths, root.spawn(nmocks)):
+        os.makedirs(p, exist_ok=True)
+        for name in columns:
+            np.lib.format.open_memmap(os.path.join(p, name + '.npy'), mode='w+', dtype=np.float64, shape=(nstars,))
+        meta = {'rsun': rsun.tolist(), 'vsun': vsun.tolist(), 'truth': dict(zip(parameters, truth_cube(truth, halo)
+                                                                                .tolist())),
+                'halo': halo, 'errors': errors, 'seed': {'entropy': s.entropy, 'spawn_key': list(s.spawn_key)},
+                'chunk_size': chunk_size}
+        write_header(p, columns, nstars, np.float64, source='mock.py', meta=meta)
+        starts = range(0, nstars, chunk_size)
+        tasks += [(p, start, min(start + chunk_size, nstars), c, truth, halo, errors, rsun, vsun)
+                  for start, c in zip(starts, s.spawn(len(starts)))]
+
+    # 2. chunks of all mocks over one pool
+    if nproc is None:
+        nproc = os.cpu_count()
+    if nproc <= 1 or len(tasks) == 1:
+        for task in tasks:
+            _mock_worker(task)
+    else:
+        with Pool(min(nproc, len(tasks))) as pool:
+            for n in pool.imap_unordered(_mock_worker, tasks, chunksize=max(1, len(tasks) // (4 * nproc))):
+                pass
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate mock halo catalogs with a known reflex motion.')
+    parser.add_argument('output', help='path of the output catalog directory')
+    parser.add_argument('--nstars', type=float, default=1.e4, help='number of stars per mock')
+    parser.add_argument('--nmocks', type=int, default=1, help='number of mocks, numbered output_0000.cat ...')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the set of mocks')
+    for name, value in list(default_truth.items()) + list(default_halo.items()) + list(default_errors.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=float, default=value, help='default %g' % value)
+    parser.add_argument('--rsun', type=float, nargs=3, default=rsun_mw, help='solar position (kpc)')
+    parser.add_argument('--vsun', type=float, nargs=3, default=vsun_mw, help='solar velocity (km/s)')
+    parser.add_argument('--chunk-size', type=int, default=mock_chunk, help='number of stars per chunk')
+    parser.add_argument('--nproc', type=int, default=None, help='number of processes')
+    args = parser.parse_args()
+
+    settings = vars(args)
+    paths = make_mocks(args.output, int(args.nstars), args.nmocks, args.seed,
+                       truth={name: settings[name] for name in default_truth},
+                       halo={name: settings[name] for name in default_halo},
+                       errors={name: settings[name] for name in default_errors},
+                       rsun=args.rsun, vsun=args.vsun, chunk_size=args.chunk_size, nproc=args.nproc)
+    with open(paths[0].rstrip('/') + '/' + 'catalog.json') as f:
+        print(json.dumps(json.load(f)['meta'], indent=2))
+    print('wrote %d mocks of %d stars to %s' % (len(paths), int(args.nstars), ', '.join(paths[:3]) +
+                                                (' ...' if len(paths) > 3 else '')))
@@ -0,0 +1,395 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import math
+import os
+from multiprocessing import Pool
+from Reflex_fit_data import ReflexFit, FitResult, Prior, batch_elements
+from catalog import Catalog, load_catalog
+from circstats import circular_median, circular_percentile_widths, weighted_percentile
+from correct_reflex import assign_bins
+from read_posterior import chain_file, get_binned_fit_medians, read_chain_text
+"""
+Fit all radial bins of a catalog from a single load of the data.
+
+The stars are read and their geometry (see geometry.py) computed once for the full catalog, and each
+bin is a subset of it. The bins can be fitted independently, in parallel over a process pool, or
+jointly with smooth radial profiles of the apex and travel velocity,
+
+    l_apex(r) = l0 + dl * x,   cos(b_apex)(r) = cosb0 + dcosb * x,   v_travel(r) = vtravel0 + dvtravel * x
+
+with x = ln(r / r_ref), and a single bulk motion and velocity dispersion for all stars.
+
+Usage, for the bins of the binned_sgr_4bin catalogs (whose correlation column is the last one):
+
+python multibin.py processed_real/binned_sgr_4bin/KG/KGiant_edr3_metal_sgr_20.txt chains/KG/ \
+    --edges processed_real/binned_sgr_4bin/KG/KGiant_edr3_metal_sgr_20_bin_edges.txt --alias corr=col22
+
+and with --joint for the radial profile fit. The per-bin results are written to chains/KG/bin0- ...,
+and the profile fit to chains/KG/joint-.
+"""
+
+
+def bin_prefixes(prefix, nbins):
+    """
+    Function to name the output prefixes of the bins
+
+    :param prefix: prefix of the output files
+    :param nbins: number of bins
+
+    :return: list of prefixes
+    """
+    return ['%sbin%d-' % (prefix, i) for i in range(nbins)]
+
+
+def _fit_worker(args):
+    """
+    Function to fit a single bin, to be called by the process pool
+
+    :param args: (ReflexFit of the bin, prefix, sampler settings)
+
+    :return: (prefix, FitResult or error message)
+    """
+    fit, prefix, settings = args
+    try:
+        return prefix, fit.run(prefix, **settings)
+    except (Exception, SystemExit) as e:
+        # pymultinest calls sys.exit on errors, which would otherwise take down the pool worker
+        return prefix, 'failed: %r' % e
+
+
+class BinnedFit:
+    """
+    Class holding a catalog split into radial bins, with the geometry of the stars computed once
+
+    :param data: path, array or Catalog of the stars, see ReflexFit
+    :param edges: galactocentric radial bin edges (Nbins+1), kpc, or the path to a _bin_edges file
+    :param layout: layout of a text input file, see ReflexFit
+    :param alias: dictionary of column aliases, e.g. {'corr': 'col22'}, see Catalog.alias
+    :param dtype: dtype of the stored data and geometry, np.float32 for the compact mode of ReflexFit
+    :param rsun: position of the sun in the galactocentric frame (kpc), see ReflexFit
+    :param vsun: motion of the sun in the galactocentric frame (kms^-1), see ReflexFit
+    """
+
+    def __init__(self, data, edges, layout='auto', alias=None, dtype=np.float64, rsun=None, vsun=None):
+        if isinstance(data, str):
+            data = load_catalog(data, layout)
+        elif not isinstance(data, Catalog):
+            data = Catalog.from_array(np.asarray(data, dtype=float))
+        for name, column in (alias or dict()).items():
+            data.alias(name, column)
+        if isinstance(edges, str):
+            edges = load_catalog(edges).array()[:, 0]
+        self.edges = np.asarray(edges, dtype=float)
+
+        # 1. geometry of all stars, once
+        self.fit = ReflexFit(data, dtype=dtype, rsun=rsun, vsun=vsun)
+        self.r = np.linalg.norm(self.fit.rgal.astype(float), axis=1)
+        self.ibin = assign_bins(self.r, self.edges)
+
+        # 2. the bins are subsets of the full fit
+        self.nbins = len(self.edges) - 1
+        self.bins = [self.fit.subset(self.ibin == i) for i in range(self.nbins)]
+        self.midpoints = np.array([np.median(self.r[self.ibin == i]) if np.any(self.ibin == i) else np.nan
+                                   for i in range(self.nbins)])
+
+    def run(self, prefix, nproc=None, **settings):
+        """
+        Function to fit the bins independently
+
+        :param prefix: prefix of the output files, the bins are written to prefixbin0-, prefixbin1-, ...
+        :param nproc: number of processes, defaults to one per bin up to the number of cores
+        :param settings: sampler settings, see ReflexFit.run
+
+        :return: list of FitResult (or error messages) of the bins
+        """
+        if nproc is None:
+            nproc = min(os.cpu_count(), self.nbins)
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        tasks = [(fit, p, settings) for fit, p in zip(self.bins, bin_prefixes(prefix, self.nbins))]
+        if nproc <= 1:
+            results = dict(_fit_worker(task) for task in tasks)
+        else:
+            with Pool(nproc) as pool:
+                results = dict(pool.imap_unordered(_fit_worker, tasks))
+        return [results[p] for p in bin_prefixes(prefix, self.nbins)]
+
+    def results(self, prefix):
+        """
+        Function to summarise the fits of the bins in the format of genreflex.table2_results
+
+        :param prefix: prefix of the output files
+
+        :return: M, Eu, Ed, each of shape (Nbins, 9), and the median radius of the stars of each bin
+        """
+        M, Eu, Ed = np.array([get_binned_fit_medians(p) for p in bin_prefixes(prefix, self.nbins)]).transpose(1, 0, 2)
+        return M, Eu, Ed, self.midpoints
+
+
+def RadialPrior(cube):
+    """
+    Function to define the prior for the parameters of the radial profile fit
+
+    :param cube: Multinest hypercube (1xNparam)
+
+    :note: the prior parameters and ranges are defined as follows:
+    :note: [0] -pi < l0 < pi (rad), [1] -pi < dl < pi (rad per e-fold in radius)
+    :note: [2] -1 < cosb0 < 1, [3] -1 < dcosb < 1 (per e-fold in radius)
+    :note: [4] 0 < vtravel0 < 150, [5] -100 < dvtravel < 100 (kms^-1, per e-fold in radius)
+    :note: [6,7,8] -250 < vr,vphi,vth < 250 (kms^-1)
+    :note: [9,10,11] precisions of the velocity dispersions, as in Prior
+    """
+    cube[1] = -np.pi + cube[1] * 2. * np.pi  # dl
+    cube[3] = -1. + cube[3] * 2.  # dcosb
+    cube[5] = -100. + cube[5] * 200.  # dvtravel
+    # the other parameters follow Prior, with the slopes taken out
+    cube[[0, 2, 4, 6, 7, 8, 9, 10, 11]] = Prior(cube[[0, 2, 4, 6, 7, 8, 9, 10, 11]])
+    return cube
+
+
+class RadialProfileFit:
+    """
+    Class holding a joint fit of all stars with radial profiles of the apex and travel velocity
+
+    :param fit: ReflexFit of the stars
+    :param r_ref: reference radius of the profiles (kpc), defaults to the median radius of the stars
+
+    :note: the instance provides the model interface of the samplers in samplers.py
+    """
+
+    parameters = ['l0', 'dl', 'cosb0', 'dcosb', 'vtravel0', 'dvtravel', 'vr', 'vphi', 'vth',
+                  'sigvlos', 'sigmul', 'sigmub']
+    n_params = len(parameters)
+    Prior = staticmethod(RadialPrior)
+
+    def __init__(self, fit, r_ref=None):
+        self.fit = fit
+        r = np.linalg.norm(fit.rgal, axis=1)
+        self.r_ref = float(np.median(r)) if r_ref is None else float(r_ref)
+        self.x = np.log(r / self.r_ref)
+
+    @staticmethod
+    def BatchPrior(cubes):
+        """
+        Function to apply the prior to a set of points of the unit hypercube at once
+
+        :param cubes: points of the unit hypercube (n_points x Nparam)
+
+        :return: parameters of shape (n_points x Nparam)
+        """
+        return RadialPrior(np.array(cubes, dtype=float).T).T
+
+    def profiles(self, cubes, x):
+        """
+        Function to compute the apex and travel velocity at a set of radii
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+        :param x: ln(r / r_ref) of the radii
+
+        :return: lapex, bapex (polar angle) and vtravel, each of shape (len(x), n_points)
+        """
+        c = np.atleast_2d(cubes).T
+        lapex = c[0] + c[1] * x[:, None]
+        bapex = np.arccos(np.clip(c[2] + c[3] * x[:, None], -1., 1.))
+        vtravel = np.maximum(c[4] + c[5] * x[:, None], 0.)
+        return lapex, bapex, vtravel
+
+    def _block_loglike(self, c, s):
+        """
+        Function to compute the summed log likelihood of a block of stars, see ReflexFit._block_gaussian
+
+        :param c: parameters after the prior (Nparam, n_points)
+        :param s: slice of the stars of the block
+
+        :return: array of n_points log likelihoods of the block, summed in float64
+        """
+        fit = self.fit
+        proj, offset = fit.geom.proj[:, s], fit.geom.offset[:, s]
+        clock = fit.clock
+        if clock is not None:
+            clock.start()
+
+        # 1. reflex motion of each star along its own apex, of shape (3, block, n_points)
+        lapex, bapex, vtravel = self.profiles(c.T, self.x[s])
+        sinb = np.sin(bapex)
+        reflex = (-vtravel * np.array([sinb * np.cos(lapex), sinb * np.sin(lapex), np.cos(bapex)])).astype(fit.dtype)
+        bulk = c[6:9].astype(fit.dtype)
+        if clock is not None:
+            clock.lap('rotation')
+
+        # 2. residuals of the observables from the reflex motion of each star and the common bulk motion
+        rv, kl, kb = [data[s, None] + offset[k, :, None] - np.einsum('nj,jnm->nm', proj[k, :, :3], reflex) -
+                      np.dot(proj[k, :, 3:], bulk) for k, data in enumerate([fit.vlos, fit.mul, fit.mub])]
+        if clock is not None:
+            clock.lap('projection')
+        return fit._block_gaussian(c[9:12].astype(fit.dtype), rv, kl, kb, s)
+
+    def BatchLogLikelihood(self, cubes):
+        """
+        Function to compute the log likelihood of a set of parameter vectors at once
+
+        :param cubes: parameters after the prior (n_points x Nparam)
+
+        :return: lnptot, array of n_points total log likelihoods
+
+        :note: the blocks of stars, threads and dtype are those of the ReflexFit, see ReflexFit._batch_loglike
+        """
+        fit = self.fit
+        cube = np.atleast_2d(cubes).T
+        lnptot = np.empty(cube.shape[1])
+        block = max(1, batch_elements // min(fit.nstars, fit.block_size))
+        for start in range(0, len(lnptot), block):
+            c = cube[:, start:start + block]
+            partial = np.array(fit._map_blocks(lambda s: self._block_loglike(c, s)))
+            lnptot[start:start + block] = [math.fsum(col) for col in partial.T]
+        lnptot[np.isinf(lnptot)] = 1.e-160
+        return lnptot
+
+    def LogLikelihood(self, cube):
+        """
+        Function to compute the log likelihood of the model given the data
+
+        :param cube: Multinest hypercube (1xNparam)
+
+        :return: lnptot, the total log likelihood
+        """
+        return self.BatchLogLikelihood(np.asarray(cube)[None, :])[0]
+
+    def LogLikelihoodGradient(self, cube):
+        """
+        Function to compute the log likelihood and its gradient with respect to the parameters
+
+        :param cube: parameters after the prior (1xNparam)
+
+        :return: lnptot, the total log likelihood, and its gradient of shape (Nparam,)
+
+        :note: each star has its own reflex vector, so the derivatives with respect to its apex and travel
+            velocity, see ReflexFit.LogLikelihoodGradient, are summed over the stars with the weights 1 and x
+            of the profiles. The clipped profiles have a zero derivative.
+        """
+        fit = self.fit
+        c = np.asarray(cube, dtype=float)
+
+        def block(s):
+            x = self.x[s]
+            proj = fit.geom.proj[:, s].astype(float)
+
+            # 1. apex and travel velocity of each star, clipped as in profiles
+            lapex = c[0] + c[1] * x
+            cosb = c[2] + c[3] * x
+            vtravel = c[4] + c[5] * x
+            free_cosb, free_vtravel = np.abs(cosb) < 1., vtravel > 0.
+            cosb, vtravel = np.clip(cosb, -1., 1.), np.maximum(vtravel, 0.)
+            # the derivative with respect to cos(b_apex) diverges at the poles
+            sinb = np.maximum(np.sqrt(1. - cosb ** 2.), 1.e-8)
+            apex = np.array([sinb * np.cos(lapex), sinb * np.sin(lapex), cosb])
+
+            # 2. residuals and derivatives per star, see ReflexFit._block_score
+            obs = np.array([fit.vlos[s], fit.mul[s], fit.mub[s]], dtype=float)
+            model = np.einsum('knj,jn->kn', proj[:, :, :3], -vtravel * apex) + np.dot(proj[:, :, 3:], c[6:9])
+            rv, kl, kb = obs - model + fit.geom.offset[:, s]
+            lnp, w, dprec = fit._block_score(c[9:12], rv, kl, kb, s)
+            greflex = np.einsum('kn,knj->jn', w, proj[:, :, :3])
+
+            # 3. chain rule through the reflex vector of each star and the profiles
+            dl = -vtravel * sinb * (greflex[1] * np.cos(lapex) - greflex[0] * np.sin(lapex))
+            dcosb = -vtravel * (greflex[2] - cosb / sinb * (greflex[0] * np.cos(lapex) + greflex[1] * np.sin(lapex)))
+            dcosb *= free_cosb
+            dvtravel = -np.sum(greflex * apex, axis=0) * free_vtravel
+            g = np.zeros(self.n_params)
+            g[:6] = [np.sum(dl), np.dot(dl, x), np.sum(dcosb), np.dot(dcosb, x), np.sum(dvtravel), np.dot(dvtravel, x)]
+            g[6:9] = np.einsum('kn,knj->j', w, proj[:, :, 3:])
+            g[9:] = dprec
+            return lnp, g
+
+        lnp, grad = zip(*fit._map_blocks(block))
+        return math.fsum(lnp), np.sum(grad, axis=0)
+
+    def fingerprint(self):
+        """
+        Function to compute a hash of the data and reference radius the likelihood depends on
+
+        :return: hexadecimal sha256 hash
+        """
+        return hashlib.sha256(('%s %r' % (self.fit.fingerprint(), self.r_ref)).encode()).hexdigest()
+
+    def run(self, prefix, sampler='multinest', resume=True, **kwargs):
+        """
+        Function to run the sampler
+
+        :param prefix: prefix for the sampler output files
+        :param sampler: name of the sampler backend, one of samplers.backends
+        :param resume: if True, resume from the output files of a previous run, see ReflexFit.run
+        :param kwargs: sampler settings, see samplers.py
+
+        :return: FitResult
+        """
+        import samplers
+
+        result = samplers.run(self, prefix, sampler, resume, **kwargs)
+        if samplers.mpi_rank() == 0:
+            with open('%sparams.json' % prefix, 'w') as f:
+                json.dump(self.parameters + ['r_ref=%g' % self.r_ref], f, indent=2)
+        return FitResult(result['samples'], result['logZ'], result['logZerr'], prefix, self.parameters)
+
+    def results(self, prefix, radii):
+        """
+        Function to summarise the radial profiles at a set of radii in the format of genreflex.table2_results
+
+        :param prefix: prefix of the sampler output files
+        :param radii: galactocentric radii (kpc)
+
+        :return: M, Eu, Ed of shape (len(radii), 3) for l_apex, b_apex (deg) and v_travel, and the radii
+        """
+        samples = read_chain_text(chain_file(prefix))[:, :self.n_params]
+        radii = np.asarray(radii, dtype=float)
+        lapex, bapex, vtravel = self.profiles(samples, np.log(radii / self.r_ref))
+        b = 90. - np.rad2deg(bapex)
+
+        M, Eu, Ed = np.zeros((3, len(radii), 3))
+        for i in range(len(radii)):
+            M[i, 0] = np.rad2deg(circular_median(lapex[i]))
+            Eu[i, 0], Ed[i, 0] = np.rad2deg(circular_percentile_widths(lapex[i], r=vtravel[i]))
+            for j, x in [(1, b[i]), (2, vtravel[i])]:
+                p14, p50, p86 = weighted_percentile(x, [14., 50., 86.])
+                M[i, j], Eu[i, j], Ed[i, j] = p50, p86 - p50, p50 - p14
+        return M, Eu, Ed, radii
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit the radial bins of a catalog from a single load of the data.')
+    parser.add_argument('input', help='input file or catalog directory of all stars')
+    parser.add_argument('prefix', help='prefix of the output files')
+    parser.add_argument('--edges', required=True, help='file of radial bin edges (first column)')
+    parser.add_argument('--alias', nargs='*', default=[], help='column aliases name=column, e.g. corr=col22')
+    parser.add_argument('--joint', action='store_true', help='fit radial profiles to all bins jointly')
+    parser.add_argument('--sampler', default='multinest', help='sampler backend')
+    parser.add_argument('--n-live-points', type=int, default=None, help='number of live points')
+    parser.add_argument('--nproc', type=int, default=None, help='number of processes for the bins')
+    parser.add_argument('--float32', action='store_true', help='store the data and geometry in float32')
+    parser.add_argument('--rsun', type=float, nargs=3, default=None, help='solar position (kpc)')
+    parser.add_argument('--vsun', type=float, nargs=3, default=None, help='solar velocity (km/s)')
+    args = parser.parse_args()
+
+    settings = dict(sampler=args.sampler)
+    if args.n_live_points is not None:
+        settings['n_live_points'] = args.n_live_points
+    binned = BinnedFit(args.input, args.edges, alias=dict(a.split('=') for a in args.alias),
+                       dtype=np.float32 if args.float32 else np.float64, rsun=args.rsun, vsun=args.vsun)
+
+    if args.joint:
+        joint = RadialProfileFit(binned.fit.subset(binned.ibin >= 0))
+        print(joint.run(args.prefix + 'joint-', **settings))
+        M, Eu, Ed, radii = joint.results(args.prefix + 'joint-', binned.midpoints)
+        names = ['l', 'b', 'vtravel']
+    else:
+        for p, result in zip(bin_prefixes(args.prefix, binned.nbins), binned.run(args.prefix, args.nproc, **settings)):
+            print(p, result if isinstance(result, str) else 'done')
+        M, Eu, Ed, radii = binned.results(args.prefix)
+        names = ['l', 'b', 'vtravel', 'vr', 'vphi', 'vth', 'sigvlos', 'sigmul', 'sigmub']
+
+    print()
+    print('%8s ' % 'r' + ' '.join('%16s' % name for name in names))
+    for i, r in enumerate(radii):
+        print('%8.2f ' % r + ' '.join('%6.1f +%4.1f -%4.1f' % (M[i, j], Eu[i, j], Ed[i, j]) for j in range(len(names))))
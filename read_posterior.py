@@ -1,14 +1,64 @@
 import numpy as np
+import io
+import os
+import re
+from catalog import Catalog, save_catalog
+from circstats import circular_median, circular_mode, shift_angles, weighted_percentile
 
 
-def read_posterior(infile, raw=False, cosb=True):
+# MultiNest writes exponents of three digits without the E, e.g. 0.1234-104
+fortran_exponent = re.compile(r'(\d)([+-]\d{3})')
+
+
+def chain_file(infile, raw=False):
+    """
+    Function to find the chain file of a pyMultinest output prefix
+
+    :param infile: prefix of the pyMultinest output files
+    :param raw: if True, the raw weighted chain, otherwise the equally weighted posterior samples
+
+    :return: path to the chain file
+    """
     if raw == True:
-        I = np.genfromtxt((infile + '.txt'))
-        I = I[:, 2:]
-    else:
-        I = np.genfromtxt((infile + 'post_equal_weights.dat'))
+        return infile + '.txt'
+    return infile + 'post_equal_weights.dat'
+
+
+def read_chain_text(fname):
+    """
+    Function to read a MultiNest chain text file
 
+    :param fname: path to the chain file
+
+    :return: array of shape (Nsamples, Ncols)
+    """
+    try:
+        return np.loadtxt(fname, ndmin=2)
+    except ValueError:
+        with open(fname) as f:
+            text = fortran_exponent.sub(r'\1E\2', f.read())
+        return np.loadtxt(io.StringIO(text), ndmin=2)
+
+
+def derived_parameters(I, raw=False, cosb=True):
+    """
+    Function to convert a chain to the derived parameters
+
+    :param I: chain array of shape (Nsamples, Ncols)
+    :param raw: if True, the raw chain with the weights and -2 log likelihood in the first two columns,
+        otherwise the equally weighted samples with the log likelihood in the last column
+    :param cosb: if True, the second parameter is cos(b_apex)
+
+    :return: dictionary of the parameters in degrees and km/s, with the loglike (and weights if raw)
+    """
     P = dict()
+    if raw == True:
+        P['weights'] = I[:, 0]
+        P['loglike'] = -0.5 * I[:, 1]
+        I = I[:, 2:]
+    elif I.shape[1] > 9:
+        P['loglike'] = I[:, 9]
+
     P['l'] = np.rad2deg(I[:, 0])
     if cosb == True:
         P['b'] = 90 - np.rad2deg(np.arccos(I[:, 1]))
@@ -26,6 +76,56 @@ def read_posterior(infile, raw=False, cosb=True):
 
     return P
 
+
+def load_chain(infile, raw=False, cosb=True, cache=True):
+    """
+    Function to load the derived parameters of a chain, through a binary cache next to the chain file
+
+    :param infile: prefix of the pyMultinest output files
+    :param raw: if True, the raw weighted chain, otherwise the equally weighted posterior samples
+    :param cosb: if True, the second parameter is cos(b_apex)
+    :param cache: if True, read and write the cache
+
+    :return: dictionary of memory-mapped parameters, see derived_parameters
+
+    :note: the cache is a catalog directory (see catalog.py) named after the chain file with a .cat
+        suffix, and is remade when the modification time or size of the chain file changes
+    """
+    fname = chain_file(infile, raw)
+    stat = os.stat(fname)
+    key = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'raw': bool(raw), 'cosb': bool(cosb)}
+    cachepath = fname + '.cat'
+
+    if cache and os.path.isdir(cachepath):
+        try:
+            cat = Catalog(cachepath, mmap_mode='c')
+            if cat.meta == key:
+                return {name: cat[name] for name in cat.names}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    P = derived_parameters(read_chain_text(fname), raw, cosb)
+    if cache:
+        try:
+            save_catalog(cachepath, np.column_stack(list(P.values())), names=list(P), source=fname, meta=key)
+        except OSError:
+            # e.g. a read-only chains directory, the chain is still returned
+            pass
+    return P
+
+
+def read_posterior(infile, raw=False, cosb=True):
+    """
+    Function to read the posterior of a fit
+
+    :param infile: prefix of the pyMultinest output files
+    :param raw: if True, the raw weighted chain, otherwise the equally weighted posterior samples
+    :param cosb: if True, the second parameter is cos(b_apex)
+
+    :return: dictionary of the parameters in degrees and km/s, with the loglike (and weights if raw)
+    """
+    return load_chain(infile, raw, cosb)
+
 def print_posterior(P):
     params = ["l", "b", "vtravel", "vr", "vphi", "vth", "sigvlos",
               "sigmul", "sigmub"]
@@ -43,6 +143,8 @@ def print_posterior(P):
 def get_binned_fit_medians(infile, raw=False, cosb=True):
 
     P = read_posterior(infile, raw, cosb)
+    # sample weights of the raw chains, None for equally weighted samples
+    weights = P.get('weights')
 
     M = np.zeros(9)
     Eu = np.zeros(9)
@@ -53,12 +155,11 @@ def get_binned_fit_medians(infile, raw=False, cosb=True):
     
     for j in range(9):
         if j==0:
-            M[j] = np.nanmedian(P[params[j]])
-
             l_samples = np.deg2rad(P[params[j]]) #in degrees
             v_samples = P[params[j+2]]
 
-            func = shift_samples(v_samples, l_samples)
+            M[j] = np.rad2deg(circular_median(l_samples, weights))
+            func = shift_samples(v_samples, l_samples, weights=weights)
             Eu[j] = func[0]
             Ed[j] = func[1]
 
@@ -66,56 +167,38 @@ def get_binned_fit_medians(infile, raw=False, cosb=True):
             b_samples = np.deg2rad(P[params[j]]) #in degrees
             v_samples = P[params[j+1]]
 
-            func = shift_samples(v_samples, b_samples)
-            M[j] = np.nanmedian(P[params[j]])
+            func = shift_samples(v_samples, b_samples, weights=weights)
+            M[j] = weighted_percentile(P[params[j]], 50., weights)
             Eu[j] = func[0]
             Ed[j] = func[1]
 
         else:
 
-            M[j] = np.nanmedian(P[params[j]])
-            Eu[j] = np.abs(np.nanpercentile(P[params[j]],86.)-np.nanpercentile(P[params[j]],50.))
-            Ed[j] = np.abs(np.nanpercentile(P[params[j]],14.)-np.nanpercentile(P[params[j]],50.))
+            p14, p50, p86 = weighted_percentile(P[params[j]], [14., 50., 86.], weights)
+            M[j] = p50
+            Eu[j] = np.abs(p86 - p50)
+            Ed[j] = np.abs(p14 - p50)
 
 
     return M, Eu, Ed
 
-def shift_samples(r, theta, all=None):
+def shift_samples(r, theta, all=None, weights=None):
+    """
+    Function to compute the widths of the posterior of a wrapped angle
 
-    th_shift  = np.zeros_like(r)
+    :param r: radial coordinate of the samples (v_travel)
+    :param theta: angle samples (rad)
+    :param all: if True, return the shifted samples instead of the widths
+    :param weights: sample weights, None for equally weighted samples
 
-    #shift angle by the bin with the largest number of samples.
-    N, edges = np.histogram(theta[~np.isnan(theta)], bins=np.linspace(-np.pi,np.pi, 37))
-    centres = (edges[:-1] + edges[1:])/2.
-    idx = np.where(N == np.max(N))[0]
-    shift_angle = -centres[idx[0]]
-    # shift_angle2 = -np.median(theta[~np.isnan(theta)])
-
-    rot = np.array([[np.cos(shift_angle), -np.sin(shift_angle)],
-                     [np.sin(shift_angle), np.cos(shift_angle)]])
-
-    #for each sample compute the x,y,z coordiante.
-    for k in range(len(r)):
-        rs = np.array([r[k]*np.cos(theta[k]),
-          r[k]*np.sin(theta[k])])
-
-        rsp = np.dot(rot, rs)
-        #compute the new angles in the rotated frame
-        sph = cartesian_to_spherical(rsp[0], rsp[1], 0.)
-
-        th_shift[k] = np.rad2deg(sph[1])
-
-    upper_percentile = np.abs(np.nanpercentile(th_shift,86.)-np.nanpercentile(th_shift,50.))
-    lower_percentile = np.abs(np.nanpercentile(th_shift,14.)-np.nanpercentile(th_shift,50.))
+    :return: upper and lower widths (deg) of the samples shifted by the bin with the largest number of samples
+    """
+    #shift angle by the bin with the largest number of samples, vectorized over all samples
+    th_shift = np.rad2deg(shift_angles(theta, circular_mode(theta, weights), r))
     if all == True:
         return th_shift
-    else:
-        return np.array([upper_percentile, lower_percentile])
-
-def cartesian_to_spherical(x, y, z):
-    r = np.sqrt(x ** 2. + y ** 2. + z ** 2.)
-    phi = np.arctan2(y, x)
-    th = np.arccos(z / r)
-    
-    return np.array([r, phi, th])
 
+    lower, median, upper = weighted_percentile(th_shift, [14., 50., 86.], weights)
+    upper_percentile = np.abs(upper - median)
+    lower_percentile = np.abs(lower - median)
+    return np.array([upper_percentile, lower_percentile])
@@ -0,0 +1,250 @@
+import numpy as np
+import argparse
+import json
+import os
+from Reflex_fit_data import ReflexFit, FitResult, batch_elements, parameters
+from catalog import Catalog, load_catalog
+from read_posterior import chain_file, read_chain_text
+from samplers import evidence_info, write_chains
+"""
+Importance reweighting of the posterior of a parent fit to subsets of its stars.
+
+The fits in results/RESULTSsgr.md differ by the Sgr cut or the distance threshold applied to the same
+parent sample, such that each input file is a subset of the stars of a parent file. With the log
+likelihood l_ij of each posterior sample i of the parent fit and each star j, the posterior of a subset
+S follows from the parent samples with the weights
+
+    w_i = L_S(theta_i) / L_parent(theta_i) = exp(-sum_{j not in S} l_ij)
+
+and the evidence from Z_S = Z_parent * mean(w). The matrix l_ij is computed once and stored
+memory-mapped next to the parent chains (prefixstarlike.npy). The reweighted posterior is reliable as
+long as its effective sample size (sum w)^2 / sum w^2 is large, and the subset is refitted otherwise.
+
+Usage, with the reweighted chains written to chains/<subset name>/ as by batch_fit.py:
+
+python reweight.py processed_real/sgrtests/KGiant_nosgr_40+.txt chains/KGiant_nosgr_40+/ \
+    "processed_real/sgrtests/KGiant_*sgr_*.txt" --chains chains/ --min-ess 500
+"""
+
+# memory-mapped matrix of the log likelihood of each sample and star, and its header
+matrix_name = 'starlike.npy'
+matrix_info = 'starlike.json'
+
+# file recording the effective sample size of a reweighted posterior
+reweight_info = 'reweight.json'
+
+
+def parent_samples(prefix):
+    """
+    Function to read the equally weighted posterior samples of a fit in the sampler parameters
+
+    :param prefix: prefix of the sampler output files
+
+    :return: array of shape (Nsamples, Nparam)
+    """
+    return read_chain_text(chain_file(prefix))[:, :len(parameters)]
+
+
+def star_loglike_matrix(fit, prefix, dtype=np.float64, cache=True):
+    """
+    Function to compute the log likelihood of each posterior sample and star of a fit
+
+    :param fit: ReflexFit of the data of the fit
+    :param prefix: prefix of the sampler output files
+    :param dtype: dtype of the stored matrix
+    :param cache: if True, read and write the matrix at prefixstarlike.npy
+
+    :return: memory-mapped array of shape (Nsamples, Nstars)
+
+    :note: the matrix is remade when the data or the chain file change
+    """
+    fname = chain_file(prefix)
+    stat = os.stat(fname)
+    key = {'data': fit.fingerprint(), 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'dtype': np.dtype(dtype).str}
+
+    if cache and os.path.exists(prefix + matrix_info) and os.path.exists(prefix + matrix_name):
+        with open(prefix + matrix_info) as f:
+            if json.load(f) == key:
+                return np.load(prefix + matrix_name, mmap_mode='r')
+
+    # 1. evaluate the samples in blocks, written to the memory-mapped matrix as they are computed
+    samples = parent_samples(prefix)
+    path = prefix + matrix_name if cache else None
+    if path is None:
+        M = np.empty((len(samples), fit.nstars), dtype=dtype)
+    else:
+        M = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(samples), fit.nstars))
+    block = max(1, batch_elements // fit.nstars)
+    for start in range(0, len(samples), block):
+        M[start:start + block] = fit.StarLogLikelihood(samples[start:start + block])
+
+    # 2. record what the matrix was made from
+    if path is not None:
+        M.flush()
+        with open(prefix + matrix_info, 'w') as f:
+            json.dump(key, f, indent=2)
+        return np.load(path, mmap_mode='r')
+    return M
+
+
+def subset_mask(parent, subset):
+    """
+    Function to find the stars of a subset in a parent sample
+
+    :param parent: array of shape (Nstars, 17) or Catalog of the parent sample
+    :param subset: array of shape (Nsubset, 17) or Catalog of the subset
+
+    :return: boolean mask of the parent stars in the subset
+
+    :raises ValueError: if a star of the subset is not in the parent sample
+    """
+    if not isinstance(parent, np.ndarray):
+        parent = parent.array(parent.names[:17])
+    if not isinstance(subset, np.ndarray):
+        subset = subset.array(subset.names[:17])
+
+    # stars are matched on their positions and velocities
+    index = {row.tobytes(): i for i, row in enumerate(np.ascontiguousarray(parent[:, :6], dtype=float))}
+    mask = np.zeros(len(parent), dtype=bool)
+    for row in np.ascontiguousarray(subset[:, :6], dtype=float):
+        i = index.get(row.tobytes())
+        if i is None:
+            raise ValueError('the subset contains stars that are not in the parent sample')
+        mask[i] = True
+    return mask
+
+
+def importance_weights(M, mask, block=None):
+    """
+    Function to compute the importance weights of the parent samples for a subset of stars
+
+    :param M: log likelihood matrix of shape (Nsamples, Nstars), see star_loglike_matrix
+    :param mask: boolean mask of the stars in the subset
+    :param block: number of samples summed at once, defaults to batch_elements stars x samples
+
+    :return: logw, the log weights, and logl, the log likelihood of the subset for each sample
+    """
+    if block is None:
+        block = max(1, batch_elements // M.shape[1])
+    inside = mask.astype(float)
+    logw, logl = np.empty(len(M)), np.empty(len(M))
+    for start in range(0, len(M), block):
+        rows = np.asarray(M[start:start + block], dtype=float)
+        logl[start:start + block] = rows @ inside
+        logw[start:start + block] = -(rows @ (1. - inside))
+    return logw, logl
+
+
+def effective_sample_size(logw):
+    """
+    Function to compute the effective sample size of weighted samples
+
+    :param logw: log weights
+
+    :return: (sum w)^2 / sum w^2
+    """
+    w = np.exp(logw - np.max(logw))
+    return np.sum(w) ** 2. / np.sum(w ** 2.)
+
+
+class ParentFit:
+    """
+    Class holding a finished parent fit and the log likelihood of its samples for each star
+
+    :param data: data of the parent fit, see ReflexFit
+    :param prefix: prefix of the sampler output files of the parent fit
+    :param layout: layout of a text input file, see ReflexFit
+    :param dtype: dtype of the stored log likelihood matrix, float32 halves its size
+
+    :note: the evidence of the parent fit is read from prefixevidence.json if it exists, otherwise
+        the evidences of the subsets are relative to the parent evidence
+    """
+
+    def __init__(self, data, prefix, layout='auto', dtype=np.float64):
+        if isinstance(data, str):
+            data = load_catalog(data, layout)
+        elif not isinstance(data, Catalog):
+            data = Catalog.from_array(np.asarray(data, dtype=float))
+        self.catalog = data
+        self.fit = ReflexFit(self.catalog)
+        self.prefix = prefix
+        self.samples = parent_samples(prefix)
+        self.M = star_loglike_matrix(self.fit, prefix, dtype)
+        self.logZ, self.logZerr = 0., 0.
+        if os.path.exists(prefix + evidence_info):
+            with open(prefix + evidence_info) as f:
+                info = json.load(f)
+            self.logZ, self.logZerr = info['logZ'], info['logZerr']
+
+    def reweight(self, subset, prefix=None, min_ess=500., refit=True, layout='auto', seed=None, **settings):
+        """
+        Function to compute the posterior of a subset of the stars of the parent fit
+
+        :param subset: path, array or Catalog of the stars of the subset, or boolean mask of the parent stars
+        :param prefix: if given, prefix of the output files of the subset, written in the MultiNest format
+        :param min_ess: minimum effective sample size of the reweighted posterior
+        :param refit: if True, fit the subset when the effective sample size is below min_ess
+        :param layout: layout of a text input file, see ReflexFit
+        :param seed: random seed of the resampling into equally weighted samples
+        :param settings: sampler settings of the refit, see ReflexFit.run
+
+        :return: FitResult, and the effective sample size (NaN if the subset was refitted)
+        """
+        if isinstance(subset, str):
+            subset = load_catalog(subset, layout)
+        if isinstance(subset, np.ndarray) and subset.dtype == bool:
+            mask = subset
+            subset = self.catalog.array(self.catalog.names[:17])[mask]
+        else:
+            mask = subset_mask(self.catalog, subset)
+
+        logw, logl = importance_weights(self.M, mask)
+        ess = effective_sample_size(logw)
+
+        if ess < min_ess and refit:
+            if prefix is None:
+                raise ValueError('a prefix is needed to refit the subset')
+            return ReflexFit(subset).run(prefix, **settings), np.nan
+
+        # evidence as the mean of the weights, with the error of the mean added to the parent error
+        n = len(logw)
+        logmean = np.logaddexp.reduce(logw) - np.log(n)
+        w = np.exp(logw - np.max(logw))
+        logZ = self.logZ + logmean
+        logZerr = np.sqrt(self.logZerr ** 2. + np.var(w) / (n * np.mean(w) ** 2.))
+
+        write = prefix is not None
+        samples = write_chains(prefix, self.samples, logl, logw, np.logaddexp.reduce(logw), seed=seed,
+                               write=write)
+        if write:
+            with open(prefix + evidence_info, 'w') as f:
+                json.dump({'sampler': 'reweight', 'logZ': float(logZ), 'logZerr': float(logZerr)}, f, indent=2)
+            with open(prefix + reweight_info, 'w') as f:
+                json.dump({'parent': self.prefix, 'ess': float(ess), 'nstars': int(np.sum(mask))}, f, indent=2)
+        return FitResult(samples, logZ, logZerr, prefix), ess
+
+
+if __name__ == "__main__":
+    from batch_fit import jobs_from_glob
+
+    parser = argparse.ArgumentParser(description='Reweight the posterior of a parent fit to subsets of its stars.')
+    parser.add_argument('parent', help='input file or catalog of the parent fit')
+    parser.add_argument('prefix', help='prefix of the output files of the parent fit')
+    parser.add_argument('subsets', nargs='+', help='glob patterns of the input files of the subsets')
+    parser.add_argument('--chains', default='chains/', help='directory for the prefix directories of the subsets')
+    parser.add_argument('--min-ess', type=float, default=500., help='refit subsets below this effective sample size')
+    parser.add_argument('--no-refit', action='store_true', help='only report subsets below --min-ess')
+    parser.add_argument('--sampler', default='multinest', help='sampler backend of the refits')
+    parser.add_argument('--float32', action='store_true', help='store the log likelihood matrix in float32')
+    args = parser.parse_args()
+
+    parent = ParentFit(args.parent, args.prefix, dtype=np.float32 if args.float32 else np.float64)
+    for dfname, prefix in jobs_from_glob(args.subsets, args.chains):
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        try:
+            result, ess = parent.reweight(dfname, prefix, args.min_ess, not args.no_refit, sampler=args.sampler)
+        except ValueError as e:
+            print('%-60s %s' % (dfname, e))
+            continue
+        status = 'refitted' if np.isnan(ess) else 'ESS %.0f' % ess
+        print('%-60s %-12s lnZ %.1f +- %.1f' % (dfname, status, result.logZ, result.logZerr))
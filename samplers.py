@@ -0,0 +1,682 @@
+import numpy as np
+import hashlib
+import json
+import os
+"""
+Sampler backends for the reflex motion fit.
+
+A backend is a function backend(model, prefix, **settings) returning a dictionary with the
+equally weighted posterior samples ('samples'), the log evidence ('logZ') and its error ('logZerr'),
+as returned by pymultinest.solve. The model is any object with the interface of ReflexFit:
+
+- n_params: number of parameters
+- parameters: parameter names
+- Prior(cube): prior transform of a point of the unit hypercube, in place
+- BatchPrior(cubes): prior transform of an (n_points, n_params) array of points of the unit hypercube
+- LogLikelihood(cube): log likelihood of a parameter vector
+- BatchLogLikelihood(cubes): log likelihoods of an (n_points, n_params) array of parameter vectors
+- fingerprint(): hash of the data the likelihood depends on
+- LogLikelihoodGradient(cube), optional: log likelihood and its gradient, used by the map and laplace
+  backends instead of finite differences
+
+The backends are:
+
+- multinest: pymultinest.solve, which needs the MultiNest library and calls LogLikelihood one point at a time
+- nested: nested sampling in pure NumPy, which replaces the live points in batches by random walks
+  evaluated with one call of BatchLogLikelihood per step
+- map: maximum a posteriori parameters from L-BFGS-B started at the best of a batch of prior draws
+- laplace: map, followed by a Gaussian approximation of the posterior and evidence at the maximum
+
+The nested backend writes its chains in the MultiNest output format (prefix.txt and
+prefixpost_equal_weights.dat), such that read_posterior.py and batch_fit.py can be used on them.
+
+Fits are run through run(), which resumes from the output files of a previous run with the same
+sampler, settings, data and prior, and starts afresh otherwise. The data and prior are recorded in
+prefixcheckpoint.json, the prior as the parameters of a fixed set of points of the unit hypercube.
+The map and laplace backends are not checkpointed during the optimization, resuming them returns the
+result of a finished run.
+The evidence of a finished run is recorded in prefixevidence.json. With run(..., telemetry=...), the
+likelihood calls and the progress of the run are recorded, see telemetry.py.
+
+Under MPI (mpiexec -n N python Reflex_fit_data.py ..., with mpi4py installed), all ranks run the
+sampler: MultiNest distributes the live points itself and the nested backend splits each batch of
+likelihood evaluations over the ranks. Only rank 0 writes the output files.
+"""
+
+# file recording the data, prior and settings of the output files of a prefix
+checkpoint_info = 'checkpoint.json'
+
+# file recording the evidence of a finished run
+evidence_info = 'evidence.json'
+
+# resume files of the backends, removed when a run starts afresh
+resume_files = ['resume.dat', 'nested.npz', 'map.json', 'laplace.json']
+
+# settings that do not change the output of a run
+run_only_settings = ['resume', 'verbose', 'n_iter_before_update', 'checkpoint_every']
+
+
+def mpi_comm():
+    """
+    Function to find the MPI communicator of the run
+
+    :return: MPI.COMM_WORLD if running on several MPI ranks, None otherwise
+    """
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    if MPI.COMM_WORLD.Get_size() < 2:
+        return None
+    return MPI.COMM_WORLD
+
+
+def mpi_rank():
+    """
+    Function to find the MPI rank of the process
+
+    :return: rank, 0 without MPI
+    """
+    comm = mpi_comm()
+    return 0 if comm is None else comm.Get_rank()
+
+
+def prior_fingerprint(model, npoints=16):
+    """
+    Function to compute a hash of the prior transform of a model
+
+    :param model: model, see the module docstring
+    :param npoints: number of points of the unit hypercube transformed
+
+    :return: hexadecimal sha256 hash
+    """
+    u = np.random.default_rng(0).random((npoints, model.n_params))
+    h = hashlib.sha256(json.dumps(list(model.parameters)).encode())
+    h.update(np.ascontiguousarray(model.BatchPrior(u), dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def check_checkpoint(model, prefix, sampler, settings, resume=True):
+    """
+    Function to check whether a run can resume from the output files of a prefix, and to record the
+    data, prior and settings of the new run
+
+    :param model: model, see the module docstring
+    :param prefix: prefix of the output files
+    :param sampler: name of the sampler backend
+    :param settings: sampler settings
+    :param resume: if False, never resume
+
+    :return: True if the run can resume
+    """
+    comm = mpi_comm()
+    if comm is not None and comm.Get_rank() != 0:
+        return comm.bcast(None, root=0)
+
+    info = {'sampler': sampler, 'data': model.fingerprint(), 'prior': prior_fingerprint(model),
+            'settings': {k: v for k, v in settings.items() if k not in run_only_settings}}
+    # round trip through json, such that the settings compare as they are stored
+    info = json.loads(json.dumps(info, sort_keys=True, default=str))
+    fname = prefix + checkpoint_info
+    old = None
+    if os.path.exists(fname):
+        with open(fname) as f:
+            old = json.load(f)
+
+    if resume and old is not None and old != info:
+        changed = [key for key in info if old.get(key) != info[key]]
+        print('%s: %s changed since the previous run, starting afresh' % (prefix, ', '.join(changed)))
+    resume = resume and old == info
+
+    # a new run killed before its first checkpoint must not resume from the files of the old one
+    if not resume:
+        for name in resume_files:
+            if os.path.exists(prefix + name):
+                os.remove(prefix + name)
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(info, f, indent=2)
+    if comm is not None:
+        comm.bcast(resume, root=0)
+    return resume
+
+
+def run(model, prefix, sampler='multinest', resume=True, telemetry=None, **settings):
+    """
+    Function to run a sampler backend, resuming from a previous run if it used the same data, prior and
+    settings
+
+    :param model: model, see the module docstring
+    :param prefix: prefix of the output files
+    :param sampler: name of the sampler backend, one of backends
+    :param resume: if True, resume from the output files of a previous run if possible
+    :param telemetry: telemetry.Telemetry recording the likelihood calls and, for the backends in
+        progress_backends, the progress of the run, or None
+    :param settings: settings passed to the backend
+
+    :return: dictionary with samples, logZ and logZerr
+    """
+    resume = check_checkpoint(model, prefix, sampler, settings, resume)
+    if telemetry is not None:
+        model = telemetry.wrap(model)
+        if sampler in progress_backends:
+            settings = dict(settings, telemetry=telemetry)
+    result = None
+    try:
+        result = backends[sampler](model, prefix, resume=resume, **settings)
+    finally:
+        # the final snapshot and profile are also written if the sampler fails
+        if telemetry is not None:
+            telemetry.close(result)
+    if mpi_rank() == 0:
+        with open(prefix + evidence_info, 'w') as f:
+            json.dump({'sampler': sampler, 'logZ': float(result['logZ']), 'logZerr': float(result['logZerr'])},
+                      f, indent=2)
+    return result
+
+
+def run_multinest(model, prefix, n_live_points=1000, resume=True, verbose=True, n_iter_before_update=100,
+                  telemetry=None, **kwargs):
+    """
+    Function to run MultiNest
+
+    :param model: model, see the module docstring
+    :param prefix: prefix for the pyMultinest output files
+    :param n_live_points: number of live points
+    :param resume: if True, resume from the output files of a previous run
+    :param verbose: if True, print the sampler progress
+    :param n_iter_before_update: number of iterations between output updates
+    :param telemetry: telemetry.Telemetry receiving the progress at each output update, or None
+    :param kwargs: other arguments passed to pymultinest.solve.solve
+
+    :return: dictionary with samples, logZ and logZerr
+    """
+    from pymultinest.solve import solve
+
+    if telemetry is not None:
+        def dump_callback(nSamples, nlive, nPar, physLive, posterior, paramConstr, maxLogLike, logZ, INSlogZ,
+                          logZerr, context):
+            # the prior volume shrinks by a factor exp(-1/nlive) per dead point
+            telemetry.progress(nSamples, logZ, -nSamples / nlive, physLive[:, nPar], physLive[:, :nPar],
+                               tolerance=kwargs.get('evidence_tolerance', 0.5))
+        kwargs['dump_callback'] = dump_callback
+
+    return solve(LogLikelihood=model.LogLikelihood, Prior=model.Prior,
+                 n_dims=model.n_params, outputfiles_basename=prefix, verbose=verbose,
+                 resume=resume, n_live_points=n_live_points, wrapped_params=None,
+                 n_iter_before_update=n_iter_before_update, **kwargs)
+
+
+def mpi_batch(func, comm):
+    """
+    Function to split the evaluation of a batch function over the MPI ranks
+
+    :param func: function of an (n_points, n_dims) array returning n_points values
+    :param comm: MPI communicator, or None
+
+    :return: function evaluating each rank's share of the points and gathering the values on all ranks
+    """
+    if comm is None:
+        return func
+
+    def batch(x):
+        part = np.array_split(x, comm.Get_size())[comm.Get_rank()]
+        return np.concatenate(comm.allgather(func(part)))
+    return batch
+
+
+def random_walk(rng, prior, loglike, u, theta, logl, logl_min, L, scale, n_steps=20):
+    """
+    Function to move a set of points by random walks within the region above a likelihood threshold
+
+    :param rng: numpy random generator
+    :param prior: batch prior transform, see BatchPrior
+    :param loglike: batch log likelihood, see BatchLogLikelihood
+    :param u: starting points in the unit hypercube (n_points x n_dims), above the threshold
+    :param theta: parameters of the starting points
+    :param logl: log likelihoods of the starting points
+    :param logl_min: likelihood threshold
+    :param L: cholesky factor of the covariance of the steps
+    :param scale: scale of the steps
+    :param n_steps: number of steps
+
+    :return: u, theta, logl of the moved points and the acceptance fraction of the steps
+
+    :note: all walks make a step at once, so each step is a single call of loglike
+    """
+    u, theta, logl = u.copy(), theta.copy(), logl.copy()
+    naccept = 0
+    for step in range(n_steps):
+        prop = u + scale * rng.normal(size=u.shape) @ L.T
+        inside = np.all((prop > 0.) & (prop < 1.), axis=1)
+        prop_theta = prior(prop[inside])
+        prop_logl = loglike(prop_theta)
+        good = prop_logl > logl_min
+        idx = np.flatnonzero(inside)[good]
+        u[idx], theta[idx], logl[idx] = prop[inside][good], prop_theta[good], prop_logl[good]
+        naccept += len(idx)
+    return u, theta, logl, naccept / float(n_steps * len(u))
+
+
+def write_chains(prefix, theta, logl, logwt, logZ, nsamples=None, seed=None, write=True):
+    """
+    Function to write weighted samples in the MultiNest output format
+
+    :param prefix: prefix of the output files
+    :param theta: parameters of the samples (n_samples x n_params)
+    :param logl: log likelihoods of the samples
+    :param logwt: log of the prior mass times the likelihood of the samples
+    :param logZ: log evidence
+    :param nsamples: number of equally weighted samples, defaults to the effective sample size
+    :param seed: random seed of the resampling
+    :param write: if False, only resample
+
+    :return: equally weighted samples (nsamples x n_params)
+    """
+    weights = np.exp(logwt - logZ)
+    weights /= np.sum(weights)
+    if nsamples is None:
+        nsamples = int(1. / np.sum(weights ** 2.))
+
+    # systematic resampling into equally weighted samples
+    rng = np.random.default_rng(seed)
+    cdf = np.cumsum(weights)
+    cdf[-1] = 1.
+    idx = np.searchsorted(cdf, (rng.random() + np.arange(nsamples)) / nsamples)
+    samples = theta[idx]
+
+    if write:
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        np.savetxt(prefix + '.txt', np.column_stack([weights, -2. * logl, theta]))
+        np.savetxt(prefix + 'post_equal_weights.dat', np.column_stack([samples, logl[idx]]))
+    return samples
+
+
+def save_state(fname, state, rng):
+    """
+    Function to save the state of the nested sampler, replacing the previous state in one step
+
+    :param fname: path to the .npz checkpoint file
+    :param state: dictionary of arrays and numbers
+    :param rng: numpy random generator, whose state is saved with the sampler state
+    """
+    tmp = fname + '.tmp.npz'
+    np.savez(tmp, rng=json.dumps(rng.bit_generator.state), **state)
+    os.replace(tmp, fname)
+
+
+def load_state(fname, rng):
+    """
+    Function to load the state of the nested sampler
+
+    :param fname: path to the .npz checkpoint file
+    :param rng: numpy random generator, whose state is restored
+
+    :return: dictionary of arrays and numbers
+    """
+    with np.load(fname) as f:
+        state = {key: f[key] for key in f.files if key != 'rng'}
+        rng.bit_generator.state = json.loads(str(f['rng']))
+    return state
+
+
+def run_nested(model, prefix, n_live_points=400, batch_size=None, n_steps=20, dlogz=0.5, max_iter=100000,
+               seed=None, resume=True, checkpoint_every=20, verbose=True, telemetry=None):
+    """
+    Function to run nested sampling with batches of live points replaced at once
+
+    :param model: model, see the module docstring
+    :param prefix: prefix for the output files
+    :param n_live_points: number of live points
+    :param batch_size: number of live points replaced per iteration, defaults to n_live_points / 10
+    :param n_steps: number of random walk steps of each new point
+    :param dlogz: stop when the estimated evidence of the live points is below this fraction of the
+        evidence, in log
+    :param max_iter: maximum number of iterations
+    :param seed: random seed, drawn once and saved in the checkpoint if None
+    :param resume: if True, resume from the checkpoint file prefixnested.npz
+    :param checkpoint_every: number of iterations between checkpoints
+    :param verbose: if True, print the sampler progress
+    :param telemetry: telemetry.Telemetry receiving the progress at each iteration, or None
+
+    :return: dictionary with samples, logZ and logZerr
+
+    :note: the k worst live points are removed together, such that the number of live points goes
+        down from n to n-k+1 during the iteration, and replaced by k points with a likelihood above the
+        highest of the removed ones. New points are random walks from randomly chosen surviving live
+        points, with steps following the covariance of the live points in the unit hypercube.
+    """
+    comm = mpi_comm()
+    rank = 0 if comm is None else comm.Get_rank()
+    # the seed also sets the resampling of the chains, so it is saved with the checkpoint, and all ranks
+    # follow the same random walks, each evaluating a share of the points
+    seed = np.random.SeedSequence(seed).entropy
+    if comm is not None:
+        seed = comm.bcast(seed, root=0)
+    verbose = verbose and rank == 0
+    batch_loglike = mpi_batch(model.BatchLogLikelihood, comm)
+
+    def loglike(theta):
+        # points with an undefined likelihood are never accepted
+        logl = batch_loglike(theta)
+        logl[np.isnan(logl)] = -np.inf
+        return logl
+
+    rng = np.random.default_rng(seed)
+    ndim = model.n_params
+    if batch_size is None:
+        batch_size = max(1, n_live_points // 10)
+    fname = prefix + 'nested.npz'
+
+    if resume and os.path.exists(fname):
+        # 1. continue from the checkpoint
+        state = load_state(fname, rng)
+        u, theta, logl = state['u'], state['theta'], state['logl']
+        dead_theta, dead_logl, dead_logwt = [state['dead_theta']], [state['dead_logl']], [state['dead_logwt']]
+        logX, logZ, scale = float(state['logX']), float(state['logZ']), float(state['scale'])
+        ncall, it0 = int(state['ncall']), int(state['it'])
+        if 'seed' in state:
+            seed = int(str(state['seed']))
+        if verbose:
+            print('resuming from iteration %d' % it0)
+    else:
+        # 1. draw the live points from the prior
+        u = rng.random((n_live_points, ndim))
+        theta = model.BatchPrior(u)
+        logl = loglike(theta)
+        ncall = n_live_points
+        dead_theta, dead_logl, dead_logwt = [], [], []
+        logX = 0.
+        logZ = -np.inf
+        scale = 2.38 / np.sqrt(ndim)
+        it0 = 0
+
+    for it in range(it0, max_iter):
+        # 2. remove the batch_size worst points, with the prior volume shrinking by 1/m per point
+        # for m live points
+        order = np.argsort(logl)
+        worst, keep = order[:batch_size], order[batch_size:]
+        m = n_live_points - np.arange(batch_size)
+        logX_new = logX - np.cumsum(1. / m)
+        logw = np.log(-np.expm1(-1. / m)) + np.concatenate([[logX], logX_new[:-1]])
+        dead_theta.append(theta[worst])
+        dead_logl.append(logl[worst])
+        dead_logwt.append(logw + logl[worst])
+        logZ = np.logaddexp(logZ, np.logaddexp.reduce(dead_logwt[-1]))
+        logX = logX_new[-1]
+        logl_min = logl[worst[-1]]
+
+        # 3. replace them by random walks from the surviving points above the likelihood of the removed
+        # points, adapting the step scale to an acceptance of ~25 per cent
+        L = np.linalg.cholesky(np.cov(u[keep], rowvar=False) + 1.e-12 * np.eye(ndim))
+        start = rng.choice(keep, batch_size)
+        new_u, new_theta, new_logl, acceptance = random_walk(rng, model.BatchPrior, loglike, u[start],
+                                                             theta[start], logl[start], logl_min, L, scale,
+                                                             n_steps)
+        ncall += n_steps * batch_size
+        scale *= np.exp(np.clip(acceptance - 0.25, -0.5, 0.5))
+        u = np.concatenate([u[keep], new_u])
+        theta = np.concatenate([theta[keep], new_theta])
+        logl = np.concatenate([logl[keep], new_logl])
+
+        # 4. stop when the live points cannot change the evidence by more than dlogz
+        delta = np.logaddexp(logZ, logX + np.max(logl)) - logZ
+        if telemetry is not None:
+            telemetry.progress(it, logZ, logX, logl, theta, delta, dlogz)
+        if verbose and it % 50 == 0:
+            print('iteration %6d, calls %9d, lnZ %12.3f, dlnZ %10.3f, acceptance %.3f' % (
+                it, ncall, logZ, delta, acceptance))
+        if delta < dlogz:
+            break
+        if rank == 0 and (it + 1) % checkpoint_every == 0:
+            dead_theta, dead_logl, dead_logwt = [[np.concatenate(x)] for x in [dead_theta, dead_logl, dead_logwt]]
+            save_state(fname, dict(u=u, theta=theta, logl=logl, dead_theta=dead_theta[0],
+                                   dead_logl=dead_logl[0], dead_logwt=dead_logwt[0], logX=logX, logZ=logZ,
+                                   scale=scale, ncall=ncall, it=it + 1, seed=str(seed)), rng)
+
+    # 5. add the remaining live points, sharing the remaining prior volume
+    dead_theta.append(theta)
+    dead_logl.append(logl)
+    dead_logwt.append(logX - np.log(n_live_points) + logl)
+    theta, logl, logwt = [np.concatenate(x) for x in [dead_theta, dead_logl, dead_logwt]]
+    logZ = np.logaddexp.reduce(logwt)
+
+    # information and evidence error estimate of Skilling (2006)
+    H = np.sum(np.exp(logwt - logZ) * logl) - logZ
+    logZerr = np.sqrt(max(H, 0.) / n_live_points)
+    if verbose:
+        print('ln(Z) = %.3f +- %.3f after %d likelihood calls' % (logZ, logZerr, ncall))
+
+    samples = write_chains(prefix, theta, logl, logwt, logZ, seed=seed, write=rank == 0)
+    return dict(samples=samples, logZ=logZ, logZerr=logZerr)
+
+
+def prior_bounds(model):
+    """
+    Function to find the parameters at the corners of the unit hypercube
+
+    :param model: model, see the module docstring
+
+    :return: lo, hi, the parameters at 0 and 1 of the unit hypercube
+
+    :note: the priors are uniform, such that the parameters are lo + u * (hi - lo)
+    """
+    theta = model.BatchPrior(np.array([np.zeros(model.n_params), np.ones(model.n_params)]))
+    return theta[0], theta[1]
+
+
+def unit_objective(model, loglike, step=1.e-6):
+    """
+    Function to make the negative log likelihood and its gradient as a function of the unit hypercube
+
+    :param model: model, see the module docstring
+    :param loglike: batch log likelihood, see BatchLogLikelihood
+    :param step: finite difference step in the unit hypercube, if the model has no LogLikelihoodGradient
+
+    :return: function of u returning the negative log likelihood and its gradient
+    """
+    lo, hi = prior_bounds(model)
+    ndim = model.n_params
+
+    if hasattr(model, 'LogLikelihoodGradient'):
+        def negloglike(u):
+            logl, grad = model.LogLikelihoodGradient(lo + u * (hi - lo))
+            return -logl, -grad * (hi - lo)
+    else:
+        def negloglike(u):
+            # forward differences, with all points in one batch, points beyond the upper bound step backwards
+            U = np.tile(u, (ndim + 1, 1))
+            h = np.where(u + step <= 1., step, -step)
+            U[1:] += np.diag(h)
+            logl = loglike(model.BatchPrior(U))
+            return -logl[0], -(logl[1:] - logl[0]) / h
+    return negloglike
+
+
+def check_gradient(model, theta, rel_step=1.e-6):
+    """
+    Function to check the LogLikelihoodGradient of a model against central finite differences
+
+    :param model: model, see the module docstring
+    :param theta: parameters after the prior
+    :param rel_step: finite difference step relative to the parameters
+
+    :return: analytic and finite difference gradients
+    """
+    theta = np.asarray(theta, dtype=float)
+    h = rel_step * np.maximum(np.abs(theta), 1.e-3)
+    points = np.concatenate([theta + np.diag(h), theta - np.diag(h)])
+    logl = model.BatchLogLikelihood(points)
+    return model.LogLikelihoodGradient(theta)[1], (logl[:len(h)] - logl[len(h):]) / (2. * h)
+
+
+def find_map(model, loglike, rng, n_starts=8, n_draws=None, step=1.e-6, verbose=True, options=None):
+    """
+    Function to maximize the likelihood over the unit hypercube with L-BFGS-B
+
+    :param model: model, see the module docstring
+    :param loglike: batch log likelihood, see BatchLogLikelihood
+    :param rng: numpy random generator
+    :param n_starts: number of optimizations, started from the best of the prior draws
+    :param n_draws: number of prior draws, defaults to 100 per parameter
+    :param step: finite difference step of the gradient in the unit hypercube
+    :param verbose: if True, print the result of each optimization
+    :param options: options passed to scipy.optimize.minimize
+
+    :return: best point of the unit hypercube, maximum log likelihood, number of likelihood calls
+    """
+    from scipy.optimize import minimize
+
+    ndim = model.n_params
+    if n_draws is None:
+        n_draws = 100 * ndim
+    negloglike = unit_objective(model, loglike, step)
+
+    # 1. start from the best prior draws
+    u0 = rng.random((n_draws, ndim))
+    logl0 = loglike(model.BatchPrior(u0))
+    starts = u0[np.argsort(logl0)[::-1][:n_starts]]
+    ncall = n_draws
+
+    # 2. optimize from each of them, keeping the best
+    best = None
+    for start in starts:
+        res = minimize(negloglike, start, jac=True, method='L-BFGS-B', bounds=[(0., 1.)] * ndim,
+                       options=options)
+        ncall += res.nfev
+        if verbose:
+            print('lnL = %.3f after %d iterations: %s' % (-res.fun, res.nit, res.message))
+        if best is None or res.fun < best.fun:
+            best = res
+    return best.x, -best.fun, ncall
+
+
+def run_map(model, prefix, n_starts=8, n_draws=None, step=1.e-6, seed=None, resume=True, verbose=True,
+            **kwargs):
+    """
+    Function to find the maximum a posteriori parameters
+
+    :param model: model, see the module docstring
+    :param prefix: prefix for the output file prefixmap.json
+    :param n_starts: number of optimizations, started from the best of the prior draws
+    :param n_draws: number of prior draws, defaults to 100 per parameter
+    :param step: finite difference step of the gradient in the unit hypercube
+    :param seed: random seed
+    :param resume: if True, return the result of a finished run in prefixmap.json, see run(). The
+        optimization itself is not checkpointed, an interrupted run starts again
+    :param verbose: if True, print the result of each optimization
+    :param kwargs: options passed to scipy.optimize.minimize
+
+    :return: dictionary with the MAP parameters as a single sample, logZ and logZerr are NaN
+
+    :note: the priors are uniform in the unit hypercube, so the posterior is maximized over the unit
+        hypercube. The gradient is the analytic LogLikelihoodGradient of the model if it has one, and
+        forward differences otherwise, with all n_params + 1 points evaluated in one call of
+        BatchLogLikelihood.
+    """
+    comm = mpi_comm()
+    rank = 0 if comm is None else comm.Get_rank()
+    if comm is not None:
+        seed = comm.bcast(np.random.SeedSequence(seed).entropy, root=0)
+    loglike = mpi_batch(model.BatchLogLikelihood, comm)
+
+    if resume and os.path.exists(prefix + 'map.json'):
+        with open(prefix + 'map.json') as f:
+            parameters = json.load(f)['parameters']
+        return dict(samples=np.array([[parameters[name] for name in model.parameters]]), logZ=np.nan,
+                    logZerr=np.nan)
+
+    u, logl, ncall = find_map(model, loglike, np.random.default_rng(seed), n_starts, n_draws, step,
+                              verbose and rank == 0, kwargs)
+    theta = model.BatchPrior(u[None, :])
+    if rank == 0:
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        with open(prefix + 'map.json', 'w') as f:
+            json.dump({'parameters': dict(zip(model.parameters, theta[0].tolist())), 'logL': float(logl)},
+                      f, indent=2)
+    return dict(samples=theta, logZ=np.nan, logZerr=np.nan)
+
+
+def run_laplace(model, prefix, n_samples=10000, n_starts=8, n_draws=None, step=1.e-6, seed=None, resume=True,
+                verbose=True, **kwargs):
+    """
+    Function to approximate the posterior by a Gaussian at the maximum a posteriori parameters
+
+    :param model: model, see the module docstring
+    :param prefix: prefix for the output files
+    :param n_samples: number of posterior samples drawn from the Gaussian
+    :param n_starts: number of optimizations, see find_map
+    :param n_draws: number of prior draws, see find_map
+    :param step: finite difference step of the Hessian, in the unit hypercube
+    :param seed: random seed
+    :param resume: if True, return the result of a finished run in prefixlaplace.json and
+        prefixpost_equal_weights.dat, see run(). The optimization itself is not checkpointed, an interrupted
+        run starts again
+    :param verbose: if True, print the result of each optimization
+    :param kwargs: options passed to scipy.optimize.minimize
+
+    :return: dictionary with samples, and the Laplace approximation of logZ, logZerr is NaN
+
+    :note: the covariance is the inverse of the Hessian of the log likelihood at the maximum, computed
+        by central differences of the gradient. Samples outside the prior are dropped. The samples are
+        written to prefixpost_equal_weights.dat for a quick look with read_posterior.py, and the maximum
+        and covariance to prefixlaplace.json.
+    """
+    comm = mpi_comm()
+    rank = 0 if comm is None else comm.Get_rank()
+    if comm is not None:
+        seed = comm.bcast(np.random.SeedSequence(seed).entropy, root=0)
+    loglike = mpi_batch(model.BatchLogLikelihood, comm)
+    rng = np.random.default_rng(seed)
+    ndim = model.n_params
+
+    # laplace.json is written after the samples, so a finished run has both
+    if resume and os.path.exists(prefix + 'laplace.json'):
+        with open(prefix + 'laplace.json') as f:
+            logZ = json.load(f)['logZ']
+        samples = np.loadtxt(prefix + 'post_equal_weights.dat', ndmin=2)[:, :ndim]
+        return dict(samples=samples, logZ=logZ, logZerr=np.nan)
+
+    # 1. maximum of the posterior in the unit hypercube
+    u, logl, ncall = find_map(model, loglike, rng, n_starts, n_draws, step, verbose and rank == 0, kwargs)
+
+    # 2. Hessian in the unit hypercube from central differences of the gradient
+    negloglike = unit_objective(model, loglike, step)
+    H = np.zeros((ndim, ndim))
+    for i in range(ndim):
+        # one sided at the bounds of the unit hypercube
+        up, down = u.copy(), u.copy()
+        up[i], down[i] = min(u[i] + step, 1.), max(u[i] - step, 0.)
+        H[i] = (negloglike(up)[1] - negloglike(down)[1]) / (up[i] - down[i])
+    ncall += 2 * ndim
+    H = 0.5 * (H + H.T)
+
+    # 3. covariance of the parameters, and the Laplace evidence for the uniform prior
+    lo, hi = prior_bounds(model)
+    cov_u = np.linalg.inv(H)
+    cov = cov_u * np.outer(hi - lo, hi - lo)
+    sign, logdet = np.linalg.slogdet(cov_u)
+    logZ = logl + 0.5 * ndim * np.log(2. * np.pi) + 0.5 * logdet if sign > 0 else np.nan
+    if verbose and rank == 0:
+        print('ln(Z) ~ %.3f from the Laplace approximation after %d likelihood calls' % (logZ, ncall))
+
+    # 4. samples of the Gaussian inside the prior
+    us = rng.multivariate_normal(u, cov_u, n_samples, check_valid='ignore')
+    us = us[np.all((us > 0.) & (us < 1.), axis=1)]
+    samples = model.BatchPrior(us)
+    if rank == 0:
+        os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+        np.savetxt(prefix + 'post_equal_weights.dat', np.column_stack([samples, loglike(samples)]))
+        theta = model.BatchPrior(u[None, :])[0]
+        with open(prefix + 'laplace.json', 'w') as f:
+            json.dump({'parameters': dict(zip(model.parameters, theta.tolist())), 'logL': float(logl),
+                       'cov': cov.tolist(), 'logZ': float(logZ), 'ncall': int(ncall)}, f, indent=2)
+    elif comm is not None:
+        loglike(samples)
+    return dict(samples=samples, logZ=logZ, logZerr=np.nan)
+
+
+backends = {'multinest': run_multinest, 'nested': run_nested, 'map': run_map, 'laplace': run_laplace}
+
+# backends reporting their progress to a telemetry.Telemetry
+progress_backends = ['multinest', 'nested']
@@ -0,0 +1,146 @@
+import numpy as np
+import argparse
+import itertools
+import json
+from Reflex_fit_data import ReflexFit, parameters
+from geometry import rsun_mw, vsun_mw
+from reweight import effective_sample_size, parent_samples
+"""
+Sensitivity of a finished fit to the solar position and motion.
+
+The likelihood of a fixed set of parameter vectors (the posterior samples or the MAP point of a fit) is
+evaluated over a grid of solar parameters. The observables are linear in the solar motion, which only
+shifts the reflex velocity of the linear model parameters (see geometry.solar_shift), so all solar
+motions of the grid are evaluated as one batch on the geometry of the fit. Each solar position of the
+grid needs its own geometry, computed once for all solar motions.
+
+For each grid point, the output has the change of the log likelihood at the best sample (dlnL), and
+with the posterior samples, the log ratio of the evidences by importance reweighting as in reweight.py,
+
+    dlogZ = log mean_i exp(lnL'(theta_i) - lnL(theta_i))
+
+with the effective sample size of the weights (ess), which should be large for dlogZ to be reliable.
+
+Usage, with the posterior samples of a fit made with the default solar parameters:
+
+python solar_sweep.py processed_real/sgrtests/KGiant_nosgr_40+.txt chains/KGiant_nosgr_40+/ \
+    --r0 8.0 8.3 8.5 --vx 8.1 11.1 14.1 --vy 232.24 244.24 256.24 --nsamples 1000
+"""
+
+# file written next to the chains of the fit
+sweep_info = 'solarsweep.json'
+
+
+def solar_grid(r0=None, zsun=None, vx=None, vy=None, vz=None, rsun=rsun_mw, vsun=vsun_mw):
+    """
+    Function to make a grid of solar positions and motions
+
+    :param r0: distances of the sun from the galactic centre (kpc), the sun being at x = -r0
+    :param zsun: heights of the sun above the plane (kpc)
+    :param vx: solar velocities along x (kms^-1)
+    :param vy: solar velocities along y (kms^-1)
+    :param vz: solar velocities along z (kms^-1)
+    :param rsun: solar position used for the components without a list of values
+    :param vsun: solar motion used for the components without a list of values
+
+    :return: rsuns of shape (n_rsun, 3) and vsuns of shape (n_vsun, 3), the outer products of the values
+    """
+    rsuns = [[-x, rsun[1], z] for x, z in itertools.product([-rsun[0]] if r0 is None else r0,
+                                                            [rsun[2]] if zsun is None else zsun)]
+    vsuns = list(itertools.product(*[[v0] if v is None else v for v, v0 in zip([vx, vy, vz], vsun)]))
+    return np.array(rsuns, dtype=float), np.array(vsuns, dtype=float)
+
+
+def solar_sweep(fit, cubes, rsuns, vsuns):
+    """
+    Function to compute the log likelihood of a set of parameter vectors over a grid of solar parameters
+
+    :param fit: ReflexFit of the data
+    :param cubes: parameters after the prior (n_points x Nparam)
+    :param rsuns: solar positions (n_rsun x 3), kpc
+    :param vsuns: solar motions (n_vsun x 3), kms^-1
+
+    :return: array of shape (n_rsun, n_vsun, n_points) of total log likelihoods
+    """
+    rsuns, vsuns = np.atleast_2d(rsuns), np.atleast_2d(vsuns)
+    cubes = np.atleast_2d(cubes)
+    lnl = np.empty((len(rsuns), len(vsuns), len(cubes)))
+    for i, rsun in enumerate(rsuns):
+        # the geometry depends on the solar position, the solar motions are a batch on it
+        f = fit if np.all(rsun == fit.rsun) else fit.with_solar(rsun=rsun)
+        lnl[i] = f.SolarSweepLogLikelihood(cubes, vsuns)
+    return lnl
+
+
+def sweep_summary(lnl, lnl0):
+    """
+    Function to summarise the log likelihood over a grid of solar parameters
+
+    :param lnl: log likelihoods of shape (..., n_points), see solar_sweep
+    :param lnl0: log likelihoods of the points with the solar parameters of the fit (n_points)
+
+    :return: dictionary of arrays of shape lnl.shape[:-1]: dlnL, the change at the best point of the fit,
+        dlogZ, the log evidence ratio from the points as equally weighted posterior samples, and ess, the
+        effective sample size of its weights
+    """
+    logw = lnl - lnl0
+    n = logw.shape[-1]
+    ess = np.apply_along_axis(effective_sample_size, -1, logw) if n > 1 else np.ones(logw.shape[:-1])
+    return {'dlnL': logw[..., np.argmax(lnl0)],
+            'dlogZ': np.logaddexp.reduce(logw, axis=-1) - np.log(n),
+            'ess': ess}
+
+
+def map_point(prefix):
+    """
+    Function to read the MAP point of a fit
+
+    :param prefix: prefix of the sampler output files, see samplers.run_map
+
+    :return: array of shape (1, Nparam)
+    """
+    with open(prefix + 'map.json') as f:
+        values = json.load(f)['parameters']
+    return np.array([[values[name] for name in parameters]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate a finished fit over a grid of solar parameters.')
+    parser.add_argument('input', help='input file or catalog of the fit')
+    parser.add_argument('prefix', help='prefix of the output files of the fit')
+    parser.add_argument('--map', action='store_true', help='use the MAP point (prefixmap.json) instead of the samples')
+    parser.add_argument('--nsamples', type=int, default=None, help='number of posterior samples, defaults to all')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the choice of samples')
+    parser.add_argument('--rsun', type=float, nargs=3, default=rsun_mw, help='solar position of the fit (kpc)')
+    parser.add_argument('--vsun', type=float, nargs=3, default=vsun_mw, help='solar velocity of the fit (km/s)')
+    parser.add_argument('--r0', type=float, nargs='+', default=None, help='grid of solar distances (kpc)')
+    parser.add_argument('--zsun', type=float, nargs='+', default=None, help='grid of solar heights (kpc)')
+    parser.add_argument('--vx', type=float, nargs='+', default=None, help='grid of solar velocities along x (km/s)')
+    parser.add_argument('--vy', type=float, nargs='+', default=None, help='grid of solar velocities along y (km/s)')
+    parser.add_argument('--vz', type=float, nargs='+', default=None, help='grid of solar velocities along z (km/s)')
+    parser.add_argument('--float32', action='store_true', help='store the data and geometry in float32')
+    args = parser.parse_args()
+
+    fit = ReflexFit(args.input, rsun=args.rsun, vsun=args.vsun, dtype=np.float32 if args.float32 else np.float64)
+    if args.map:
+        cubes = map_point(args.prefix)
+    else:
+        cubes = parent_samples(args.prefix)
+        if args.nsamples is not None and args.nsamples < len(cubes):
+            cubes = cubes[np.random.default_rng(args.seed).choice(len(cubes), args.nsamples, replace=False)]
+
+    rsuns, vsuns = solar_grid(args.r0, args.zsun, args.vx, args.vy, args.vz, fit.rsun, fit.vsun)
+    lnl0 = fit.BatchLogLikelihood(cubes)
+    summary = sweep_summary(solar_sweep(fit, cubes, rsuns, vsuns), lnl0)
+
+    rows = []
+    print('%8s %8s %8s %8s %8s %10s %10s %8s' % ('r0', 'zsun', 'vx', 'vy', 'vz', 'dlnL', 'dlogZ', 'ess'))
+    for i, j in itertools.product(range(len(rsuns)), range(len(vsuns))):
+        row = {'rsun': rsuns[i].tolist(), 'vsun': vsuns[j].tolist()}
+        row.update({key: float(value[i, j]) for key, value in summary.items()})
+        rows.append(row)
+        print('%8.3f %8.3f %8.2f %8.2f %8.2f %10.2f %10.2f %8.0f' % (-rsuns[i, 0], rsuns[i, 2], *vsuns[j],
+                                                                    row['dlnL'], row['dlogZ'], row['ess']))
+    with open(args.prefix + sweep_info, 'w') as f:
+        json.dump({'input': args.input, 'npoints': len(cubes), 'rsun': fit.rsun.tolist(), 'vsun': fit.vsun.tolist(),
+                   'grid': rows}, f, indent=2)
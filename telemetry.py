@@ -0,0 +1,355 @@
+import numpy as np
+import csv
+import json
+import os
+import threading
+import time
+"""
+Opt-in instrumentation of the likelihood and live telemetry of a running fit.
+
+Telemetry wraps a model (ReflexFit or any model of samplers.py) such that the calls of its likelihood
+are counted and timed, and receives the progress of the nested samplers (log evidence, live points,
+remaining evidence of the live points). Every interval seconds it writes a snapshot to a JSON file (the
+latest snapshot and the history, for monitoring and sizing jobs) or appends a row to a CSV file, with
+
+- calls, points: likelihood calls and parameter vectors evaluated, and evals_per_s, the points per
+  second over the last interval and over the run
+- likelihood_fraction: fraction of the wall time spent in the likelihood
+- stages: seconds spent in each stage of the likelihood of ReflexFit, see StageTimer: rotation (the
+  reflex vector of the apex), projection (onto the observables), like_vlos, like_pms and sum, and setup,
+  the one-off computation of the geometry of the stars (the coordinate transforms of get_v)
+- iteration, logZ, dlogz: iteration, log evidence and the estimated log evidence remaining in the live
+  points of the sampler, which stops when dlogz is below its tolerance
+- live_logl_spread, live_param_std: range of the log likelihoods and standard deviation of the
+  parameters of the live points
+- eta_s: estimated time until dlogz reaches the tolerance, from the rate the prior volume shrinks at
+  over the last interval, with the maximum likelihood and evidence as they are (a lower bound early on)
+
+The stages are timed with a few time.perf_counter calls per block of stars, and the calls without
+telemetry pay one attribute check per block. A profiler with the enable()/disable() interface of
+cProfile.Profile can be given, which is only enabled during the likelihood calls (cProfile only sees the
+calling thread, so run with --threads 1 to profile the blocks of stars).
+
+Usage:
+
+python Reflex_fit_data.py processed_real/sgrtests/KGiant_nosgr_40+.txt chains/KG/ nested \
+    --telemetry chains/KG/telemetry.json [--telemetry-interval 10] [--profile]
+
+or from python, ReflexFit(...).run(prefix, 'nested', telemetry=Telemetry(prefix + 'telemetry.csv')).
+"""
+
+# stages of the likelihood of ReflexFit, in the order of the columns of the CSV file
+stages = ['setup', 'rotation', 'projection', 'like_vlos', 'like_pms', 'sum']
+
+
+class StageTimer:
+    """
+    Class accumulating the time spent in the stages of a computation, per thread
+
+    :note: start() marks the beginning of the timed code and lap(stage) adds the time since the previous
+        mark to stage, such that consecutive laps split the code into stages. The marks and totals are kept
+        per thread, so the blocks of the likelihood can be timed on a thread pool, and totals() adds up the
+        threads (the stage times are then CPU seconds summed over the threads)
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._totals = []
+        self._lock = threading.Lock()
+
+    def _thread_totals(self):
+        totals = getattr(self._local, 'totals', None)
+        if totals is None:
+            totals = self._local.totals = dict.fromkeys(stages, 0.)
+            with self._lock:
+                self._totals.append(totals)
+        return totals
+
+    def start(self):
+        """
+        Function to mark the beginning of a timed computation in this thread
+        """
+        self._local.mark = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        Function to add the time since the previous mark of this thread to a stage
+
+        :param stage: name of the stage
+        """
+        now = time.perf_counter()
+        totals = self._thread_totals()
+        totals[stage] = totals.get(stage, 0.) + now - self._local.mark
+        self._local.mark = now
+
+    def add(self, stage, seconds):
+        """
+        Function to add a measured time to a stage
+
+        :param stage: name of the stage
+        :param seconds: time (s)
+        """
+        totals = self._thread_totals()
+        totals[stage] = totals.get(stage, 0.) + seconds
+
+    def totals(self):
+        """
+        Function to add up the time of each stage over the threads
+
+        :return: dictionary of stage and seconds
+        """
+        out = dict.fromkeys(stages, 0.)
+        with self._lock:
+            for totals in self._totals:
+                for stage, t in totals.items():
+                    out[stage] = out.get(stage, 0.) + t
+        return out
+
+    def __getstate__(self):
+        # thread-local state is not sent to parallel workers, they start their own totals
+        return dict()
+
+    def __setstate__(self, state):
+        self.__init__()
+
+
+def _clock_targets(model):
+    """
+    Function to find the objects of a model whose likelihood has stages, see ReflexFit.clock
+
+    :param model: model, see samplers.py, possibly wrapping a ReflexFit as model.fit
+
+    :return: list of objects with a clock attribute
+    """
+    targets = []
+    while model is not None and model not in targets:
+        if hasattr(model, 'clock'):
+            targets.append(model)
+        model = getattr(model, 'fit', None)
+    return targets
+
+
+class Telemetry:
+    """
+    Class recording the likelihood calls and sampler progress of a fit, and writing them periodically
+
+    :param path: output file, .csv for a CSV file with a row per snapshot, otherwise JSON
+    :param interval: minimum time between snapshots (s)
+    :param profiler: profiler with enable() and disable() methods, e.g. cProfile.Profile(), enabled during
+        the likelihood calls; with dump_stats(), its statistics are written to path + '.prof' by close()
+
+    :note: a Telemetry instance records one run, see samplers.run(..., telemetry=...)
+    """
+
+    def __init__(self, path, interval=10., profiler=None):
+        self.path = path
+        self.interval = float(interval)
+        self.profiler = profiler
+        self.clock = StageTimer()
+        self.calls = 0
+        self.points = 0
+        self.likelihood_time = 0.
+        self.progress_state = dict()
+        self.history = []
+        self.t0 = time.time()
+        self._lock = threading.Lock()
+        self._targets = []
+
+    def wrap(self, model):
+        """
+        Function to instrument a model
+
+        :param model: model, see samplers.py
+
+        :return: InstrumentedModel with the interface of model
+        """
+        self._targets = _clock_targets(model)
+        for target in self._targets:
+            target.clock = self.clock
+            setup = getattr(target, 'setup_time', None)
+            if setup:
+                self.clock.add('setup', setup)
+        return InstrumentedModel(model, self)
+
+    def record(self, npoints, seconds):
+        """
+        Function to record a likelihood call
+
+        :param npoints: number of parameter vectors evaluated
+        :param seconds: duration of the call (s)
+        """
+        with self._lock:
+            self.calls += 1
+            self.points += npoints
+            self.likelihood_time += seconds
+        self.write()
+
+    def progress(self, iteration, logZ, logX, live_logl, live_theta=None, dlogz=None, tolerance=None):
+        """
+        Function to record the progress of a nested sampler
+
+        :param iteration: iteration of the sampler
+        :param logZ: current log evidence
+        :param logX: log of the remaining prior volume
+        :param live_logl: log likelihoods of the live points
+        :param live_theta: parameters of the live points (n_live x Nparam)
+        :param dlogz: estimated log evidence remaining in the live points, computed from the above if None
+        :param tolerance: value of dlogz the sampler stops at
+        """
+        live_logl = np.asarray(live_logl, dtype=float)
+        finite = live_logl[np.isfinite(live_logl)]
+        lmax = np.max(finite) if len(finite) else -np.inf
+        if dlogz is None:
+            dlogz = np.logaddexp(logZ, logX + lmax) - logZ if np.isfinite(logZ) else np.inf
+        state = {'iteration': int(iteration), 'logZ': float(logZ), 'logX': float(logX), 'dlogz': float(dlogz),
+                 'live_logl_max': float(lmax),
+                 'live_logl_spread': float(np.ptp(finite)) if len(finite) else np.nan,
+                 'live_param_std': np.std(live_theta, axis=0).tolist() if live_theta is not None else None,
+                 'tolerance': tolerance}
+        self.progress_state = state
+        self.write()
+
+    def _eta(self, now):
+        """
+        Function to estimate the time until the sampler stops
+
+        :param now: current time (s)
+
+        :return: seconds, or None without progress or a rate of the prior volume
+        """
+        state = self.progress_state
+        if not state or state.get('tolerance') is None or not np.isfinite(state['logZ']):
+            return None
+        # the sampler stops when logX + lmax - logZ < log(exp(tolerance) - 1)
+        remaining = state['logX'] + state['live_logl_max'] - state['logZ'] - np.log(np.expm1(state['tolerance']))
+        if remaining <= 0.:
+            return 0.
+        past = [h for h in self.history if h.get('logX') is not None]
+        if not past:
+            return None
+        rate = (past[-1]['logX'] - state['logX']) / max(now - past[-1]['time'], 1.e-9)
+        return float(remaining / rate) if rate > 0. else None
+
+    def snapshot(self):
+        """
+        Function to summarise the telemetry
+
+        :return: dictionary, see the module docstring
+        """
+        now = time.time() - self.t0
+        snap = {'time': now, 'calls': self.calls, 'points': self.points,
+                'evals_per_s_total': self.points / now if now > 0. else 0.,
+                'likelihood_fraction': self.likelihood_time / now if now > 0. else 0.}
+        last = self.history[-1] if self.history else {'time': 0., 'points': 0}
+        snap['evals_per_s'] = (self.points - last['points']) / (now - last['time']) if now > last['time'] else 0.
+        snap['stages'] = self.clock.totals()
+        snap.update({key: self.progress_state.get(key) for key in
+                     ['iteration', 'logZ', 'logX', 'dlogz', 'live_logl_spread', 'live_param_std']})
+        snap['eta_s'] = self._eta(now)
+        return snap
+
+    def write(self, force=False):
+        """
+        Function to write a snapshot if interval has passed since the previous one
+
+        :param force: if True, write regardless of the interval
+        """
+        last = self.history[-1]['time'] if self.history else 0.
+        if not force and time.time() - self.t0 - last < self.interval:
+            return
+        from samplers import mpi_rank
+
+        snap = self.snapshot()
+        self.history.append(snap)
+        if mpi_rank() != 0:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if self.path.endswith('.csv'):
+            row = {key: value for key, value in snap.items() if key not in ['stages', 'live_param_std']}
+            row.update(snap['stages'])
+            new = not os.path.exists(self.path) or len(self.history) == 1
+            with open(self.path, 'w' if new else 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                if new:
+                    writer.writeheader()
+                writer.writerow(row)
+        else:
+            # written to a temporary file and moved, such that a reader never sees a partial file
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'latest': snap, 'history': self.history}, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+    def close(self, result=None):
+        """
+        Function to write the final snapshot and the profiler statistics, and to stop timing the stages
+
+        :param result: dictionary returned by the sampler, whose logZ is recorded
+        """
+        for target in self._targets:
+            target.clock = None
+        if result is not None and np.isfinite(result.get('logZ', np.nan)):
+            self.progress_state = dict(self.progress_state, logZ=float(result['logZ']), dlogz=0.)
+        self.write(force=True)
+        if self.profiler is not None and hasattr(self.profiler, 'dump_stats'):
+            from samplers import mpi_rank
+
+            if mpi_rank() == 0:
+                self.profiler.dump_stats(self.path + '.prof')
+
+
+class InstrumentedModel:
+    """
+    Class forwarding the interface of a model, with its likelihood calls recorded by a Telemetry
+
+    :param model: model, see samplers.py
+    :param telemetry: Telemetry recording the calls
+    """
+
+    def __init__(self, model, telemetry):
+        self.model = model
+        self.telemetry = telemetry
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _timed(self, func, npoints, *args):
+        """
+        Function to call a likelihood function, recording the call
+
+        :param func: likelihood function of the model
+        :param npoints: number of parameter vectors evaluated
+        :param args: arguments of func
+
+        :return: value of func
+        """
+        profiler = self.telemetry.profiler
+        if profiler is not None:
+            profiler.enable()
+        t = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            t = time.perf_counter() - t
+            if profiler is not None:
+                profiler.disable()
+            self.telemetry.record(npoints, t)
+
+    def LogLikelihood(self, cube):
+        """
+        Function to compute the log likelihood of the model, see ReflexFit.LogLikelihood
+        """
+        return self._timed(self.model.LogLikelihood, 1, cube)
+
+    def BatchLogLikelihood(self, cubes):
+        """
+        Function to compute the log likelihood of a set of parameter vectors, see ReflexFit.BatchLogLikelihood
+        """
+        return self._timed(self.model.BatchLogLikelihood, len(np.atleast_2d(cubes)), cubes)
+
+    @property
+    def LogLikelihoodGradient(self):
+        """
+        Log likelihood and gradient of the model, only present if the model has one, see samplers.unit_objective
+        """
+        gradient = self.model.LogLikelihoodGradient
+        return lambda cube: self._timed(gradient, 1, cube)
@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+import pytest
+"""
+Shared fixtures of the tests, run with python -m pytest from the top of the repository.
+"""
+
+# the modules of the repository are flat files at its top level
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def stars():
+    """
+    Small seeded mock catalog, array of shape (300, 17)
+    """
+    from mock import mock_array
+
+    return mock_array(300, seed=1)
+
+
+@pytest.fixture(scope='session')
+def cubes():
+    """
+    Parameters after the prior: the injected parameters of the mock, and draws around them and from the prior
+    """
+    from mock import truth_cube
+    from Reflex_fit_data import BatchPrior
+
+    rng = np.random.default_rng(2)
+    truth = truth_cube()
+    near = truth * (1. + 0.05 * rng.standard_normal((8, len(truth))))
+    near[:, 1] = np.clip(near[:, 1], -0.99, 0.99)
+    return np.vstack([truth, near, BatchPrior(rng.random((8, len(truth))))])
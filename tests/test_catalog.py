@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from catalog import Catalog, columns, convert_text, read_text, text_layout
+"""
+Tests of the reading of the text input files, see catalog.py.
+"""
+
+
+def write(path, d, layout):
+    np.savetxt(path, d if layout == 'rows' else d.T)
+    return str(path)
+
+
+@pytest.mark.parametrize('nstars', [1, 5, 16, 18, 300])
+@pytest.mark.parametrize('layout', ['rows', 'cols'])
+def test_layout_of_small_files(stars, tmp_path, nstars, layout):
+    d = stars[:nstars]
+    fname = write(tmp_path / 'stars.txt', d, layout)
+    assert text_layout(fname) == layout
+    np.testing.assert_array_equal(read_text(fname).array(), d)
+    np.testing.assert_array_equal(Catalog(convert_text(fname)).array(columns), d)
+
+
+@pytest.mark.parametrize('layout', ['rows', 'cols'])
+def test_layout_with_extra_columns(stars, tmp_path, layout):
+    d = np.column_stack([stars[:40], np.arange(40. * 3).reshape(40, 3)])
+    fname = write(tmp_path / 'stars.txt', d, layout)
+    assert text_layout(fname) == layout
+    assert read_text(fname)['col19'][1] == d[1, 19]
+
+
+def test_square_file_needs_a_layout(stars, tmp_path):
+    fname = write(tmp_path / 'stars.txt', stars[:17], 'cols')
+    with pytest.raises(ValueError, match='layout'):
+        text_layout(fname)
+    np.testing.assert_array_equal(read_text(fname, layout='cols').array(), stars[:17])
+
+
+def test_empty_file(tmp_path):
+    fname = tmp_path / 'empty.txt'
+    fname.write_text('# no stars\n\n')
+    with pytest.raises(ValueError, match='no data'):
+        text_layout(str(fname))
+
+
+def test_layout_of_named_columns(tmp_path):
+    # e.g. the _bin_edges.txt files, with two columns
+    fname = tmp_path / 'x_bin_edges.txt'
+    np.savetxt(fname, [[20., 1593.], [30., 696.], [200., 0.]])
+    assert text_layout(str(fname), 2) == 'rows'
+    np.testing.assert_array_equal(read_text(str(fname))['nstars'], [1593., 696., 0.])
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from Reflex_fit_data import ReflexFit
+from distance import DistanceMarginalFit
+"""
+Tests of the likelihood marginalised over the distance errors against ReflexFit, in the limits where they
+agree, and of its convergence with the number of nodes.
+"""
+
+
+def test_single_node_is_reflexfit_without_distance_errors(stars, cubes):
+    # a single node sits at the measured distance with the weight 1
+    exact = stars.copy()
+    exact[:, 12] = 0.
+    np.testing.assert_array_equal(DistanceMarginalFit(ReflexFit(stars), 1).BatchLogLikelihood(cubes),
+                                  ReflexFit(exact).BatchLogLikelihood(cubes))
+
+
+@pytest.mark.parametrize('nodes', [2, 5, 11])
+def test_small_distance_errors_reduce_to_reflexfit(stars, cubes, nodes):
+    small, exact = stars.copy(), stars.copy()
+    small[:, 12] = 1.e-9 * stars[:, 8]
+    exact[:, 12] = 0.
+    np.testing.assert_allclose(DistanceMarginalFit(ReflexFit(small), nodes).BatchLogLikelihood(cubes),
+                               ReflexFit(exact).BatchLogLikelihood(cubes), rtol=1.e-12)
+
+
+def test_convergence_with_the_nodes(stars, cubes):
+    # as in the module docstring and benchmark.py --distance: the scatter between the points near the
+    # maximum of the difference from 21 nodes, for the 10% distance errors of the mock
+    fit = ReflexFit(stars)
+    near = cubes[:9]
+    ref = DistanceMarginalFit(fit, 21).BatchLogLikelihood(near)
+    assert np.std(DistanceMarginalFit(fit, 5).BatchLogLikelihood(near) - ref) < 1.e-3
+    assert np.std(fit.BatchLogLikelihood(near) - ref) > 0.1
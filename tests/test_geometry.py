@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+from coord import cartesian_to_spherical, spherical_to_cartesian, spherical_unit_vectors, euler_xyz, add_vtravel
+from geometry import ReflexGeometry, reflex_vector, rsun_mw, vsun_mw
+from Reflex_fit_data import ReflexFit, get_v
+"""
+Regression tests of the precomputed geometry against the original implementation, which rotated the stars
+to the frame of the apex, added v_travel there and rotated back (the Euler rotation round trip), and summed
+the likelihood star by star.
+"""
+
+
+def round_trip_get_v(lapex, bapex, vtravel, vr, vphi, vth, rgal, solar=True):
+    """
+    Function to compute the observables with the Euler rotation round trip of the original get_v
+
+    :param lapex: azimuthal angle of the apex (rad)
+    :param bapex: polar angle of the apex (rad)
+    :param vtravel, vr, vphi, vth: travel velocity and bulk motion (kms^-1)
+    :param rgal: galactic cartesian coordinates (Nx3)
+    :param solar: if True, the solar motion is subtracted
+
+    :return: vlos, the tangential velocities vl, vb (kms^-1) and fac, 4.74057 times the norm of the
+        heliocentric (r, phi, theta) used by the original get_v
+    """
+    zero = np.zeros(len(rgal))
+    rgalsph = cartesian_to_spherical(rgal[:, 0], rgal[:, 1], rgal[:, 2], zero, zero, zero)[0].T
+
+    # 1. reflex motion: rotate such that the z axis points at the apex, add vtravel and rotate back
+    Rrot = euler_xyz(lapex, bapex, deg=False)
+    rp = np.dot(Rrot, rgal.T).T
+    rpsph = cartesian_to_spherical(rp[:, 0], rp[:, 1], rp[:, 2], zero, zero, zero)[0].T
+    vpsph = add_vtravel(vtravel, rpsph[:, 2]).T
+    rp1, vp1 = spherical_to_cartesian(rpsph[:, 0], rpsph[:, 1], rpsph[:, 2], vpsph[:, 0], vpsph[:, 1], vpsph[:, 2])
+    rgal1 = np.dot(np.linalg.inv(Rrot), rp1).T
+    vgal1 = np.dot(np.linalg.inv(Rrot), vp1).T
+
+    # 2. bulk motion and solar motion, projected onto the unit vectors centred at the sun
+    bulk = spherical_to_cartesian(rgalsph[:, 0], rgalsph[:, 1], rgalsph[:, 2], vr, vphi, vth)[1].T
+    r = rgal1 - rsun_mw
+    v = vgal1 + bulk - (vsun_mw if solar else 0.)
+    rsunsph = cartesian_to_spherical(r[:, 0], r[:, 1], r[:, 2], v[:, 0], v[:, 1], v[:, 2])[0].T
+    elos, ephi, eth = [e.T for e in spherical_unit_vectors(rsunsph[:, 1], rsunsph[:, 2])]
+    fac = 4.74057 * np.linalg.norm(rsunsph, axis=1)
+    return (np.einsum('ij,ij->i', v, elos), np.einsum('ij,ij->i', v, ephi), -np.einsum('ij,ij->i', v, eth),
+            fac)
+
+
+def loop_loglike(cube, d):
+    """
+    Function to compute the log likelihood star by star, as the original LogLikelihood
+
+    :param cube: parameters after the prior
+    :param d: data array (Nx17)
+
+    :return: total log likelihood
+    """
+    vlos, vl, vb, fac = round_trip_get_v(cube[0], np.arccos(cube[1]), *cube[2:6], d[:, :3])
+    mul, mub = vl / fac, vb / fac
+    lnptot = 0.
+    for i in range(len(d)):
+        # line-of-sight velocity
+        evlos2 = d[i, 13] ** 2. + 1. / cube[6]
+        lnptot += -0.5 * np.log(2 * np.pi * evlos2) - 0.5 * (d[i, 9] - vlos[i]) ** 2. / evlos2
+
+        # proper motions, with the 2x2 covariance matrix
+        dist, epml, epmb, edist = d[i, 8], d[i, 14], d[i, 15], d[i, 12]
+        pfac = 4.74057 * dist
+        elp2 = epml ** 2. + edist ** 2. * (d[i, 10] ** 2. / dist ** 2.) + 1. / cube[7] / pfac ** 2.
+        ebp2 = epmb ** 2. + edist ** 2. * (d[i, 11] ** 2. / dist ** 2.) + 1. / cube[8] / pfac ** 2.
+        cov = np.array([[elp2, epml * epmb * d[i, 16]], [epml * epmb * d[i, 16], ebp2]])
+        X = np.array([d[i, 10] - mul[i], d[i, 11] - mub[i]])
+        lnptot += -0.5 * np.log((2 * np.pi) ** 2. * np.linalg.det(cov)) - 0.5 * np.dot(X, np.linalg.solve(cov, X))
+    return lnptot
+
+
+def test_geometry_matches_round_trip(stars, cubes):
+    rgal = stars[:, :3]
+    geom = ReflexGeometry(rgal, rsun_mw, vsun_mw, pm_units=False)
+    for cube in cubes:
+        vlos, vl, vb, fac = round_trip_get_v(cube[0], np.arccos(cube[1]), *cube[2:6], rgal)
+        obs = geom.observables(reflex_vector(cube[0], np.arccos(cube[1]), *cube[2:6]))
+        for x, ref in zip(obs, [vlos, vl, vb]):
+            np.testing.assert_allclose(x, ref, rtol=0., atol=1.e-11 * np.max(np.abs(ref)))
+        np.testing.assert_allclose(geom.fac, fac, rtol=1.e-14)
+
+
+def test_get_v_matches_round_trip(stars, cubes):
+    rgal, vgal = stars[:, :3], stars[:, 3:6]
+    for cube in cubes:
+        vlos, vl, vb, fac = round_trip_get_v(cube[0], np.arccos(cube[1]), *cube[2:6], rgal)
+        for x, ref in zip(get_v(cube, rgal, vgal), [vlos, vl / fac, vb / fac]):
+            np.testing.assert_allclose(x, ref, rtol=0., atol=1.e-11 * np.max(np.abs(ref)))
+
+
+def test_genreflex_get_v_matches_round_trip(stars, cubes):
+    pytest.importorskip('matplotlib')
+    import genreflex
+
+    rgal, vgal = stars[:, :3], stars[:, 3:6]
+    for cube in cubes[:4]:
+        params = [cube[0], np.arccos(cube[1])] + list(cube[2:6])
+        for solar in [False, True]:
+            vlos, vl, vb, fac = round_trip_get_v(*params, rgal, solar=solar)
+            l, b, dsun, *obs = genreflex.get_v(params, rgal, vgal, solar=solar)
+            for x, ref in zip(obs, [vlos, vl * fac, vb * fac]):
+                np.testing.assert_allclose(x, ref, rtol=0., atol=1.e-11 * np.max(np.abs(ref)))
+
+
+def test_loglikelihood_matches_loop(stars, cubes):
+    fit = ReflexFit(stars)
+    ref = np.array([loop_loglike(cube, stars) for cube in cubes])
+    np.testing.assert_allclose([fit.LogLikelihood(cube) for cube in cubes], ref, rtol=1.e-13)
+    np.testing.assert_allclose(fit.BatchLogLikelihood(cubes), ref, rtol=1.e-13)
@@ -0,0 +1,31 @@
+import numpy as np
+from Reflex_fit_data import ReflexFit
+from samplers import check_gradient, unit_objective
+"""
+Tests of the analytic gradient of the likelihood against central finite differences, see samplers.check_gradient.
+"""
+
+
+def test_gradient_matches_finite_differences(stars, cubes):
+    fit = ReflexFit(stars)
+    for cube in cubes:
+        analytic, numeric = check_gradient(fit, cube)
+        np.testing.assert_allclose(analytic, numeric, rtol=1.e-5)
+
+
+def test_gradient_value_matches_loglikelihood(stars, cubes):
+    fit = ReflexFit(stars)
+    for cube in cubes:
+        np.testing.assert_allclose(fit.LogLikelihoodGradient(cube)[0], fit.LogLikelihood(cube), rtol=1.e-12)
+
+
+def test_unit_objective_uses_the_gradient(stars, cubes):
+    # the objective of the map and laplace backends, in the unit hypercube
+    fit = ReflexFit(stars)
+    objective = unit_objective(fit, fit.BatchLogLikelihood)
+    lo, hi = fit.BatchPrior(np.array([np.zeros(fit.n_params), np.ones(fit.n_params)]))
+    u = (cubes[0] - lo) / (hi - lo)
+    value, grad = objective(u)
+    logl, dlogl = fit.LogLikelihoodGradient(cubes[0])
+    np.testing.assert_allclose(value, -logl, rtol=1.e-12)
+    np.testing.assert_allclose(grad, -dlogl * (hi - lo), rtol=1.e-12)
@@ -0,0 +1,54 @@
+import numpy as np
+import os
+import pytest
+from catalog import columns, read_text
+from ingest import equatorial_to_galactic, icrs_to_galactic, transform_chunk
+from geometry import vsun_mw
+"""
+Tests of the transformation of the raw survey columns to the input columns of the fitter, see ingest.py.
+"""
+
+
+def raw_columns(d):
+    """
+    Raw columns of stars in the 17-column format, with the Galactic sky positions and proper motions rotated back
+    to equatorial ones (the errors are passed unrotated, they do not enter x..vz)
+    """
+    c = dict(zip(columns, d.T))
+    l, b = np.deg2rad(c['l']), np.deg2rad(c['b'])
+    cosl, sinl, cosb, sinb = np.cos(l), np.sin(l), np.cos(b), np.sin(b)
+    u = icrs_to_galactic.T @ np.array([cosb * cosl, cosb * sinl, sinb])
+    pm = icrs_to_galactic.T @ (c['mul'] * np.array([-sinl, cosl, np.zeros_like(l)]) +
+                               c['mub'] * np.array([-sinb * cosl, -sinb * sinl, cosb]))
+    ra, dec = np.arctan2(u[1], u[0]), np.arcsin(u[2])
+    east = np.array([-np.sin(ra), np.cos(ra), np.zeros_like(ra)])
+    north = np.array([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)])
+    return {'ra': np.rad2deg(ra) % 360., 'dec': np.rad2deg(dec), 'distance': c['dist'], 'pmra': np.sum(pm * east, axis=0),
+            'pmdec': np.sum(pm * north, axis=0), 'rv': c['vlos'], 'pmra_error': c['emul'], 'pmdec_error': c['emub'],
+            'rv_error': c['evlos'], 'pmra_pmdec_corr': c['corr']}
+
+
+def test_galactic_pole_and_centre():
+    pm, epm, corr = np.array([1., 3.]), np.array([0.2, 0.1]), np.array([0.5, -0.2])
+    l, b, mul, mub, emul, emub, corr_lb = equatorial_to_galactic(np.array([192.85948, 266.40498829]),
+                                                                 np.array([27.12825, -28.93617776]), pm, -pm, epm,
+                                                                 2. * epm, corr)
+    np.testing.assert_allclose(b, [90., 0.], rtol=0., atol=1.e-5)
+    assert abs((l[1] + 180.) % 360. - 180.) < 1.e-5
+
+    # the proper motions and their covariance are rotated, keeping their norm and trace
+    np.testing.assert_allclose(mul ** 2. + mub ** 2., 2. * pm ** 2., rtol=1.e-12)
+    np.testing.assert_allclose(emul ** 2. + emub ** 2., 5. * epm ** 2., rtol=1.e-12)
+    np.testing.assert_allclose(emul * emub * np.sqrt(1. - corr_lb ** 2.), 2. * epm ** 2. * np.sqrt(1. - corr ** 2.),
+                               rtol=1.e-12)
+
+
+@pytest.mark.parametrize('fname', ['processed_real/sgrtests/KGiant_nosgr_40+.txt',
+                                   'processed_real/binned_sgr_4bin/KG/KGiant_edr3_metal_sgr_20_0.txt'])
+def test_transform_reproduces_the_shipped_catalogs(fname):
+    # the K giant catalogs were made with the sun 30 pc above the plane, rather than the 20 pc of rsun_mw
+    d = read_text(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), fname)).array()
+    out, valid = transform_chunk(raw_columns(d), rsun=[-8.3, 0., 0.03], vsun=vsun_mw)
+    assert np.all(valid)
+    for i in [0, 1, 2, 3, 4, 5, 8, 9, 10, 11]:
+        np.testing.assert_allclose(out[columns[i]], d[:, i], rtol=0., atol=1.e-9, err_msg=columns[i])
@@ -0,0 +1,44 @@
+import numpy as np
+import pickle
+from Reflex_fit_data import ReflexFit
+"""
+Tests of the evaluation paths of the likelihood of ReflexFit: blocks of stars, threads, single points and
+the float32 compact mode.
+"""
+
+
+def test_blocks_match_single_block(stars, cubes):
+    ref = ReflexFit(stars, block_size=len(stars)).BatchLogLikelihood(cubes)
+    for block_size in [7, 64, 1000]:
+        fit = ReflexFit(stars, block_size=block_size)
+        np.testing.assert_allclose(fit.BatchLogLikelihood(cubes), ref, rtol=1.e-14)
+        np.testing.assert_allclose([fit.LogLikelihood(cube) for cube in cubes], ref, rtol=1.e-14)
+
+
+def test_threads_do_not_change_the_sum(stars, cubes):
+    # the partial sums of the blocks are added with math.fsum, independent of the order they finish in
+    ref = ReflexFit(stars, block_size=7).BatchLogLikelihood(cubes)
+    for nthreads in [2, 4]:
+        fit = ReflexFit(stars, block_size=7, nthreads=nthreads)
+        np.testing.assert_array_equal(fit.BatchLogLikelihood(cubes), ref)
+        np.testing.assert_array_equal([fit.LogLikelihood(cube) for cube in cubes], ref)
+
+
+def test_threaded_fit_pickles(stars, cubes):
+    fit = ReflexFit(stars, block_size=7, nthreads=2)
+    fit.LogLikelihood(cubes[0])
+    copy = pickle.loads(pickle.dumps(fit))
+    np.testing.assert_array_equal(copy.BatchLogLikelihood(cubes), fit.BatchLogLikelihood(cubes))
+
+
+def test_float32_matches_float64(stars, cubes):
+    # tolerances of the compact mode, see the notes of ReflexFit and benchmark.py --precision
+    fit64, fit32 = ReflexFit(stars), ReflexFit(stars, dtype=np.float32)
+    ref, lnl = fit64.BatchLogLikelihood(cubes), fit32.BatchLogLikelihood(cubes)
+    assert lnl.dtype == np.float64
+    np.testing.assert_allclose(lnl, ref, rtol=1.e-7)
+    np.testing.assert_allclose([fit32.LogLikelihood(cube) for cube in cubes], ref, rtol=1.e-7)
+
+    # around the maximum, the differences between points matter: their scatter is below 1.1e-4
+    near = slice(0, 9)
+    assert np.std(lnl[near] - ref[near]) < 1.1e-4
@@ -0,0 +1,49 @@
+import numpy as np
+from Reflex_fit_data import ReflexFit, Prior, parameters
+from marginal import MarginalReflexFit, bulk, sampled
+"""
+Tests of the fit with the bulk motion marginalised analytically against the likelihood of ReflexFit.
+"""
+
+
+def test_conditional_reproduces_the_likelihood(stars, cubes):
+    fit = ReflexFit(stars)
+    model = MarginalReflexFit(fit)
+    c = cubes[:, sampled]
+    lmax, bhat, L = model.conditional(c)
+    np.testing.assert_allclose(fit.BatchLogLikelihood(model.expand(c, bhat)), lmax, rtol=1.e-12)
+
+    # the log likelihood is exactly quadratic in the bulk motion, with the curvature H = L L^T
+    rng = np.random.default_rng(4)
+    for scale in [1., 10.]:
+        delta = scale * rng.standard_normal(bhat.shape)
+        quadratic = lmax - 0.5 * np.einsum('ni,nij,nj->n', delta, L @ L.transpose(0, 2, 1), delta)
+        np.testing.assert_allclose(fit.BatchLogLikelihood(model.expand(c, bhat + delta)), quadratic, rtol=1.e-10)
+
+
+def test_marginal_matches_grid_integral(stars, cubes):
+    fit = ReflexFit(stars)
+    model = MarginalReflexFit(fit)
+    c = cubes[:9, sampled]
+    lmax, bhat, L = model.conditional(c)
+
+    # trapezoid rule over +-8 sigma in the whitened bulk motion z, with b = b_hat + L^-T z
+    z1 = np.linspace(-8., 8., 49)
+    z = np.array(np.meshgrid(z1, z1, z1, indexing='ij')).reshape(3, -1).T
+    dz = (z1[1] - z1[0]) ** 3.
+    for i in range(len(c)):
+        Linv = np.linalg.inv(L[i])
+        b = bhat[i] + z @ Linv
+        lnl = fit.BatchLogLikelihood(model.expand(np.repeat(c[i:i + 1], len(z), axis=0), b))
+        integral = np.log(np.sum(np.exp(lnl - lmax[i])) * dz * abs(np.linalg.det(Linv))) + lmax[i]
+        np.testing.assert_allclose(model.LogLikelihood(c[i]), integral - np.sum(np.log(model.widths)), rtol=0.,
+                                   atol=1.e-8 * abs(lmax[i]))
+
+
+def test_draws_stay_in_the_prior_box(stars, cubes):
+    model = MarginalReflexFit(ReflexFit(stars))
+    full = model.draws(cubes[:, sampled], ndraws=20, seed=5)
+    lo, hi = Prior(np.zeros(len(parameters)))[bulk], Prior(np.ones(len(parameters)))[bulk]
+    assert full.shape == (20 * len(cubes), len(parameters))
+    assert np.all((full[:, bulk] >= lo) & (full[:, bulk] <= hi))
+    np.testing.assert_array_equal(full[:, sampled], np.repeat(cubes[:, sampled], 20, axis=0))
@@ -0,0 +1,32 @@
+import numpy as np
+from catalog import Catalog, columns
+from mock import make_mocks, mock_array, mock_seed, truth_cube
+from Reflex_fit_data import ReflexFit, BatchPrior
+from samplers import find_map
+"""
+Tests of the mock catalogs: their reproducibility, and the recovery of the injected parameters by the fit.
+"""
+
+
+def test_make_mocks_independent_of_processes_and_in_memory(tmp_path):
+    # several chunks per mock, such that the chunks of the two mocks are spread over the pool
+    settings = dict(nstars=1000, nmocks=2, seed=4, chunk_size=300)
+    serial = make_mocks(str(tmp_path / 'serial.cat'), nproc=1, **settings)
+    parallel = make_mocks(str(tmp_path / 'parallel.cat'), nproc=4, **settings)
+    for s, p in zip(serial, parallel):
+        d = Catalog(s).array(columns)
+        np.testing.assert_array_equal(Catalog(p).array(columns), d)
+        np.testing.assert_array_equal(mock_array(settings['nstars'], mock_seed(s), chunk_size=settings['chunk_size']),
+                                      d)
+    assert not np.array_equal(Catalog(serial[0]).array(columns), Catalog(serial[1]).array(columns))
+
+
+def test_find_map_recovers_the_truth():
+    # without errors, the parameters are only uncertain by the noise of the halo, from the Hessian at the maximum
+    fit = ReflexFit(mock_array(10000, seed=11, errors={'pm_error': 1.e-6, 'evlos': 1.e-6, 'edist': 0.}))
+    u, logl, ncall = find_map(fit, fit.BatchLogLikelihood, np.random.default_rng(0), n_starts=2, verbose=False)
+    theta = BatchPrior(u[None, :])[0]
+    H = np.array([(fit.LogLikelihoodGradient(theta + h)[1] - fit.LogLikelihoodGradient(theta - h)[1]) / (2. * h[i])
+                  for i, h in enumerate(np.diag(1.e-5 * np.abs(theta)))])
+    sigma = np.sqrt(np.diag(np.linalg.inv(-0.5 * (H + H.T))))
+    assert np.all(np.abs(theta - truth_cube()) < 4. * sigma)
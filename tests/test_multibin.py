@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from Reflex_fit_data import ReflexFit
+from multibin import RadialProfileFit
+from samplers import check_gradient
+"""
+Tests of the likelihood of the radial profile fit, which shares the blocked kernel of ReflexFit.
+"""
+
+
+@pytest.fixture(scope='module')
+def profile_cubes(cubes):
+    """
+    Parameters of the radial profile fit: those of cubes with slopes of the apex and travel velocity
+    """
+    rng = np.random.default_rng(3)
+    c = np.zeros((len(cubes), RadialProfileFit.n_params))
+    c[:, [0, 2, 4, 6, 7, 8, 9, 10, 11]] = cubes
+    c[:, [1, 3, 5]] = [0.2, 0.1, 10.] * rng.standard_normal((len(cubes), 3))
+    return c
+
+
+def test_zero_slopes_match_reflexfit(stars, cubes):
+    c = np.zeros((len(cubes), RadialProfileFit.n_params))
+    c[:, [0, 2, 4, 6, 7, 8, 9, 10, 11]] = cubes
+    fit = ReflexFit(stars)
+    np.testing.assert_allclose(RadialProfileFit(fit).BatchLogLikelihood(c), fit.BatchLogLikelihood(cubes),
+                               rtol=1.e-13)
+
+
+def test_blocks_threads_and_float32(stars, profile_cubes):
+    ref = RadialProfileFit(ReflexFit(stars, block_size=len(stars))).BatchLogLikelihood(profile_cubes)
+    for block_size, nthreads in [(7, 1), (64, 4)]:
+        joint = RadialProfileFit(ReflexFit(stars, block_size=block_size, nthreads=nthreads))
+        np.testing.assert_allclose(joint.BatchLogLikelihood(profile_cubes), ref, rtol=1.e-14)
+        np.testing.assert_allclose([joint.LogLikelihood(c) for c in profile_cubes], ref, rtol=1.e-14)
+    joint = RadialProfileFit(ReflexFit(stars, dtype=np.float32))
+    np.testing.assert_allclose(joint.BatchLogLikelihood(profile_cubes), ref, rtol=1.e-7)
+
+
+def test_gradient_matches_finite_differences(stars, profile_cubes):
+    joint = RadialProfileFit(ReflexFit(stars, block_size=64))
+    for c in profile_cubes:
+        logl, grad = joint.LogLikelihoodGradient(c)
+        np.testing.assert_allclose(logl, joint.LogLikelihood(c), rtol=1.e-12)
+        analytic, numeric = check_gradient(joint, c)
+        # the finite differences of the small components are limited by the cancellation of the total
+        np.testing.assert_allclose(analytic, numeric, rtol=1.e-5, atol=1.e-8 * np.max(np.abs(numeric)))
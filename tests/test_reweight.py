@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from Reflex_fit_data import ReflexFit
+from reweight import ParentFit, effective_sample_size
+"""
+Tests of the importance reweighting of a parent fit to subsets of its stars, see reweight.py.
+"""
+
+nested_settings = dict(sampler='nested', n_live_points=200, seed=3, verbose=False)
+
+
+@pytest.fixture(scope='module')
+def parent(stars, tmp_path_factory):
+    """
+    Nested sampling fit of the stars, as the parent fit of the subsets
+    """
+    prefix = str(tmp_path_factory.mktemp('parent') / 'parent-')
+    ReflexFit(stars).run(prefix, **nested_settings)
+    return ParentFit(stars, prefix)
+
+
+def test_full_set_keeps_the_parent_fit(parent, tmp_path):
+    n = len(parent.samples)
+    assert effective_sample_size(np.zeros(n)) == n
+    result, ess = parent.reweight(np.ones(parent.fit.nstars, dtype=bool), str(tmp_path / 'full-'), seed=1)
+    assert ess == n
+    np.testing.assert_allclose(result.logZ, parent.logZ, rtol=0., atol=1.e-12)
+    assert result.logZerr == parent.logZerr
+
+
+def test_subset_matches_a_refit(stars, parent, tmp_path):
+    mask = np.arange(len(stars)) >= 30
+    reweighted, ess = parent.reweight(mask, str(tmp_path / 'reweighted-'), min_ess=0., seed=1)
+    refit = ReflexFit(stars[mask]).run(str(tmp_path / 'refit-'), **nested_settings)
+    assert ess > 0.2 * len(parent.samples)
+
+    # the posteriors agree up to the sampling noise of the two fits, and the evidences within their errors
+    scale = np.std(refit.samples, axis=0)
+    np.testing.assert_array_less(np.abs(np.mean(reweighted.samples, axis=0) - np.mean(refit.samples, axis=0)),
+                                 0.25 * scale)
+    np.testing.assert_allclose(np.std(reweighted.samples, axis=0), scale, rtol=0.2)
+    assert abs(reweighted.logZ - refit.logZ) < 3. * np.hypot(reweighted.logZerr, refit.logZerr)
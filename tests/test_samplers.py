@@ -0,0 +1,58 @@
+import numpy as np
+import os
+import shutil
+import samplers
+from Reflex_fit_data import ReflexFit
+"""
+Tests of the resuming of the sampler backends, see samplers.run.
+"""
+
+nested_settings = dict(n_live_points=40, n_steps=5, dlogz=0.5, checkpoint_every=5, verbose=False)
+
+
+def test_nested_resume_reproduces_the_run(stars, tmp_path):
+    fit = ReflexFit(stars)
+    full = samplers.run_nested(fit, str(tmp_path / 'full-'), seed=3, **nested_settings)
+
+    # a run stopped after 10 iterations, with its checkpoint, continued to the end
+    prefix = str(tmp_path / 'part-')
+    samplers.run_nested(fit, prefix, seed=3, max_iter=10, **nested_settings)
+    resumed = samplers.run_nested(fit, prefix, seed=3, resume=True, **nested_settings)
+    assert resumed['logZ'] == full['logZ']
+    np.testing.assert_array_equal(resumed['samples'], full['samples'])
+
+
+def test_nested_resume_keeps_an_unset_seed(stars, tmp_path):
+    # without a seed, the seed drawn by the first run is kept in the checkpoint, so resuming twice from
+    # the same checkpoint gives the same chains
+    fit = ReflexFit(stars)
+    prefix = str(tmp_path / 'a-')
+    samplers.run_nested(fit, prefix, max_iter=10, **nested_settings)
+    shutil.copy(prefix + 'nested.npz', str(tmp_path / 'b-nested.npz'))
+    first = samplers.run_nested(fit, prefix, resume=True, **nested_settings)
+    second = samplers.run_nested(fit, str(tmp_path / 'b-'), resume=True, **nested_settings)
+    np.testing.assert_array_equal(first['samples'], second['samples'])
+
+
+def test_laplace_resume_returns_the_finished_run(stars, tmp_path):
+    fit = ReflexFit(stars)
+    prefix = str(tmp_path / 'laplace-')
+    first = samplers.run(fit, prefix, 'laplace', n_samples=200, seed=1, verbose=False)
+    mtime = os.path.getmtime(prefix + 'laplace.json')
+    second = samplers.run(fit, prefix, 'laplace', n_samples=200, seed=1, verbose=False)
+    assert os.path.getmtime(prefix + 'laplace.json') == mtime
+    np.testing.assert_allclose(second['samples'], first['samples'], rtol=1.e-15)
+
+    # a change of the settings starts afresh
+    third = samplers.run(fit, prefix, 'laplace', n_samples=100, seed=1, verbose=False)
+    assert len(third['samples']) < len(first['samples'])
+
+
+def test_map_resume_returns_the_finished_run(stars, tmp_path):
+    fit = ReflexFit(stars)
+    prefix = str(tmp_path / 'map-')
+    first = samplers.run(fit, prefix, 'map', seed=1, verbose=False)
+    second = samplers.run(fit, prefix, 'map', seed=1, verbose=False)
+    np.testing.assert_array_equal(second['samples'], first['samples'])
+    np.testing.assert_array_equal(samplers.run(fit, prefix, 'map', resume=False, seed=1, verbose=False)['samples'],
+                                  first['samples'])
@@ -0,0 +1,28 @@
+import numpy as np
+from Reflex_fit_data import ReflexFit
+from geometry import rsun_mw, vsun_mw
+from solar_sweep import solar_grid, solar_sweep
+"""
+Tests of the likelihood over grids of solar parameters against fits made with those parameters.
+"""
+
+
+def test_solar_motions_match_refits(stars, cubes):
+    fit = ReflexFit(stars)
+    vsuns = vsun_mw + np.array([[0., 0., 0.], [-5., 10., 2.], [12., -30., -7.], [0., 40., 0.]])
+    lnl = fit.SolarSweepLogLikelihood(cubes, vsuns)
+    assert lnl.shape == (len(vsuns), len(cubes))
+    for v, x in zip(vsuns, lnl):
+        np.testing.assert_allclose(x, ReflexFit(stars, vsun=v).BatchLogLikelihood(cubes), rtol=1.e-12)
+
+
+def test_sweep_over_solar_positions_matches_with_solar(stars, cubes):
+    fit = ReflexFit(stars)
+    rsuns, vsuns = solar_grid(r0=[8.0, 8.3, 8.5], zsun=[0.0, 0.02], vy=[232.24, 244.24])
+    assert rsuns.shape == (6, 3) and vsuns.shape == (2, 3)
+    np.testing.assert_array_equal(rsuns[0], [-8.0, rsun_mw[1], 0.0])
+    lnl = solar_sweep(fit, cubes, rsuns, vsuns)
+    for i, r in enumerate(rsuns):
+        for j, v in enumerate(vsuns):
+            np.testing.assert_allclose(lnl[i, j], fit.with_solar(rsun=r, vsun=v).BatchLogLikelihood(cubes),
+                                       rtol=1.e-12)
@@ -0,0 +1,49 @@
+import cProfile
+import json
+import numpy as np
+import pytest
+import samplers
+from Reflex_fit_data import ReflexFit
+from telemetry import Telemetry
+"""
+Tests of the telemetry of a run, see telemetry.py.
+"""
+
+
+class FailingFit(ReflexFit):
+    """
+    Class of a fit whose likelihood fails after a number of calls, like an interrupted run
+    """
+
+    ncalls = 0
+
+    def BatchLogLikelihood(self, cubes):
+        FailingFit.ncalls += 1
+        if FailingFit.ncalls > 20:
+            raise RuntimeError('likelihood failed')
+        return ReflexFit.BatchLogLikelihood(self, cubes)
+
+
+def test_telemetry_of_a_run(stars, tmp_path):
+    fit = ReflexFit(stars)
+    telemetry = Telemetry(str(tmp_path / 'telemetry.json'), interval=0.2, profiler=cProfile.Profile())
+    result = samplers.run(fit, str(tmp_path / 'fit-'), 'nested', telemetry=telemetry, n_live_points=40, verbose=False)
+    with open(tmp_path / 'telemetry.json') as f:
+        latest = json.load(f)['latest']
+    assert latest['points'] > 0 and latest['logZ'] == result['logZ']
+    assert all(latest['stages'][stage] > 0. for stage in ['projection', 'like_vlos', 'like_pms', 'sum'])
+    assert (tmp_path / 'telemetry.json.prof').exists()
+    assert fit.clock is None
+
+
+def test_telemetry_closed_when_the_sampler_fails(stars, tmp_path):
+    fit = FailingFit(stars)
+    telemetry = Telemetry(str(tmp_path / 'telemetry.csv'), interval=1.e9, profiler=cProfile.Profile())
+    with pytest.raises(RuntimeError):
+        samplers.run(fit, str(tmp_path / 'fit-'), 'nested', telemetry=telemetry, n_live_points=40, verbose=False)
+    assert fit.clock is None
+    assert (tmp_path / 'telemetry.csv').exists()
+    assert (tmp_path / 'telemetry.csv.prof').exists()
+    rows = np.genfromtxt(tmp_path / 'telemetry.csv', delimiter=',', names=True)
+    # the failed call is recorded too
+    assert rows['calls'] == 21
@@ -0,0 +1,52 @@
+import numpy as np
+from Reflex_fit_data import ReflexFit, BatchPrior, parameters
+from samplers import check_gradient
+from variants import VariantFit, compare_evidence, run_variants, standard_variants
+"""
+Tests of the variants of the model with fixed parameters, and of their runs in parallel processes.
+"""
+
+
+def test_fixed_values_and_prior_of_the_free_parameters(stars):
+    model = VariantFit(ReflexFit(stars), {'vtravel': 0., 'vr': 5.})
+    assert model.parameters == ['l', 'b', 'vphi', 'vth', 'sigvlos', 'sigmul', 'sigmub']
+    u = np.random.default_rng(6).random((50, model.n_params))
+    full_u = np.full((len(u), len(parameters)), 0.5)
+    full_u[:, model.free] = u
+    free = model.BatchPrior(u)
+    np.testing.assert_array_equal(free, BatchPrior(full_u)[:, model.free])
+
+    full = model.expand(free)
+    np.testing.assert_array_equal(full[:, model.free], free)
+    np.testing.assert_array_equal(full[:, parameters.index('vtravel')], 0.)
+    np.testing.assert_array_equal(full[:, parameters.index('vr')], 5.)
+
+
+def test_gradient_of_the_free_parameters(stars, cubes):
+    fit = ReflexFit(stars)
+    model = VariantFit(fit, standard_variants['dipole'])
+    for cube in cubes[:9]:
+        free = cube[model.free]
+        logl, grad = model.LogLikelihoodGradient(free)
+        ref_logl, ref_grad = fit.LogLikelihoodGradient(model.expand(free)[0])
+        assert logl == ref_logl
+        np.testing.assert_array_equal(grad, ref_grad[model.free])
+        analytic, numeric = check_gradient(model, free)
+        np.testing.assert_allclose(analytic, numeric, rtol=1.e-5)
+
+
+def test_parallel_variants_match_serial(stars, tmp_path):
+    # a threaded fit whose thread pool exists before the workers are forked
+    fit = ReflexFit(stars, block_size=64, nthreads=2)
+    fit.LogLikelihood(BatchPrior(np.full((1, len(parameters)), 0.5))[0])
+    settings = dict(sampler='map', n_starts=2, seed=7, verbose=False)
+    serial = run_variants(fit, standard_variants, str(tmp_path / 'serial') + '/', nproc=1, **settings)
+    parallel = run_variants(fit, standard_variants, str(tmp_path / 'parallel') + '/', nproc=2, **settings)
+    for name in standard_variants:
+        assert not isinstance(serial[name], str), serial[name]
+        np.testing.assert_array_equal(parallel[name].samples, serial[name].samples)
+        # the map backend has no evidence, its logZ is NaN
+        np.testing.assert_array_equal([parallel[name].logZ, parallel[name].logZerr],
+                                      [serial[name].logZ, serial[name].logZerr])
+    table = compare_evidence(serial)
+    assert {row['name'] for row in table} == set(standard_variants)
@@ -0,0 +1,310 @@
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import get_all_start_methods, get_context
+from Reflex_fit_data import ReflexFit, FitResult, Prior, parameters
+"""
+Fit variants of the reflex motion model to one dataset and compare their evidences.
+
+A variant fixes any subset of the parameters of ReflexFit to given values (after the prior, e.g. vtravel=0)
+and samples the others with the prior of Prior, so its evidence is that of the reduced model. All variants
+use the same ReflexFit, whose geometry is computed once: the variants are run in parallel in processes
+forked after the fit is made, which share its arrays. The processes are forked on every platform that
+supports it, including macOS where the default start method is spawn. On Windows, where fork does not
+exist, the fit is pickled to each worker instead, costing its memory once per process.
+
+The standard variants are:
+
+- full: all nine parameters
+- dipole: the reflex motion only, with the bulk motion fixed to zero
+- bulk: no reflex motion (v_travel = 0, with the then meaningless apex fixed), only the bulk motion
+- null: no reflex or bulk motion, only the velocity dispersions
+
+and others are given on the command line as name:param=value,param=value. The output of each variant is
+written to prefix<name>-, and the evidences with their differences from the reference variant (full) to
+prefixvariants.json.
+
+Usage:
+
+python variants.py processed_real/sgrtests/KGiant_nosgr_40+.txt chains/KGiant_nosgr_40+/ nested \
+    --variants full dipole bulk null --nproc 4
+"""
+
+standard_variants = {
+    'full': {},
+    'dipole': {'vr': 0., 'vphi': 0., 'vth': 0.},
+    'bulk': {'l': 0., 'b': 0., 'vtravel': 0.},
+    'null': {'l': 0., 'b': 0., 'vtravel': 0., 'vr': 0., 'vphi': 0., 'vth': 0.},
+}
+
+# file recording the evidences of the variants
+variants_info = 'variants.json'
+
+# fit shared by the forked workers, see run_variants
+_shared_fit = None
+
+
+def parse_variant(text):
+    """
+    Function to read a variant from the command line
+
+    :param text: name of a standard variant, or name:param=value,param=value
+
+    :return: name and dictionary of the fixed parameters
+    """
+    if ':' not in text:
+        if text not in standard_variants:
+            raise ValueError('unknown variant %s, give it as %s:param=value,...' % (text, text))
+        return text, standard_variants[text]
+    name, spec = text.split(':', 1)
+    return name, {key: float(value) for key, value in (item.split('=') for item in spec.split(',') if item)}
+
+
+class VariantFit:
+    """
+    Class holding a variant of a reflex motion fit with some of the parameters fixed
+
+    :param fit: ReflexFit of the stars
+    :param fixed: dictionary of the fixed parameters and their values after the prior, e.g. {'vtravel': 0.}
+
+    :note: the instance provides the model interface of the samplers in samplers.py
+    """
+
+    def __init__(self, fit, fixed=None):
+        self.fit = fit
+        self.fixed = {name: float(value) for name, value in (fixed or dict()).items()}
+        unknown = sorted(set(self.fixed) - set(parameters))
+        if unknown:
+            raise ValueError('unknown parameters %s, the parameters are %s' % (unknown, parameters))
+        self.free = [i for i, name in enumerate(parameters) if name not in self.fixed]
+        self.parameters = [parameters[i] for i in self.free]
+        self.n_params = len(self.parameters)
+
+    def expand(self, cubes):
+        """
+        Function to make the parameters of ReflexFit from the free parameters
+
+        :param cubes: free parameters (n_points x Nparam)
+
+        :return: array of shape (n_points, 9)
+        """
+        cubes = np.atleast_2d(cubes)
+        full = np.empty((len(cubes), len(parameters)))
+        full[:, self.free] = cubes
+        for name, value in self.fixed.items():
+            full[:, parameters.index(name)] = value
+        return full
+
+    def Prior(self, cube):
+        """
+        Function to define the prior for the free parameters, those of Prior
+
+        :param cube: Multinest hypercube (1xNparam)
+        """
+        full = np.full((len(parameters),) + np.shape(cube)[1:], 0.5)
+        full[self.free] = cube
+        cube[:] = Prior(full)[self.free]
+        return cube
+
+    def BatchPrior(self, cubes):
+        """
+        Function to apply the prior to a set of points of the unit hypercube at once
+
+        :param cubes: points of the unit hypercube (n_points x Nparam)
+
+        :return: parameters of shape (n_points x Nparam)
+        """
+        return self.Prior(np.array(cubes, dtype=float).T).T
+
+    def BatchLogLikelihood(self, cubes):
+        """
+        Function to compute the log likelihood of a set of parameter vectors at once
+
+        :param cubes: free parameters (n_points x Nparam)
+
+        :return: lnptot, array of n_points total log likelihoods
+        """
+        return self.fit.BatchLogLikelihood(self.expand(cubes))
+
+    def LogLikelihood(self, cube):
+        """
+        Function to compute the log likelihood of the model given the data
+
+        :param cube: Multinest hypercube (1xNparam)
+
+        :return: lnptot, the total log likelihood
+        """
+        return self.BatchLogLikelihood(np.asarray(cube)[None, :])[0]
+
+    def LogLikelihoodGradient(self, cube):
+        """
+        Function to compute the log likelihood and its gradient with respect to the free parameters
+
+        :param cube: free parameters (1xNparam)
+
+        :return: lnptot, the total log likelihood, and its gradient of shape (Nparam,)
+        """
+        logl, grad = self.fit.LogLikelihoodGradient(self.expand(cube)[0])
+        return logl, grad[self.free]
+
+    def fingerprint(self):
+        """
+        Function to compute a hash of the data and fixed parameters the likelihood depends on
+
+        :return: hexadecimal sha256 hash
+        """
+        return hashlib.sha256(('%s %s' % (self.fit.fingerprint(), json.dumps(self.fixed, sort_keys=True))
+                               ).encode()).hexdigest()
+
+    def run(self, prefix, sampler='multinest', resume=True, **kwargs):
+        """
+        Function to run the sampler
+
+        :param prefix: prefix for the sampler output files
+        :param sampler: name of the sampler backend, one of samplers.backends
+        :param resume: if True, resume from the output files of a previous run, see ReflexFit.run
+        :param kwargs: sampler settings, see samplers.py
+
+        :return: FitResult of the free parameters
+        """
+        import samplers
+
+        result = samplers.run(self, prefix, sampler, resume, **kwargs)
+        if samplers.mpi_rank() == 0:
+            with open('%sparams.json' % prefix, 'w') as f:
+                json.dump(self.parameters + ['%s=%g' % item for item in self.fixed.items()], f, indent=2)
+        return FitResult(result['samples'], result['logZ'], result['logZerr'], prefix, self.parameters)
+
+
+def variant_prefixes(prefix, names):
+    """
+    Function to name the output prefixes of the variants
+
+    :param prefix: prefix of the output files
+    :param names: names of the variants
+
+    :return: list of prefixes
+    """
+    return ['%s%s-' % (prefix, name) for name in names]
+
+
+def _init_worker(fit):
+    """
+    Function to set the fit shared by the variants in a pool worker
+
+    :param fit: ReflexFit, inherited without a copy by forked workers
+    """
+    global _shared_fit
+    # the threads of the thread pool of the parent do not exist in a forked worker
+    fit.configure(fit.block_size, fit.nthreads)
+    _shared_fit = fit
+
+
+def _variant_worker(args):
+    """
+    Function to fit a single variant, to be called by the process pool
+
+    :param args: (fixed parameters, prefix, sampler settings)
+
+    :return: (prefix, FitResult or error message)
+    """
+    fixed, prefix, settings = args
+    try:
+        return prefix, VariantFit(_shared_fit, fixed).run(prefix, **settings)
+    except (Exception, SystemExit) as e:
+        # pymultinest calls sys.exit on errors, which would otherwise take down the pool worker
+        return prefix, 'failed: %r' % e
+
+
+def run_variants(fit, variants, prefix, nproc=None, **settings):
+    """
+    Function to fit the variants of the model to one dataset
+
+    :param fit: ReflexFit of the stars
+    :param variants: dictionary of variant name and fixed parameters, see VariantFit
+    :param prefix: prefix of the output files, the variants are written to prefix<name>-
+    :param nproc: number of processes, defaults to one per variant up to the number of cores
+    :param settings: sampler settings, see ReflexFit.run
+
+    :return: dictionary of variant name and FitResult (or error message)
+
+    :note: the workers are forked where possible, such that they share the arrays of fit, and are spawned
+        with a pickled copy of fit otherwise (Windows)
+    """
+    names = list(variants)
+    for name in names:
+        # check the fixed parameters before starting any fit
+        VariantFit(fit, variants[name])
+    if nproc is None:
+        nproc = min(os.cpu_count(), len(names))
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    tasks = [(variants[name], p, settings) for name, p in zip(names, variant_prefixes(prefix, names))]
+    if nproc <= 1:
+        _init_worker(fit)
+        results = dict(_variant_worker(task) for task in tasks)
+    else:
+        context = get_context('fork' if 'fork' in get_all_start_methods() else None)
+        with context.Pool(nproc, initializer=_init_worker, initargs=(fit,)) as pool:
+            results = dict(pool.imap_unordered(_variant_worker, tasks))
+    return {name: results[p] for name, p in zip(names, variant_prefixes(prefix, names))}
+
+
+def compare_evidence(results, reference='full'):
+    """
+    Function to compare the evidences of the variants
+
+    :param results: dictionary of variant name and FitResult, see run_variants
+    :param reference: name of the variant the evidences are compared to, defaults to the best variant
+        if it is not in results
+
+    :return: list of dictionaries with the name, number of free parameters, logZ, logZerr, the difference
+        dlogZ = logZ - logZ(reference) and its error, sorted by decreasing evidence
+    """
+    done = {name: r for name, r in results.items() if isinstance(r, FitResult)}
+    if not done:
+        return []
+    if reference not in done:
+        reference = max(done, key=lambda name: done[name].logZ)
+    ref = done[reference]
+    rows = [{'name': name, 'nfree': len(r.names), 'logZ': float(r.logZ), 'logZerr': float(r.logZerr),
+             'dlogZ': float(r.logZ - ref.logZ), 'dlogZerr': float(np.hypot(r.logZerr, ref.logZerr)) if
+             name != reference else 0., 'reference': reference} for name, r in done.items()]
+    return sorted(rows, key=lambda row: -row['logZ'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit variants of the reflex motion model and compare their evidences.')
+    parser.add_argument('input', help='input file or catalog directory')
+    parser.add_argument('prefix', help='prefix of the output files')
+    parser.add_argument('sampler', nargs='?', default='multinest', choices=['multinest', 'nested', 'map', 'laplace'],
+                        help='sampler backend')
+    parser.add_argument('--variants', nargs='+', default=list(standard_variants),
+                        help='standard variants (%s) or name:param=value,...' % ', '.join(standard_variants))
+    parser.add_argument('--reference', default='full', help='variant the evidences are compared to')
+    parser.add_argument('--n-live-points', type=int, default=None, help='number of live points')
+    parser.add_argument('--nproc', type=int, default=None, help='number of processes for the variants')
+    parser.add_argument('--no-resume', action='store_true', help='start afresh instead of resuming')
+    parser.add_argument('--float32', action='store_true', help='store the data and geometry in float32')
+    args = parser.parse_args()
+
+    settings = dict(sampler=args.sampler, resume=not args.no_resume)
+    if args.n_live_points is not None:
+        settings['n_live_points'] = args.n_live_points
+    variants = dict(parse_variant(text) for text in args.variants)
+
+    fit = ReflexFit(args.input, dtype=np.float32 if args.float32 else np.float64)
+    results = run_variants(fit, variants, args.prefix, args.nproc, **settings)
+    for name, result in results.items():
+        if not isinstance(result, FitResult):
+            print('%-12s %s' % (name, result))
+
+    rows = compare_evidence(results, args.reference)
+    print()
+    print('%-12s %5s %16s %16s' % ('variant', 'nfree', 'lnZ', 'dlnZ'))
+    for row in rows:
+        print('%-12s %5d %9.2f +- %4.2f %9.2f +- %4.2f' % (row['name'], row['nfree'], row['logZ'], row['logZerr'],
+                                                          row['dlogZ'], row['dlogZerr']))
+    with open(args.prefix + variants_info, 'w') as f:
+        json.dump({'input': args.input, 'variants': variants, 'evidence': rows}, f, indent=2)